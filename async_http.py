@@ -0,0 +1,898 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import asyncio
+import functools
+import socket
+import time
+# Internal modules
+import client_http
+import config_srv
+import h2_http
+import hpack_http
+import limit_http
+import log_http
+import metrics_http
+import proxy_http
+import tls_http
+
+# Bytes buffered by the stream of a connection before it stops reading the socket
+READ_LIMIT = 64 * 1024
+
+
+async def client_processing(reader, writer):
+    """
+    Serve the requests of a client on the event loop, with the same
+    keep-alive and pipelining behaviour as client_http.client_processing.
+    An idle connection only costs its buffers, not a thread; the responses
+    are built by the default executor, so a file read or a listing does not
+    stall the other connections.
+    :param reader: stream to read the requests from
+    :type reader: asyncio.StreamReader
+    :param writer: stream to write the responses to
+    :type writer: asyncio.StreamWriter
+    :return: None
+    :rtype: None
+    """
+    peername = writer.get_extra_info("peername")
+    address = peername[0] if peername else "-"
+    counted = limit_http.connection_opened(address)
+    if counted is False:
+        # Refused before reading anything, like the accept loop of the threads engine
+        await refuse(writer, 503)
+        return None
+    metrics_http.connection_opened()
+    max_requests = config_srv.CONFIGURATION['KeepAliveMax']
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    served = 0
+    keep_alive = True
+    try:
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.selected_alpn_protocol() == "h2":
+            # Chosen with ALPN, the client starts with the HTTP/2 preface
+            await serve_h2(reader, writer, buffer, h2_http.Connection(address))
+            keep_alive = False
+        while keep_alive:
+            (code, request) = await read_request(reader, buffer)
+            if code is None:
+                break
+            if code != 200:
+                data = client_http.gen_data_error(code)
+                header = client_http.generate_header(code, len(data))
+                await send_response(writer, header, data)
+                metrics_http.response(code, len(header) + len(data))
+                log_http.access(address, None, code, len(data), 0)
+                break
+            if not limit_http.allow(address):
+                data = client_http.gen_data_error(429)
+                header = client_http.generate_header(429, len(data), extra=[("Retry-After", limit_http.retry_after())])
+                await send_response(writer, header, data)
+                metrics_http.response(429, len(header) + len(data))
+                log_http.access(address, request, 429, len(data), 0)
+                break
+            connection = h2_http.start(request, address)
+            if connection is not None:
+                await serve_h2(reader, writer, buffer, connection)
+                break
+            received = time.perf_counter()
+            served += 1
+            upstream = proxy_http.route(request)
+            if upstream is not None:
+                (code, header_length, length, keep_alive) = await forward(
+                    reader, writer, buffer, request, upstream, served < max_requests, address)
+                if header_length is None:
+                    data = client_http.gen_data_error(code)
+                    header = client_http.generate_header(code, len(data))
+                    await send_response(writer, header, data)
+                    (header_length, length) = (len(header), len(data))
+                metrics_http.response(code, header_length + length)
+                log_http.access(address, request, code, length, time.perf_counter() - received)
+                continue
+            (header, data, keep_alive) = await loop.run_in_executor(
+                None, client_http.handle_request, request, served < max_requests)
+            begin = time.perf_counter()
+            await send_response(writer, header, data)
+            sent = time.perf_counter()
+            metrics_http.observe("send", sent - begin)
+            code = int(header[9:12])
+            length = client_http.body_length(data)
+            metrics_http.response(code, len(header) + length)
+            log_http.access(address, request, code, length, sent - received)
+    except ConnectionError:
+        pass
+    finally:
+        metrics_http.connection_closed()
+        if counted:
+            limit_http.connection_closed(address)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+    return None
+
+
+async def refuse(writer, code):
+    """
+    Answer an error and close the connection, like client_http.reject
+    :param writer: stream to write the response to
+    :type writer: asyncio.StreamWriter
+    :param code: HTTP error code
+    :type code: int
+    :return: None
+    :rtype: None
+    """
+    data = client_http.gen_data_error(code)
+    response = client_http.generate_header(code, len(data)) + data
+    try:
+        writer.write(response)
+        await writer.drain()
+        metrics_http.response(code, len(response))
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+    return None
+
+
+async def read_request(reader, buffer):
+    """
+    Event loop equivalent of client_http.read_request, with the same limits
+    :type reader: asyncio.StreamReader
+    :param buffer: bytes received from the client and not used yet, kept between the requests
+    :type buffer: bytearray
+    :return: code and request, (None, None) when the connection is over
+    :rtype: tuple
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None
+    started = time.perf_counter()
+    searched = 0
+    while True:
+        (code, request) = client_http.take_request(buffer, searched)
+        if code is not None:
+            metrics_http.observe("read", time.perf_counter() - started)
+            return code, request
+        if deadline is None and buffer:
+            # A request has started, the time spent waiting for it is not counted
+            started = time.perf_counter()
+            deadline = loop.time() + config_srv.CONFIGURATION['RequestTimeout']
+        if deadline is None:
+            timeout = config_srv.CONFIGURATION['KeepAliveTimeout']
+        else:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return 408, None
+        try:
+            data = await asyncio.wait_for(reader.read(client_http.RECV_SIZE), timeout)
+        except asyncio.TimeoutError:
+            if buffer:
+                return 408, None
+            # Idle connection
+            return None, None
+        if not data:
+            # Connection closed by the client
+            return None, None
+        searched = len(buffer)
+        buffer += data
+
+
+async def send_stream(writer, stream):
+    """
+    Event loop equivalent of client_http.send_stream. The source, which may block
+    (reading a pipe, waiting for an event), is read by a thread of the loop,
+    and the next chunk is only taken once the buffer of the writer is drained.
+    :type writer: asyncio.StreamWriter
+    :type stream: client_http.BodyStream
+    :return: None
+    :rtype: None
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, stream.read)
+        writer.write(client_http.chunk_frame(stream, chunk))
+        await writer.drain()
+        if not chunk:
+            return None
+
+
+async def send_response(writer, header, data):
+    """
+    Event loop equivalent of client_http.send_response,
+    the FileRange parts are sent with the sendfile of the loop and closed.
+    :type writer: asyncio.StreamWriter
+    :param header: response header
+    :type header: bytes
+    :param data: response body, bytes or list of bytes, FileRange and BodyStream
+    :type data: bytes or memoryview or list or client_http.BodyStream
+    :return: None
+    :rtype: None
+    """
+    if isinstance(data, client_http.BodyStream):
+        data = [data]
+    if isinstance(data, memoryview):
+        # Not joined to the header, a mapped file is not copied
+        writer.write(header)
+        writer.write(data)
+        await writer.drain()
+        return None
+    if not isinstance(data, list):
+        writer.write(header + data)
+        await writer.drain()
+        return None
+    try:
+        writer.write(header)
+        for part in data:
+            if isinstance(part, client_http.FileRange):
+                await writer.drain()
+                await asyncio.get_running_loop().sendfile(writer.transport, part.file, part.offset, part.count)
+            elif isinstance(part, client_http.BodyStream):
+                await send_stream(writer, part)
+            else:
+                writer.write(part)
+        await writer.drain()
+    finally:
+        client_http.close_body(data)
+    return None
+
+
+class Stream:
+    """
+    Event loop equivalent of proxy_http.Connection, each read waiting at most timeout seconds
+    """
+    __slots__ = ("reader", "buffer", "timeout")
+
+    def __init__(self, reader, buffer, timeout):
+        self.reader = reader
+        self.buffer = buffer
+        self.timeout = timeout
+
+    async def read(self, size):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return await asyncio.wait_for(self.reader.read(size), self.timeout)
+
+    async def readline(self):
+        searched = 0
+        while True:
+            end = self.buffer.find(b"\n", searched)
+            if end != -1:
+                line = bytes(self.buffer[:end + 1])
+                del self.buffer[:end + 1]
+                return line
+            if len(self.buffer) >= config_srv.CONFIGURATION['MaxHeaderSize']:
+                raise ValueError("Line too long")
+            searched = len(self.buffer)
+            data = await asyncio.wait_for(self.reader.read(proxy_http.COPY_SIZE), self.timeout)
+            if not data:
+                raise ConnectionError("Connection closed")
+            self.buffer += data
+
+
+async def read_head(stream):
+    """
+    Event loop equivalent of proxy_http.read_head
+    :type stream: Stream
+    :rtype: str
+    """
+    lines = []
+    size = 0
+    while True:
+        line = await stream.readline()
+        size += len(line)
+        if size > config_srv.CONFIGURATION['MaxHeaderSize']:
+            raise ValueError("Response header too large")
+        if line in (b"\r\n", b"\n"):
+            return "".join(lines) + "\r\n"
+        lines.append(line.decode("latin-1").rstrip("\r\n") + "\r\n")
+
+
+async def copy_body(source, writer, length, dechunk=False):
+    """
+    Event loop equivalent of proxy_http.copy_body
+    :type source: Stream
+    :param writer: stream of the other side
+    :type writer: asyncio.StreamWriter
+    :param length: bytes, proxy_http.CHUNKED, or None until the source closes the connection
+    :type length: int or None
+    :param dechunk: relay only the data of a body sent in chunks
+    :type dechunk: bool
+    :return: bytes relayed
+    :rtype: int
+    """
+    async def copy_length(left):
+        while left > 0:
+            data = await source.read(min(left, proxy_http.COPY_SIZE))
+            if not data:
+                raise ConnectionError("Connection closed before the end of the body")
+            writer.write(data)
+            await writer.drain()
+            left -= len(data)
+
+    if length is None:
+        length = 0
+        while True:
+            data = await source.read(proxy_http.COPY_SIZE)
+            if not data:
+                return length
+            writer.write(data)
+            await writer.drain()
+            length += len(data)
+    if length != proxy_http.CHUNKED:
+        await copy_length(length)
+        return length
+    length = 0
+    while True:
+        line = await source.readline()
+        size = int(line.split(b";")[0], 16)
+        if not dechunk:
+            writer.write(line)
+            length += len(line)
+        if size == 0:
+            break
+        if dechunk:
+            await copy_length(size)
+            await source.readline()
+            length += size
+        else:
+            await copy_length(size + 2)
+            length += size + 2
+    while True:
+        line = await source.readline()
+        if not dechunk:
+            writer.write(line)
+            length += len(line)
+        if line in (b"\r\n", b"\n"):
+            await writer.drain()
+            return length
+
+
+async def acquire(backend):
+    """
+    Event loop equivalent of proxy_http.acquire
+    :type backend: proxy_http.Backend
+    :return: the connection as a Stream and its writer, and whether it was used before
+    :rtype: tuple
+    :raise: OSError when the server can't be reached
+    """
+    timeout = config_srv.CONFIGURATION['UpstreamTimeout']
+    while backend.streams:
+        (reader, writer, watch) = backend.streams.pop()
+        if not watch.done() and not writer.is_closing():
+            watch.cancel()
+            await asyncio.wait([watch])
+            # Nothing read while the connection was idle
+            if watch.cancelled():
+                proxy_http.stats['reused'] += 1
+                return Stream(reader, bytearray(), timeout), writer, True
+        # Closed by the server, or data received without request
+        writer.close()
+    (reader, writer) = await asyncio.wait_for(asyncio.open_connection(*backend.address), timeout)
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    proxy_http.stats['opened'] += 1
+    return Stream(reader, bytearray(), timeout), writer, False
+
+
+def release(backend, stream, writer, reusable):
+    """
+    Event loop equivalent of proxy_http.release
+    :type backend: proxy_http.Backend
+    :type stream: Stream or None
+    :type writer: asyncio.StreamWriter or None
+    :type reusable: bool
+    :return: None
+    :rtype: None
+    """
+    with proxy_http.lock:
+        backend.active -= 1
+    if reusable and not stream.buffer and len(backend.streams) < config_srv.CONFIGURATION['UpstreamPoolSize']:
+        # Read while the connection is idle: it ends when the server closes the connection or sends data
+        # without request, making the connection unusable; cancelled by acquire otherwise
+        watch = asyncio.ensure_future(stream.reader.read(1))
+        backend.streams.append((stream.reader, writer, watch))
+    elif writer is not None:
+        writer.close()
+    return None
+
+
+async def relay_request_body(client, writer, length):
+    """
+    Event loop equivalent of proxy_http.relay_request_body
+    :type client: Stream
+    :param writer: stream of the upstream server
+    :type writer: asyncio.StreamWriter
+    :param length: bytes, or proxy_http.CHUNKED
+    :type length: int
+    :return: bytes relayed
+    :rtype: int
+    :raise: proxy_http.ClientError when the client fails, OSError when the server does
+    """
+    try:
+        return await copy_body(client, writer, length)
+    except asyncio.TimeoutError as e:
+        # Only the reads of the client have a timeout
+        raise proxy_http.ClientError(408) from e
+    except (OSError, ValueError) as e:
+        # The writes fail once the server has closed the connection
+        if writer.is_closing():
+            raise
+        raise proxy_http.ClientError(400) from e
+
+
+async def forward(reader, writer, buffer, request, chosen, keep_alive, address):
+    """
+    Event loop equivalent of proxy_http.forward
+    :type reader: asyncio.StreamReader
+    :type writer: asyncio.StreamWriter
+    :param buffer: bytes received from the client and not used yet, starting with the request body
+    :type buffer: bytearray
+    :type request: str
+    :param chosen: route given by proxy_http.route
+    :type chosen: tuple
+    :type keep_alive: bool
+    :type address: str
+    :return: status code, header and body lengths sent to the client, whether the connection stays open;
+             the header length is None for an error to answer, nothing being sent
+    :rtype: tuple
+    """
+    try:
+        (first, fields) = proxy_http.parse_head(request)
+        length = proxy_http.request_length(fields)
+    except ValueError:
+        return 400, None, 0, False
+    (method, target, version) = first
+    keep_alive = keep_alive and proxy_http.persistent(version, fields)
+    backend = proxy_http.choose(chosen)
+    if backend is None:
+        return 503, None, 0, False
+    head = proxy_http.upstream_request(method, target, fields, backend, address)
+    if "100-continue" in proxy_http.field(fields, "expect").lower():
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+    client = Stream(reader, buffer, config_srv.CONFIGURATION['KeepAliveTimeout'])
+    while True:
+        try:
+            (upstream, upstream_writer, reused) = await acquire(backend)
+        except OSError:
+            proxy_http.failed(backend)
+            release(backend, None, None, False)
+            return 502, None, 0, False
+        try:
+            upstream_writer.write(head)
+            if length:
+                await relay_request_body(client, upstream_writer, length)
+            await upstream_writer.drain()
+            (response, response_fields) = proxy_http.parse_head(await read_head(upstream))
+            # Interim responses, like 100 Continue, are not relayed
+            while response[1].startswith("1") and response[1] != "101":
+                (response, response_fields) = proxy_http.parse_head(await read_head(upstream))
+            code = int(response[1])
+            body = proxy_http.response_length(method, code, response_fields)
+            break
+        except proxy_http.ClientError as e:
+            release(backend, upstream, upstream_writer, False)
+            return e.code, None, 0, False
+        except asyncio.TimeoutError:
+            proxy_http.stats['errors'] += 1
+            release(backend, upstream, upstream_writer, False)
+            return 504, None, 0, False
+        except (OSError, ValueError):
+            upstream_writer.close()
+            if reused and not length and method in proxy_http.IDEMPOTENT:
+                continue
+            proxy_http.stats['errors'] += 1
+            release(backend, None, None, False)
+            return 502, None, 0, False
+    dechunk = body == proxy_http.CHUNKED and version == "HTTP/1.0"
+    keep_alive = keep_alive and body is not None and not dechunk
+    header = proxy_http.client_response(response, response_fields, keep_alive, dechunk)
+    sent = 0
+    try:
+        writer.write(header)
+        sent = await copy_body(upstream, writer, body, dechunk)
+        reusable = body is not None and proxy_http.persistent(response[0], response_fields)
+    except (OSError, ValueError):
+        # The response is started: the client only sees the connection closed
+        (reusable, keep_alive) = (False, False)
+    release(backend, upstream, upstream_writer, reusable)
+    return code, len(header), sent, keep_alive
+
+
+async def serve_h2(reader, writer, buffer, connection):
+    """
+    Event loop equivalent of h2_http.serve: a task gives the frames received to the connection
+    while this one sends what the connection has to send, the BodyStream chunks being read
+    in the executor of the loop
+    :type reader: asyncio.StreamReader
+    :type writer: asyncio.StreamWriter
+    :param buffer: bytes received after the request which started HTTP/2
+    :type buffer: bytearray
+    :param connection: connection given by h2_http.start
+    :type connection: h2_http.Connection
+    :return: None
+    :rtype: None
+    """
+    received = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def produced(stream, body, future):
+        connection.produced(stream, body, future.result())
+        received.set()
+
+    async def read_forever():
+        try:
+            while not connection.closed:
+                data = await reader.read(proxy_http.COPY_SIZE)
+                if not data:
+                    break
+                connection.receive(data)
+                received.set()
+        except ConnectionError:
+            pass
+        finally:
+            received.set()
+
+    connection.receive(bytes(buffer))
+    buffer.clear()
+    task = asyncio.create_task(read_forever())
+    try:
+        while True:
+            out = connection.data_to_send()
+            if out:
+                writer.write(out)
+                await writer.drain()
+            if connection.closed or task.done():
+                break
+            for (stream, body) in connection.to_produce():
+                loop.run_in_executor(None, h2_http.read_chunk, body).add_done_callback(
+                    functools.partial(produced, stream, body))
+            if not connection.sendable():
+                received.clear()
+                try:
+                    await asyncio.wait_for(received.wait(), config_srv.CONFIGURATION['KeepAliveTimeout'])
+                except asyncio.TimeoutError:
+                    if not connection.producing():
+                        connection.close(h2_http.NO_ERROR)
+    except ConnectionError:
+        pass
+    finally:
+        task.cancel()
+        connection.release()
+    return None
+
+
+async def serve_forever(sock):
+    """
+    Accept and serve the connections of a bound socket on the event loop,
+    the TLS handshakes of HTTPS being done by the loop without blocking it
+    :type sock: socket.socket
+    :return: None
+    :rtype: None
+    """
+    options = {}
+    if tls_http.context is not None:
+        options = {'ssl': tls_http.context, 'ssl_handshake_timeout': config_srv.CONFIGURATION['TlsHandshakeTimeout']}
+    server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT,
+                                        backlog=socket.SOMAXCONN, **options)
+    async with server:
+        await server.serve_forever()
+
+
+def listen(sock):
+    """
+    Event loop equivalent of server_http.listen: a single thread
+    multiplexes every connection with the selector of the platform (epoll on Linux).
+    :type sock: socket.socket
+    :return: None
+    :rtype: None
+    """
+    try:
+        asyncio.run(serve_forever(sock))
+    except KeyboardInterrupt:
+        print("Socket stopped manually")
+    except OSError:
+        print("Socket listening error")
+    return
+
+
+def main():
+    # Test
+
+    async def test_pipelining():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT)
+        (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+        writer.write(b"GET / HTTP/1.1\r\n\r\nGET /nofile HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    # ----- client_processing()
+
+    response = asyncio.run(test_pipelining())
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert response.count(b"HTTP/1.1 ") == 2
+    assert b"HTTP/1.1 404 NOT FOUND\r\n" in response
+    assert response.endswith(client_http.gen_data_error(404))
+
+    # HEADER TOO LARGE
+    async def test_too_large():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT)
+        (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+        writer.write(b"GET / HTTP/1.1\r\nCookie: " + b"a" * config_srv.CONFIGURATION['MaxHeaderSize'])
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    assert asyncio.run(test_too_large()).startswith(b"HTTP/1.1 431 REQUEST HEADER FIELDS TOO LARGE\r\n")
+
+    # INDEX STREAMED WITH SENDFILE
+    config_srv.update({'SendfileThreshold': 64})
+    assert asyncio.run(test_pipelining()) == response
+    config_srv.update({'SendfileThreshold': 1024 * 1024})
+
+    # SECOND REQUEST BEYOND THE RATE LIMIT
+    config_srv.update({'RateLimit': 1, 'RateBurst': 1})
+    response = asyncio.run(test_pipelining())
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n") and b"HTTP/1.1 429 TOO MANY REQUESTS\r\n" in response
+    assert b"Retry-After: 1\r\n" in response
+    config_srv.update({'RateLimit': 0})
+
+    # SECOND CONNECTION BEYOND MaxConnectionsPerIP
+    async def test_connections():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT)
+        (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+        writer.write(b"GET / HTTP/1.1\r\n\r\n")
+        await reader.readuntil(b"\r\n\r\n")
+        (second_reader, second_writer) = await asyncio.open_connection(*sock.getsockname())
+        response = await second_reader.read()
+        second_writer.close()
+        # The first connection ends once the server sees it closed
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    config_srv.update({'MaxConnectionsPerIP': 1})
+    assert asyncio.run(test_connections()).startswith(b"HTTP/1.1 503 SERVICE UNAVAILABLE\r\n")
+    assert limit_http.connections == {}
+    config_srv.update({'MaxConnectionsPerIP': 0})
+    print("Test client_processing OK")
+
+    # ----- send_stream()
+
+    def slow(state):
+        # Source blocking between its chunks, read by a thread while the loop serves the other connections
+        for chunk in (b"ab", b"cd"):
+            time.sleep(0.2)
+            yield chunk
+        state['done'] = time.monotonic()
+
+    async def test_stream(state):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT)
+        (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+        writer.write(b"POST /log HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+        (other_reader, other_writer) = await asyncio.open_connection(*sock.getsockname())
+        other_writer.write(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+        await other_reader.read()
+        state['other'] = time.monotonic()
+        other_writer.close()
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    state = {}
+    client_http.METHODS["POST"] = lambda req, keep_alive: client_http.stream_response(req, slow(state), keep_alive)
+    response = asyncio.run(test_stream(state))
+    del client_http.METHODS["POST"]
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n") and b"Transfer-Encoding: chunked\r\n" in response
+    assert b"\r\n\r\n2\r\nab\r\n2\r\ncd\r\n0\r\n\r\nHTTP/1.1 200 OK\r\n" in response
+    assert state['other'] < state['done']
+
+    # SLOW HANDLER RUN BY A THREAD
+    def blocking(req, keep_alive):
+        time.sleep(0.3)
+        state['done'] = time.monotonic()
+        return client_http.get(req, keep_alive)
+
+    state = {}
+    client_http.METHODS["POST"] = blocking
+    response = asyncio.run(test_stream(state))
+    del client_http.METHODS["POST"]
+    assert response.count(b"HTTP/1.1 ") == 2
+    assert state['other'] < state['done']
+
+    # MAPPED FILE NOT JOINED TO THE HEADER
+    class Writer:
+        def __init__(self):
+            self.written = []
+
+        def write(self, data):
+            self.written.append(data)
+
+        async def drain(self):
+            pass
+
+    (writer, mapped) = (Writer(), memoryview(b"mapped"))
+    asyncio.run(send_response(writer, b"header", mapped))
+    assert writer.written == [b"header", mapped] and writer.written[1] is mapped
+    print("Test send_stream OK")
+
+    # ----- forward()
+
+    async def upstream(reader, writer):
+        # Stand-in upstream server: echoes the body of the requests, in chunks for /chunked
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                writer.close()
+                return
+            if b"Content-Length: " in head:
+                try:
+                    body = await reader.readexactly(int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0]))
+                except asyncio.IncompleteReadError:
+                    # Given up by the proxy, its client failing to send the body
+                    writer.close()
+                    return
+            else:
+                body = head.split(b" ")[1]
+            if head.startswith(b"GET /chunked"):
+                writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n")
+            else:
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+
+    async def test_proxy():
+        upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream_sock.bind(("127.0.0.1", 0))
+        upstream_server = await asyncio.start_server(upstream, sock=upstream_sock)
+        config_srv.update({'Upstreams': {"/": ["127.0.0.1:%d" % upstream_sock.getsockname()[1]]}})
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT)
+        (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+        writer.write(b"POST /echo HTTP/1.1\r\nContent-Length: 5\r\n\r\nhelloGET /chunked HTTP/1.1\r\n\r\n"
+                     b"GET /last HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        pooled = dict(proxy_http.stats)
+        # CHUNKS REMOVED FOR AN HTTP/1.0 CLIENT, THE CONNECTION CLOSED
+        (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+        writer.write(b"GET /chunked HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+        unchunked = await reader.read()
+        writer.close()
+        assert unchunked.endswith(b"\r\n\r\nabc") and b"Transfer-Encoding" not in unchunked
+        assert b"Connection: close\r\n" in unchunked
+        # CLIENT CLOSING OR TOO SLOW WHILE SENDING ITS BODY, THE SERVER NOT BLAMED
+        errors = proxy_http.stats['errors']
+        failures = []
+        for timeout in (5, 0.2):
+            config_srv.update({'KeepAliveTimeout': timeout})
+            (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+            writer.write(b"POST /echo HTTP/1.1\r\nContent-Length: 10\r\n\r\nhello")
+            if timeout == 5:
+                writer.write_eof()
+            failures.append((await reader.read())[:12])
+            writer.close()
+        assert failures == [b"HTTP/1.1 400", b"HTTP/1.1 408"] and proxy_http.stats['errors'] == errors
+        config_srv.update({'KeepAliveTimeout': 5})
+        server.close()
+        await server.wait_closed()
+        config_srv.update({'Upstreams': {}})
+        for backend in proxy_http.backends.values():
+            while backend.streams:
+                (upstream_reader, upstream_writer, watch) = backend.streams.pop()
+                watch.cancel()
+                upstream_writer.close()
+                await upstream_writer.wait_closed()
+        upstream_server.close()
+        await upstream_server.wait_closed()
+        return response, pooled
+
+    opened = proxy_http.stats['opened']
+    (response, pooled) = asyncio.run(test_proxy())
+    assert response.count(b"HTTP/1.1 200 OK\r\n") == 3 and response.endswith(b"\r\n\r\n/last")
+    assert b"\r\n\r\nhello" in response and b"\r\n\r\n3\r\nabc\r\n0\r\n\r\n" in response
+    # ONE UPSTREAM CONNECTION FOR THE THREE REQUESTS
+    assert pooled['opened'] == opened + 1 and pooled['reused'] >= 2
+    print("Test forward OK")
+
+    # ----- serve_h2()
+
+    async def test_h2():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT)
+        (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+        block = hpack_http.Encoder().encode([(":method", "GET"), (":scheme", "http"), (":path", "/"),
+                                             (":authority", "x")])
+        writer.write(h2_http.PREFACE + h2_http.frame(h2_http.SETTINGS, 0, 0) +
+                     h2_http.frame(h2_http.HEADERS, h2_http.END_STREAM | h2_http.END_HEADERS, 1, block))
+        frames = []
+        while not frames or frames[-1][0] != h2_http.DATA or not frames[-1][1] & h2_http.END_STREAM:
+            head = await reader.readexactly(9)
+            frames.append((head[3], head[4], await reader.readexactly(int.from_bytes(head[:3], "big"))))
+        writer.write(h2_http.frame(h2_http.GOAWAY, 0, 0, bytes(8)))
+        # The server answers GOAWAY and closes the connection
+        rest = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return (frames, rest)
+
+    (frames, rest) = asyncio.run(test_h2())
+    headers = [payload for (frame_type, flags, payload) in frames if frame_type == h2_http.HEADERS]
+    assert hpack_http.Decoder().decode(headers[0])[0] == (":status", "200")
+    with open(config_srv.CONFIGURATION['Path'] + "index.html", "rb") as file:
+        assert b"".join(payload for (frame_type, flags, payload) in frames if frame_type == h2_http.DATA) == \
+            file.read()
+    assert rest[3] == h2_http.GOAWAY
+
+    # SLOW BODY READ IN THE EXECUTOR, ANOTHER CONNECTION SERVED MEANWHILE
+
+    def slow():
+        for chunk in (b"abc", b"def"):
+            time.sleep(0.3)
+            yield chunk
+
+    async def test_h2_slow():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        server = await asyncio.start_server(client_processing, sock=sock, limit=READ_LIMIT)
+        finished = []
+
+        async def request(method, path):
+            (reader, writer) = await asyncio.open_connection(*sock.getsockname())
+            writer.write(h2_http.PREFACE + h2_http.frame(h2_http.SETTINGS, 0, 0) + h2_http.frame(
+                h2_http.HEADERS, h2_http.END_STREAM | h2_http.END_HEADERS, 1, hpack_http.Encoder().encode(
+                    [(":method", method), (":scheme", "http"), (":path", path), (":authority", "x")])))
+            body = b""
+            while True:
+                head = await reader.readexactly(9)
+                payload = await reader.readexactly(int.from_bytes(head[:3], "big"))
+                if head[3] == h2_http.DATA:
+                    body += payload
+                    if head[4] & h2_http.END_STREAM:
+                        break
+            finished.append(path)
+            writer.write(h2_http.frame(h2_http.GOAWAY, 0, 0, bytes(8)))
+            await reader.read()
+            writer.close()
+            return body
+
+        slow_body = asyncio.create_task(request("POST", "/slow"))
+        await asyncio.sleep(0.1)
+        await request("GET", "/index.html")
+        body = await slow_body
+        server.close()
+        await server.wait_closed()
+        return (finished, body)
+
+    client_http.METHODS["POST"] = lambda req, keep_alive: client_http.stream_response(req, slow(), False)
+    (finished, body) = asyncio.run(test_h2_slow())
+    del client_http.METHODS["POST"]
+    assert finished == ["/index.html", "/slow"] and body == b"abcdef"
+    print("Test serve_h2 OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+# Internal modules
+import client_http
+import config_srv
+
+# Request sent by a browser, as in client_http.main
+REQUEST = 'GET /test/py.png?v=2 HTTP/1.1\r\n' \
+          'Host: 127.0.0.1:8000\r\n' \
+          'Connection: keep-alive\r\n' \
+          'Cache-Control: max-age=0\r\n' \
+          'Upgrade-Insecure-Requests: 1\r\n' \
+          'DNT: 1\r\n' \
+          'User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) ' \
+          'Chrome/80.0.3987.132 Safari/537.36\r\n' \
+          'Sec-Fetch-Dest: document\r\n' \
+          'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,' \
+          'application/signed-exchange;v=b3;q=0.9\r\n' \
+          'Sec-Fetch-Site: cross-site\r\n' \
+          'Sec-Fetch-Mode: navigate\r\n' \
+          'Accept-Encoding: gzip, deflate, br\r\n' \
+          'Accept-Language: en-US,en;q=0.9,fr-FR;q=0.8,fr;q=0.7\r\n\r\n'
+
+
+def legacy_parse(request):
+    """
+    Parsing done for each request before client_http.parse_request:
+    verify_request, build_file_path on the re-split first line,
+    then one scan of the request for each header field looked up
+    :param request: request
+    :type request: str
+    :return: HTTP code, file path and header values
+    :rtype: tuple
+    """
+    code = 500
+    header = request.split("\n")
+    first_line = header[0].split(" ")
+    if len(first_line) == 3:
+        version = first_line[2].split("/")[1]
+        if first_line[0] == "GET" and first_line[2].split("/")[0] == "HTTP" and version in ("1.1\r", "1.0\r"):
+            for elt in header[1:]:
+                if re.match("^[A-Za-z- ]*[:].*", elt) or elt == "\r" or elt == "":
+                    code = 200
+                else:
+                    return 400, None, None
+        else:
+            return 405, None, None
+    else:
+        return 400, None, None
+    target = request.split("\r\n")[0].split(" ")[1]
+    path = urllib.parse.unquote(target).split("?")[0]
+    path = config_srv.CONFIGURATION['Path'][:-1] + path
+    values = []
+    for name in ("connection", "range", "if-none-match", "if-modified-since", "accept-encoding"):
+        value = None
+        for line in request.split("\r\n")[1:]:
+            (field, colon, field_value) = line.partition(":")
+            if colon and field.strip().lower() == name:
+                value = field_value.strip()
+                break
+        values.append(value)
+    return code, path, values
+
+
+def current_parse(request):
+    """
+    Parsing done for each request by client_http
+    :param request: request
+    :type request: str
+    :return: HTTP code, file path and header values
+    :rtype: tuple
+    """
+    (code, req) = client_http.parse_request(request)
+    path = client_http.target_path(req.target)
+    values = [req.headers.get(name)
+              for name in ("connection", "range", "if-none-match", "if-modified-since", "accept-encoding")]
+    return code, path, values
+
+
+def legacy_header(code_response, length=None, type_mime="text/html; charset=UTF-8", keep_alive=False, extra=None):
+    """
+    Header building done for each response before the templates of client_http.generate_header
+    :return: response header
+    :rtype: bytes
+    """
+    code = {
+        200: "200 OK",
+        404: "404 NOT FOUND",
+        500: "500 INTERNAL SERVER ERROR",
+    }
+    date = time.strftime("%a, %d %b %Y %H:%M:%S")
+    if code_response not in code:
+        code_response = 500
+    response_header = "HTTP/1.1 " + code[code_response] + "\r\n"
+    response_header += "Date: " + date + "\r\n"
+    response_header += "Server: Tobi\r\n"
+    if keep_alive:
+        response_header += "Connection: keep-alive\r\n"
+    else:
+        response_header += "Connection: close\r\n"
+    response_header += "Content-Type: " + type_mime + "\r\n"
+    if length is not None:
+        response_header += "Content-Length: " + str(length) + "\r\n"
+    if extra is not None:
+        for (name, value) in extra:
+            response_header += name + ": " + value + "\r\n"
+    response_header += "\r\n"
+    return response_header.encode('utf-8')
+
+
+def bench_header(generate, number=100000):
+    """
+    Measure how many response headers per second a function builds
+    :param generate: header building function
+    :type generate: function
+    :param number: number of headers built
+    :type number: int
+    :return: headers per second
+    :rtype: float
+    """
+    extra = [("Accept-Ranges", "bytes"), ("ETag", '"17a2b3c4d5e6f-c8"')]
+    start = time.perf_counter()
+    for i in range(number):
+        generate(200, 4096, "image/png;", True, extra)
+    return number / (time.perf_counter() - start)
+
+
+def bench_parser(parse, number=100000):
+    """
+    Measure how many requests per second a parsing function handles
+    :param parse: parsing function
+    :type parse: function
+    :param number: number of requests parsed
+    :type number: int
+    :return: requests per second
+    :rtype: float
+    """
+    start = time.perf_counter()
+    for i in range(number):
+        parse(REQUEST)
+    return number / (time.perf_counter() - start)
+
+
+# Load test scenarios: request sent, keep-alive, concurrent clients and idle connections held meanwhile
+SCENARIOS = {
+    'small': (b"GET /index.html HTTP/1.1\r\nHost: bench\r\n\r\n", True, 32, 0),
+    'large': (b"GET /large.bin HTTP/1.1\r\nHost: bench\r\n\r\n", True, 8, 0),
+    'not_found': (b"GET /missing.html HTTP/1.1\r\nHost: bench\r\n\r\n", True, 32, 0),
+    'malformed': (b"GET / HTTP/1.1\r\nHost bench\r\n\r\n", False, 32, 0),
+    'idle': (b"GET /index.html HTTP/1.1\r\nHost: bench\r\n\r\n", True, 8, 1000),
+}
+# Size of the large file, above the sendfile threshold
+LARGE_SIZE = 4 * 1024 * 1024
+# Seconds a response may take before being counted as an error
+RESPONSE_TIMEOUT = 10
+# Starts the server with the configuration given in JSON
+SERVER = "import json, sys; import config_srv, server_http; " \
+         "config_srv.override(json.loads(sys.argv.pop(1))); server_http.main()"
+
+
+class LoadResult:
+    """
+    Responses received by the clients of a scenario
+    """
+    __slots__ = ("latencies", "statuses", "errors")
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+
+def percentile(values, fraction):
+    """
+    Get a percentile of sorted values
+    :param values: sorted values
+    :type values: list
+    :param fraction: 0.5 for the median, 0.99 for the 99th percentile
+    :type fraction: float
+    :return: the value, None without values
+    :rtype: float or None
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def rss(pid):
+    """
+    Get the memory used by a process, from /proc on Linux
+    :param pid: process id
+    :type pid: int
+    :return: resident and peak resident memory in KiB, None for each if unknown
+    :rtype: tuple
+    """
+    values = {}
+    try:
+        with open("/proc/" + str(pid) + "/status") as file:
+            for line in file:
+                (name, _, value) = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    values[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+async def read_response(reader):
+    """
+    Read a response, its body being dropped as it comes
+    :type reader: asyncio.StreamReader
+    :return: status code and whether the server closes the connection
+    :rtype: tuple
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head[9:12])
+    (length, close) = (0, False)
+    for line in head.split(b"\r\n")[1:]:
+        (name, _, value) = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"connection":
+            close = value.strip().lower() == b"close"
+    while length > 0:
+        data = await reader.read(min(length, 256 * 1024))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", length)
+        length -= len(data)
+    return status, close
+
+
+async def load_client(address, request, keep_alive, deadline, result):
+    """
+    Send requests one after the other until deadline, on a single connection with keep-alive,
+    on a new connection for each request otherwise or when the server closes it
+    :param address: host and port of the server
+    :type address: tuple
+    :type request: bytes
+    :type keep_alive: bool
+    :param deadline: time.perf_counter() at which to stop
+    :type deadline: float
+    :type result: LoadResult
+    :return: None
+    :rtype: None
+    """
+    writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                (reader, writer) = await asyncio.wait_for(asyncio.open_connection(*address), RESPONSE_TIMEOUT)
+            begin = time.perf_counter()
+            writer.write(request)
+            (status, close) = await asyncio.wait_for(read_response(reader), RESPONSE_TIMEOUT)
+            result.latencies.append(time.perf_counter() - begin)
+            result.statuses[status] = result.statuses.get(status, 0) + 1
+            if close or not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            result.errors += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+    if writer is not None:
+        writer.close()
+    return None
+
+
+async def load(address, scenario, duration):
+    """
+    Run a load test scenario
+    :param address: host and port of the server
+    :type address: tuple
+    :param scenario: request, keep-alive, concurrent clients and idle connections, from SCENARIOS
+    :type scenario: tuple
+    :param duration: seconds of load
+    :type duration: float
+    :return: the responses received, the idle connections opened and the seconds the load lasted
+    :rtype: tuple
+    """
+    (request, keep_alive, concurrency, idle) = scenario
+    if not keep_alive:
+        request = request[:-2] + b"Connection: close\r\n\r\n"
+    idle_writers = []
+    for i in range(idle):
+        try:
+            idle_writers.append((await asyncio.wait_for(asyncio.open_connection(*address), 1))[1])
+        except (OSError, asyncio.TimeoutError):
+            break
+    result = LoadResult()
+    begin = time.perf_counter()
+    await asyncio.gather(*[load_client(address, request, keep_alive, begin + duration, result)
+                           for i in range(concurrency)])
+    seconds = time.perf_counter() - begin
+    for writer in idle_writers:
+        writer.close()
+    return result, len(idle_writers), seconds
+
+
+def start_server(overrides):
+    """
+    Start server_http in a new process, and wait for it to accept connections
+    :param overrides: configuration of the server, replacing the one of config_srv
+    :type overrides: dict
+    :return: the server process
+    :rtype: subprocess.Popen
+    """
+    server = subprocess.Popen([sys.executable, "-c", SERVER, json.dumps(overrides)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", overrides['Port']), 1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("The server did not start.")
+
+
+def free_port():
+    """
+    Find a TCP port nothing listens on
+    :return: port
+    :rtype: int
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_load(engine, duration, names):
+    """
+    Start the server on a copy of the document root with a large file added,
+    and run load test scenarios against it
+    :param engine: "thread" or "asyncio"
+    :type engine: str
+    :param duration: seconds of load of each scenario
+    :type duration: float
+    :param names: scenarios to run, from SCENARIOS
+    :type names: list
+    :return: results, JSON serializable
+    :rtype: dict
+    """
+    results = {'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"), 'python': platform.python_version(),
+               'engine': engine, 'duration': duration, 'scenarios': {}}
+    with tempfile.TemporaryDirectory() as root:
+        shutil.copytree(config_srv.CONFIGURATION['Path'], root, dirs_exist_ok=True)
+        with open(os.path.join(root, "large.bin"), "wb") as file:
+            file.write(os.urandom(LARGE_SIZE))
+        port = free_port()
+        server = start_server({'Port': port, 'Path': root + "/", 'Engine': engine, 'AccessLog': None})
+        try:
+            for name in names:
+                (result, idle, seconds) = asyncio.run(load(("127.0.0.1", port), SCENARIOS[name], duration))
+                latencies = sorted(result.latencies)
+                (memory, peak) = rss(server.pid)
+                results['scenarios'][name] = {
+                    'requests': len(latencies), 'errors': result.errors, 'idle_connections': idle,
+                    'statuses': {str(code): count for (code, count) in sorted(result.statuses.items())},
+                    'requests_per_second': round(len(latencies) / seconds, 1),
+                    'p50_ms': ms(percentile(latencies, 0.5)), 'p99_ms': ms(percentile(latencies, 0.99)),
+                    'p999_ms': ms(percentile(latencies, 0.999)), 'rss_kib': memory, 'peak_rss_kib': peak}
+        finally:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    return results
+
+
+def ms(seconds):
+    """
+    :param seconds: a latency
+    :type seconds: float or None
+    :return: the latency in milliseconds, rounded
+    :rtype: float or None
+    """
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def report(results, previous=None):
+    """
+    Display load test results, with their change from previous results of the same scenarios
+    :param results: results of run_load
+    :type results: dict
+    :param previous: results of an earlier run_load, to compare with
+    :type previous: dict or None
+    :return: None
+    :rtype: None
+    """
+    print("Load test, engine", results['engine'] + ",", results['duration'], "seconds per scenario")
+    for (name, result) in results['scenarios'].items():
+        line = "%-10s: %9.1f req/s  p50 %s ms  p99 %s ms  p99.9 %s ms  RSS %s KiB  errors %d" % (
+            name, result['requests_per_second'], result['p50_ms'], result['p99_ms'], result['p999_ms'],
+            result['rss_kib'], result['errors'])
+        before = (previous or {}).get('scenarios', {}).get(name)
+        if before and before['requests_per_second'] and before['p99_ms'] and result['p99_ms']:
+            line += "  (req/s %+.1f%%, p99 %+.1f%%)" % (
+                (result['requests_per_second'] / before['requests_per_second'] - 1) * 100,
+                (result['p99_ms'] / before['p99_ms'] - 1) * 100)
+        print(line)
+    return None
+
+
+def load_main(argv):
+    """
+    Command line of the load test: python bench_http.py load --help
+    :param argv: arguments after "load"
+    :type argv: list
+    :return: None
+    :rtype: None
+    """
+    parser = argparse.ArgumentParser(prog="bench_http.py load", description="Load test of server_http")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of load of each scenario")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="scenario to run, every one by default")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--compare", help="JSON file of earlier results to compare with")
+    args = parser.parse_args(argv)
+    results = run_load(args.engine, args.duration, args.scenario or list(SCENARIOS))
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    report(results, previous)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    return None
+
+
+def main():
+    if sys.argv[1:2] == ["load"]:
+        load_main(sys.argv[2:])
+        return
+
+    # Both parsings agree
+    assert legacy_parse(REQUEST) == current_parse(REQUEST)
+    assert percentile([1, 2, 3, 4], 0.5) == 3 and percentile([1, 2, 3, 4], 0.999) == 4 and percentile([], 0.5) is None
+
+    legacy = bench_parser(legacy_parse)
+    current = bench_parser(current_parse)
+    print("Request parsing, requests/s")
+    print("legacy  :", int(legacy))
+    print("current :", int(current), "(x" + format(current / legacy, ".1f") + ")")
+
+    legacy = bench_header(legacy_header)
+    current = bench_header(client_http.generate_header)
+    print("Header building, headers/s")
+    print("legacy  :", int(legacy))
+    print("current :", int(current), "(x" + format(current / legacy, ".1f") + ")")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import collections
+import os
+import threading
+# Internal modules
+import config_srv
+
+# path -> (mtime, size, data, type_mime), least recently used first
+entries = collections.OrderedDict()
+# Total size of the cached data
+cached_bytes = 0
+# (document root, request target) -> (expiry, path, status), least recently used first
+paths = collections.OrderedDict()
+stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'path_hits': 0, 'path_misses': 0}
+# directory -> (mtime, entries) of the directories listed, least recently used first
+listings = collections.OrderedDict()
+# path -> (mtime, size, data, type_mime, etag, last_modified, encodings) of the files preloaded,
+# never modified: a reload replaces the whole table
+preloaded = {}
+
+lock = threading.Lock()
+
+
+def lookup(path, st):
+    """
+    Get the cached content of a file if it didn't change since it was cached
+    :param path: full path of the file
+    :type path: str
+    :param st: current status of the file
+    :type st: os.stat_result
+    :return: data and type of the file, None if not cached or outdated
+    :rtype: tuple or None
+    """
+    with lock:
+        entry = entries.get(path)
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            stats['misses'] += 1
+            return None
+        entries.move_to_end(path)
+        stats['hits'] += 1
+    return entry[2], entry[3]
+
+
+def store(path, st, data, type_mime):
+    """
+    Cache the content of a file, evicting the least recently used files
+    until the cache fits in CacheMaxBytes and CacheMaxEntries.
+    Files bigger than CacheMaxFileSize are not cached.
+    :param path: full path of the file
+    :type path: str
+    :param st: status of the file when it was read
+    :type st: os.stat_result
+    :param data: content of the file
+    :type data: bytes
+    :param type_mime: type of the file, from client_http.data_type
+    :type type_mime: str or None
+    :return: None
+    :rtype: None
+    """
+    global cached_bytes
+    if len(data) > config_srv.CONFIGURATION['CacheMaxFileSize']:
+        return None
+    max_bytes = config_srv.CONFIGURATION['CacheMaxBytes']
+    max_entries = config_srv.CONFIGURATION['CacheMaxEntries']
+    with lock:
+        old = entries.pop(path, None)
+        if old is not None:
+            cached_bytes -= len(old[2])
+        entries[path] = (st.st_mtime_ns, st.st_size, data, type_mime)
+        cached_bytes += len(data)
+        while cached_bytes > max_bytes or len(entries) > max_entries:
+            (evicted_path, evicted) = entries.popitem(last=False)
+            cached_bytes -= len(evicted[2])
+            stats['evictions'] += 1
+    return None
+
+
+def lookup_path(key, now):
+    """
+    Get the cached resolution of a request target
+    :param key: document root and request target
+    :type key: tuple
+    :param now: current time.monotonic()
+    :type now: float
+    :return: path and status of the file, None if not cached or expired
+    :rtype: tuple or None
+    """
+    with lock:
+        entry = paths.get(key)
+        if entry is None or entry[0] <= now:
+            stats['path_misses'] += 1
+            return None
+        paths.move_to_end(key)
+        stats['path_hits'] += 1
+    return entry[1], entry[2]
+
+
+def store_path(key, path, st, expiry):
+    """
+    Cache the resolution of a request target until expiry,
+    evicting the least recently used ones beyond PathCacheEntries
+    :param key: document root and request target
+    :type key: tuple
+    :param path: full path of the file, None if refused
+    :type path: str or None
+    :param st: status of the file, None if missing
+    :type st: os.stat_result or None
+    :param expiry: time.monotonic() until which the resolution is valid
+    :type expiry: float
+    :return: None
+    :rtype: None
+    """
+    max_entries = config_srv.CONFIGURATION['PathCacheEntries']
+    with lock:
+        paths[key] = (expiry, path, st)
+        paths.move_to_end(key)
+        while len(paths) > max_entries:
+            paths.popitem(last=False)
+    return None
+
+
+def drop_path(key):
+    """
+    Forget the resolution of a request target, its file being found missing before the entry expires
+    :param key: document root and request target
+    :type key: tuple
+    :return: None
+    :rtype: None
+    """
+    with lock:
+        paths.pop(key, None)
+    return None
+
+
+def lookup_listing(directory, st):
+    """
+    Get the cached entries of a directory if no file was added, removed or renamed in it since
+    :param directory: full path of the directory
+    :type directory: str
+    :param st: current status of the directory
+    :type st: os.stat_result
+    :return: entries of the directory, None if not cached or outdated
+    :rtype: list or None
+    """
+    with lock:
+        entry = listings.get(directory)
+        if entry is None or entry[0] != st.st_mtime_ns:
+            return None
+        listings.move_to_end(directory)
+    return entry[1]
+
+
+def store_listing(directory, st, entries):
+    """
+    Cache the entries of a directory, evicting the least recently used ones beyond ListingCacheEntries
+    :param directory: full path of the directory
+    :type directory: str
+    :param st: status of the directory when it was scanned
+    :type st: os.stat_result
+    :param entries: entries of the directory, from client_http.scan_directory
+    :type entries: list
+    :return: None
+    :rtype: None
+    """
+    max_entries = config_srv.CONFIGURATION['ListingCacheEntries']
+    with lock:
+        listings[directory] = (st.st_mtime_ns, entries)
+        listings.move_to_end(directory)
+        while len(listings) > max_entries:
+            listings.popitem(last=False)
+    return None
+
+
+def lookup_preloaded(path, st):
+    """
+    Get a preloaded file if it didn't change since it was preloaded
+    :param path: full path of the file
+    :type path: str
+    :param st: current status of the file
+    :type st: os.stat_result
+    :return: data, type, ETag, Last-Modified and compressed encodings of the file,
+             None if not preloaded or outdated
+    :rtype: tuple or None
+    """
+    entry = preloaded.get(path)
+    if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+        return None
+    return entry[2:]
+
+
+def install_preloaded(table):
+    """
+    Replace the preloaded files, the responses being sent keep the data of the previous table
+    :param table: preloaded files, from client_http.preload
+    :type table: dict
+    :return: None
+    :rtype: None
+    """
+    global preloaded
+    preloaded = table
+    return None
+
+
+def clear():
+    """
+    Empty the cache
+    :return: None
+    :rtype: None
+    """
+    global cached_bytes
+    with lock:
+        entries.clear()
+        paths.clear()
+        listings.clear()
+        cached_bytes = 0
+    return None
+
+
+def main():
+    # Test
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = []
+        for name in ("a", "b", "c"):
+            files.append(os.path.join(directory, name))
+            with open(files[-1], "wb") as file:
+                file.write(name.encode() * 100)
+
+        # ----- lookup() / store()
+
+        st = os.stat(files[0])
+        assert lookup(files[0], st) is None
+        store(files[0], st, b"a" * 100, "text/plain;")
+        assert lookup(files[0], st) == (b"a" * 100, "text/plain;")
+        assert stats['hits'] == 1 and stats['misses'] == 1
+
+        # MODIFIED FILE IS NOT SERVED FROM THE CACHE
+        with open(files[0], "ab") as file:
+            file.write(b"a")
+        assert lookup(files[0], os.stat(files[0])) is None
+        print("Test lookup OK")
+
+        # ----- LRU eviction
+
+        config_srv.update({'CacheMaxBytes': 250})
+        clear()
+        for path in files:
+            store(path, os.stat(path), open(path, "rb").read(), None)
+        assert list(entries) == [files[1], files[2]]
+        assert cached_bytes == 200 and stats['evictions'] == 1
+        # b is used, so c is the least recently used
+        lookup(files[1], os.stat(files[1]))
+        store(files[0], os.stat(files[0]), open(files[0], "rb").read(), None)
+        assert list(entries) == [files[1], files[0]]
+        print("Test store OK")
+
+    # ----- lookup_path() / store_path()
+
+    config_srv.update({'PathCacheEntries': 2})
+    store_path(("/root/", "/a"), "/root/a", None, 10)
+    assert lookup_path(("/root/", "/a"), 5) == ("/root/a", None)
+    # EXPIRED
+    assert lookup_path(("/root/", "/a"), 10) is None
+    store_path(("/root/", "/b"), "/root/b", None, 10)
+    store_path(("/root/", "/c"), "/root/c", None, 10)
+    assert list(paths) == [("/root/", "/b"), ("/root/", "/c")]
+    drop_path(("/root/", "/b"))
+    drop_path(("/root/", "/b"))
+    assert list(paths) == [("/root/", "/c")]
+    print("Test lookup_path OK")
+
+    # ----- lookup_preloaded()
+
+    st = os.stat(__file__)
+    install_preloaded({__file__: (st.st_mtime_ns, st.st_size, b"data", "text/x-python;", '"1-4"', "", {})})
+    assert lookup_preloaded(__file__, st) == (b"data", "text/x-python;", '"1-4"', "", {})
+    assert lookup_preloaded(__file__, os.stat(config_srv.__file__)) is None
+    install_preloaded({})
+    assert lookup_preloaded(__file__, st) is None
+    print("Test lookup_preloaded OK")
+
+
+if __name__ == "__main__":
+    main()
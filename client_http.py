@@ -2,14 +2,130 @@
 # -*- coding: utf-8 -*-
 
 # System modules
+import email.utils
+import gzip
+import html
+import json
 import mimetypes
+import mmap
+import posixpath
 import re
 import socket
+import ssl
+import stat
 import time
 import urllib.parse
+import uuid
 import os.path
 # Internal modules
+import cache_http
 import config_srv
+import h2_http
+import limit_http
+import log_http
+import metrics_http
+import proxy_http
+import tls_http
+
+# Optional modules
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Status line of each response code
+STATUS_LINES = {code: ("HTTP/1.1 " + reason + "\r\n").encode('utf-8') for (code, reason) in (
+    (200, "200 OK"),
+    (206, "206 PARTIAL CONTENT"),
+    (301, "301 MOVED PERMANENTLY"),
+    (304, "304 NOT MODIFIED"),
+    (400, "400 BAD REQUEST"),
+    (403, "403 FORBIDDEN"),
+    (404, "404 NOT FOUND"),
+    (405, "405 METHOD NOT ALLOWED"),
+    (408, "408 REQUEST TIMEOUT"),
+    (416, "416 RANGE NOT SATISFIABLE"),
+    (429, "429 TOO MANY REQUESTS"),
+    (431, "431 REQUEST HEADER FIELDS TOO LARGE"),
+    (500, "500 INTERNAL SERVER ERROR"),
+    (502, "502 BAD GATEWAY"),
+    (503, "503 SERVICE UNAVAILABLE"),
+    (504, "504 GATEWAY TIMEOUT"),
+)}
+# Pre-encoded header fields by (type, keep-alive), at most MAX_TEMPLATES of them
+header_templates = {}
+MAX_TEMPLATES = 256
+# (second, Date field) of the last response
+date_field = (0, b"")
+# Header field line: name and value
+HEADER_LINE = re.compile("^([A-Za-z- ]*)[:](.*)")
+# Bytes asked to the socket at once
+RECV_SIZE = 4096
+# Above this number of ranges, the whole file is sent
+MAX_RANGES = 16
+# Bytes read at once from a file-like object streamed
+STREAM_CHUNK = 64 * 1024
+# Content encodings by order of preference, with the extension of their precompressed files
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# Types compressed on the fly, besides text/*
+COMPRESSIBLE_TYPES = {"application/javascript", "application/json", "application/xml", "image/svg+xml"}
+
+
+class FileRange:
+    """
+    Part of an open file sent to the client without reading it in memory
+    """
+    __slots__ = ("file", "offset", "count")
+
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+
+class BodyStream:
+    """
+    Part of a response produced while it is sent, never held in memory as a whole:
+    the chunks of an iterable (like a generator) or of a file-like object,
+    each one taken once the previous one is sent
+    """
+    __slots__ = ("source", "length", "chunked", "sent")
+
+    def __init__(self, source, length=None, chunked=False):
+        # Object with a read method, or iterator of bytes or str
+        self.source = source if hasattr(source, "read") else iter(source)
+        # Bytes announced in Content-Length, None when unknown
+        self.length = length
+        # Sent with Transfer-Encoding: chunked
+        self.chunked = chunked
+        # Bytes of the body sent, chunked encoding excluded
+        self.sent = 0
+
+    def read(self):
+        """
+        Take the next chunk of the body
+        :return: the bytes, empty when the body is over
+        :rtype: bytes
+        """
+        if hasattr(self.source, "read"):
+            chunk = self.source.read(STREAM_CHUNK)
+        else:
+            # An empty chunk would end the chunked body
+            chunk = next((chunk for chunk in self.source if chunk), b"")
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        return chunk
+
+    def close(self):
+        """
+        Close the source, a generator stopped before its end running its finally clauses
+        :return: None
+        :rtype: None
+        """
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            close()
+        return None
 
 
 def data_type(file=None):
@@ -38,29 +154,528 @@ def data_type(file=None):
         return None
 
 
-def data_reader(file_name):
+def data_reader(file_name, keep_alive=False, req=None, st=None, retry=True):
     """
-    Read data of a file from the directory.
+    Read data of a file from the directory, or from the content cache
+    if the file didn't change since it was last read.
+    The file is not read when the client already has it (304),
+    and only the parts asked in the Range header of the request are sent.
     :param file_name: Full directory of the file to read
     :type file_name: file
-    :return: header and data
+    :param keep_alive: keep the connection open after the response
+    :type keep_alive: bool
+    :param req: request, for its conditional and Range fields
+    :type req: Request or None
+    :param st: status of the file when already known, from resolve_target
+    :type st: os.stat_result or None
+    :param retry: answer again once from the file opened when it changed since st,
+                  a file changing all the time is answered 503
+    :type retry: bool
+    :return: header and data, a list of bytes and FileRange for the files streamed
     :rtype: tuple
     """
+    if st is None:
+        try:
+            st = os.stat(file_name)
+        except (OSError, ValueError):
+            # ValueError for a null byte in the path
+            st = None
     # If directory and file exists, open it, and send data
-    if os.path.isfile(file_name):
+    if st is not None and stat.S_ISREG(st.st_mode):
+        preloaded = cache_http.lookup_preloaded(file_name, st)
+        type_mime = data_type(file_name) if preloaded is None else preloaded[1]
+        fields = []
+        (encoding, sibling, sibling_st) = (None, None, None)
+        if compressible(type_mime):
+            fields.append(("Vary", "Accept-Encoding"))
+            # Ranges are served from the file itself
+            if req is not None and "range" not in req.headers:
+                (encoding, sibling, sibling_st) = choose_encoding(file_name, st, req)
+        (etag, last_modified) = validators(st) if preloaded is None else preloaded[2:4]
+        if encoding is not None:
+            # Each encoding of the file is a different representation
+            etag = etag[:-1] + "-" + encoding + '"'
+        fields += [("ETag", etag), ("Last-Modified", last_modified)]
+        seconds = max_age(file_name)
+        if seconds is not None:
+            fields.append(("Cache-Control", "max-age=" + str(seconds)))
+        if req is not None and not_modified(req, etag, st):
+            header = generate_header(304, None, type_mime, keep_alive, fields)
+            return header, b""
+        if req is not None and req.method == "HEAD":
+            # The header of a GET without its Range: the status of the file is enough,
+            # the length of a compression not done yet is not sent
+            if encoding is None:
+                header = generate_header(200, st.st_size, type_mime, keep_alive, [("Accept-Ranges", "bytes")] + fields)
+            else:
+                length = sibling_st.st_size if sibling is not None else compressed_length(file_name, st, encoding)
+                header = generate_header(200, length, type_mime, keep_alive, fields + [("Content-Encoding", encoding)])
+            return header, b""
         try:
-            with open(file_name, "rb") as file:
-                data = file.read()
-                header = generate_header(200, len(data), data_type(file_name))
+            if sibling is not None:
+                data = load(sibling, sibling_st, type_mime)[0]
+            else:
+                (data, opened_st) = load(file_name, st, type_mime)
+                if (opened_st.st_mtime_ns, opened_st.st_size) != (st.st_mtime_ns, st.st_size):
+                    # The file changed since its status was cached by resolve_target:
+                    # validators, ranges and length of the response must all be the ones of the file opened
+                    close_body(data)
+                    if retry:
+                        return data_reader(file_name, keep_alive, req, opened_st, False)
+                    data = gen_data_error(503)
+                    header = generate_header(503, len(data), data_type(None), keep_alive, [("Retry-After", "1")])
+                    return header, data
+                if encoding is not None:
+                    data = compress(file_name, st, data, type_mime, encoding)
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed since its status was cached by resolve_target
+            if req is not None:
+                cache_http.drop_path(path_key(req.target))
+            data = gen_data_error(404)
+            header = generate_header(404, len(data), data_type(None), keep_alive)
+            return header, data
         except IOError:
             data = gen_data_error(500)
-            header = generate_header(500, len(data), data_type(None))
+            header = generate_header(500, len(data), data_type(None), keep_alive)
+            return header, data
+        if encoding is not None:
+            header = generate_header(200, body_length(data), type_mime, keep_alive,
+                                     fields + [("Content-Encoding", encoding)])
+            return header, data
+        ranges = requested_ranges(req, st, etag, last_modified) if req is not None else None
+        fields.insert(0, ("Accept-Ranges", "bytes"))
+        if ranges is None:
+            header = generate_header(200, body_length(data), type_mime, keep_alive, fields)
+        elif not ranges:
+            if isinstance(data, list):
+                data[0].file.close()
+            data = gen_data_error(416)
+            header = generate_header(416, len(data), data_type(None), keep_alive,
+                                     [("Content-Range", "bytes */" + str(st.st_size))])
+        elif len(ranges) == 1:
+            (start, end) = ranges[0]
+            content_range = "bytes " + str(start) + "-" + str(end) + "/" + str(st.st_size)
+            data = body_part(data, start, end)
+            header = generate_header(206, end - start + 1, type_mime, keep_alive,
+                                     fields + [("Content-Range", content_range)])
+        else:
+            (header, data) = multipart_ranges(data, ranges, st.st_size, type_mime, keep_alive, fields)
     else:
         data = gen_data_error(404)
-        header = generate_header(404, len(data), data_type(None))
+        header = generate_header(404, len(data), data_type(None), keep_alive)
     return header, data
 
 
+def load(path, st, type_mime):
+    """
+    Get the content of a file: preloaded or from the content cache if it didn't change,
+    in a FileRange if it is big enough to be streamed, read from the disk otherwise.
+    The status given may be older than the file, cached by resolve_target:
+    the one of the file opened is returned with its content.
+    :param path: full path of the file
+    :type path: str
+    :param st: status of the file
+    :type st: os.stat_result
+    :param type_mime: type of the file, kept in the cache
+    :type type_mime: str or None
+    :return: data, a memoryview for the files mapped, a list with a FileRange for the files streamed,
+             and the status of the file read
+    :rtype: tuple
+    :raise: IOError
+    """
+    preloaded = cache_http.lookup_preloaded(path, st)
+    if preloaded is not None:
+        return preloaded[0], st
+    cached = None
+    if st.st_size < config_srv.CONFIGURATION['SendfileThreshold']:
+        cached = cache_http.lookup(path, st)
+    if cached is not None:
+        return cached[0], st
+    file = open(path, "rb")
+    st = os.fstat(file.fileno())
+    if st.st_size >= config_srv.CONFIGURATION['SendfileThreshold']:
+        # Closed once sent
+        return [FileRange(file, 0, st.st_size)], st
+    with file:
+        data = file.read()
+        if len(data) != st.st_size:
+            # Written while read
+            return data, os.fstat(file.fileno())
+    cache_http.store(path, st, data, type_mime)
+    return data, st
+
+
+def compressible(type_mime):
+    """
+    Tells if a type of file is worth compressing,
+    images like jpg or png and pdf are already compressed
+    :param type_mime: type of the file, from data_type
+    :type type_mime: str or None
+    :return: True for text types
+    :rtype: bool
+    """
+    if type_mime is None:
+        return False
+    type_subtype = type_mime.split(";", 1)[0]
+    return type_subtype.startswith("text/") or type_subtype in COMPRESSIBLE_TYPES
+
+
+def accepted_encodings(req):
+    """
+    Get the content encodings accepted by the client
+    :param req: request
+    :type req: Request
+    :return: encodings with a non zero quality
+    :rtype: set
+    """
+    value = req.headers.get("accept-encoding")
+    accepted = set()
+    if value is None:
+        return accepted
+    for item in value.split(","):
+        (name, _, params) = item.partition(";")
+        quality = 1.0
+        (param, equal, q) = params.partition("=")
+        if equal and param.strip().lower() == "q":
+            try:
+                quality = float(q)
+            except ValueError:
+                quality = 0.0
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    if "*" in accepted:
+        accepted.update(ENCODINGS)
+    return accepted
+
+
+def choose_encoding(file_name, st, req):
+    """
+    Choose the content encoding of the response, preferring in order:
+    a precompressed sibling (file.br, file.gz) at least as recent as the file,
+    then an on-the-fly compression of the files small enough to be read in memory
+    :param file_name: Full directory of the file
+    :type file_name: str
+    :param st: status of the file
+    :type st: os.stat_result
+    :param req: request
+    :type req: Request
+    :return: encoding, path and status of the precompressed file, or None for each
+    :rtype: tuple
+    """
+    accepted = accepted_encodings(req)
+    if not accepted or not config_srv.CONFIGURATION['Compression']:
+        return None, None, None
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            sibling = file_name + ENCODINGS[encoding]
+            try:
+                sibling_st = os.stat(sibling)
+            except OSError:
+                continue
+            if stat.S_ISREG(sibling_st.st_mode) and sibling_st.st_mtime >= st.st_mtime:
+                return encoding, sibling, sibling_st
+    if config_srv.CONFIGURATION['CompressMinSize'] <= st.st_size < config_srv.CONFIGURATION['SendfileThreshold']:
+        for encoding in ENCODINGS:
+            if encoding in accepted and (encoding != "br" or brotli is not None):
+                return encoding, None, None
+    return None, None, None
+
+
+def compress(path, st, data, type_mime, encoding):
+    """
+    Compress the content of a file, the result is kept in the content cache
+    until the file changes
+    :param path: full path of the file
+    :type path: str
+    :param st: status of the file
+    :type st: os.stat_result
+    :param data: content of the file
+    :type data: bytes
+    :param type_mime: type of the file
+    :type type_mime: str or None
+    :param encoding: "br" or "gzip"
+    :type encoding: str
+    :return: compressed content
+    :rtype: bytes
+    """
+    preloaded = cache_http.lookup_preloaded(path, st)
+    if preloaded is not None and encoding in preloaded[4]:
+        return preloaded[4][encoding]
+    key = (path, encoding)
+    cached = cache_http.lookup(key, st)
+    if cached is not None:
+        return cached[0]
+    compressed = encode(data, encoding)
+    cache_http.store(key, st, compressed, type_mime)
+    return compressed
+
+
+def compressed_length(path, st, encoding):
+    """
+    Get the length of a compressed file, if it was already compressed
+    :param path: full path of the file
+    :type path: str
+    :param st: status of the file
+    :type st: os.stat_result
+    :param encoding: "br" or "gzip"
+    :type encoding: str
+    :return: length, None if not compressed yet
+    :rtype: int or None
+    """
+    preloaded = cache_http.lookup_preloaded(path, st)
+    if preloaded is not None and encoding in preloaded[4]:
+        return len(preloaded[4][encoding])
+    cached = cache_http.lookup((path, encoding), st)
+    return len(cached[0]) if cached is not None else None
+
+
+def encode(data, encoding):
+    """
+    Compress data with a content encoding
+    :param data: content of a file
+    :type data: bytes or memoryview
+    :param encoding: "br" or "gzip"
+    :type encoding: str
+    :return: compressed content
+    :rtype: bytes
+    """
+    if encoding == "br":
+        return brotli.compress(bytes(data))
+    return gzip.compress(data, config_srv.CONFIGURATION['GzipLevel'], mtime=0)
+
+
+def preload(root):
+    """
+    Read the files of the document root for cache_http.install_preloaded,
+    with their type, validators and compressed encodings:
+    the files smaller than PreloadMaxFileSize in memory, as long as they fit in PreloadMaxBytes,
+    the bigger ones mapped with mmap, except the ones streamed with sendfile
+    :param root: document root
+    :type root: str
+    :return: table of the preloaded files, bytes held in memory and bytes mapped
+    :rtype: tuple
+    """
+    table = {}
+    (in_memory, mapped) = (0, 0)
+    real_root = os.path.join(os.path.realpath(root), "")
+    for (directory, _, files) in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+                if (not stat.S_ISREG(st.st_mode) or st.st_size >= config_srv.CONFIGURATION['SendfileThreshold']
+                        or not os.path.realpath(path).startswith(real_root)):
+                    continue
+                if st.st_size < config_srv.CONFIGURATION['PreloadMaxFileSize'] or st.st_size == 0:
+                    if in_memory + st.st_size > config_srv.CONFIGURATION['PreloadMaxBytes']:
+                        continue
+                    with open(path, "rb") as file:
+                        data = file.read()
+                    in_memory += len(data)
+                else:
+                    with open(path, "rb") as file:
+                        data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+                    mapped += len(data)
+            except OSError:
+                continue
+            type_mime = data_type(path)
+            encodings = {}
+            # Files precompressed (file.gz) are served as they are
+            if (compressible(type_mime) and config_srv.CONFIGURATION['Compression']
+                    and st.st_size >= config_srv.CONFIGURATION['CompressMinSize']
+                    and not path.endswith(tuple(ENCODINGS.values()))):
+                for encoding in ENCODINGS:
+                    if encoding != "br" or brotli is not None:
+                        encodings[encoding] = encode(data, encoding)
+                        in_memory += len(encodings[encoding])
+            table[path] = (st.st_mtime_ns, st.st_size, data, type_mime) + validators(st) + (encodings,)
+    return table, in_memory, mapped
+
+
+def validators(st):
+    """
+    Compute the validators of a file, which change when the file is modified
+    :param st: status of the file
+    :type st: os.stat_result
+    :return: ETag and Last-Modified values
+    :rtype: tuple
+    """
+    etag = '"' + format(st.st_mtime_ns, "x") + "-" + format(st.st_size, "x") + '"'
+    last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+    return etag, last_modified
+
+
+def not_modified(req, etag, st):
+    """
+    Tells if the version of the file the client has is still the current one,
+    from the If-None-Match field, or If-Modified-Since without If-None-Match
+    :param req: request
+    :type req: Request
+    :param etag: current ETag of the file
+    :type etag: str
+    :param st: status of the file
+    :type st: os.stat_result
+    :return: True if a 304 response is enough
+    :rtype: bool
+    """
+    if_none_match = req.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match == "*":
+            return True
+        # Weak comparison
+        return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if_modified_since = req.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            date = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(st.st_mtime) <= date.timestamp()
+    return False
+
+
+def max_age(file_name):
+    """
+    Find how long clients may keep a file without asking for it again,
+    from the MaxAge rules: the longest directory rule ("/test/") matching the file,
+    otherwise the rule of its extension (".png"), otherwise DefaultMaxAge
+    :param file_name: Full directory of the file
+    :type file_name: str
+    :return: max-age in seconds, None for no Cache-Control field
+    :rtype: int or None
+    """
+    rules = config_srv.CONFIGURATION['MaxAge']
+    relative = file_name[len(config_srv.CONFIGURATION['Path']) - 1:]
+    best = None
+    for rule in rules:
+        if rule.endswith("/") and relative.startswith(rule) and (best is None or len(rule) > len(best)):
+            best = rule
+    if best is not None:
+        return rules[best]
+    return rules.get(os.path.splitext(file_name)[1].lower(), config_srv.CONFIGURATION['DefaultMaxAge'])
+
+
+def parse_range(value, size):
+    """
+    Parse the value of a Range header field for a file
+    :param value: value of the field, like "bytes=0-99,-50"
+    :type value: str
+    :param size: size of the file
+    :type size: int
+    :return: (first byte, last byte) of each satisfiable range,
+             None if the field is invalid and must be ignored
+    :rtype: list or None
+    """
+    (unit, equal, ranges_spec) = value.partition("=")
+    if not equal or unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in ranges_spec.split(","):
+        (first, dash, last) = spec.strip().partition("-")
+        if not dash:
+            return None
+        if first == "" and last.isdigit():
+            # Suffix range: the last bytes of the file
+            if int(last) == 0:
+                continue
+            start = max(0, size - int(last))
+            end = size - 1
+        elif first.isdigit() and (last == "" or last.isdigit()):
+            start = int(first)
+            end = int(last) if last != "" else size - 1
+            if last != "" and end < start:
+                return None
+            end = min(end, size - 1)
+        else:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def requested_ranges(req, st, etag, last_modified):
+    """
+    Get the ranges of the file asked by the request
+    :param req: request
+    :type req: Request
+    :param st: status of the file
+    :type st: os.stat_result
+    :param etag: current ETag of the file
+    :type etag: str
+    :param last_modified: current Last-Modified date of the file
+    :type last_modified: str
+    :return: ranges to send, None to send the whole file, empty if not satisfiable
+    :rtype: list or None
+    """
+    value = req.headers.get("range")
+    if value is None:
+        return None
+    if_range = req.headers.get("if-range")
+    if if_range is not None and if_range != etag and if_range != last_modified:
+        # The client has an other version of the file
+        return None
+    return parse_range(value, st.st_size)
+
+
+def body_part(data, start, end):
+    """
+    Select bytes of a response body
+    :param data: whole file, in memory, mapped or streamed
+    :type data: bytes or memoryview or list
+    :param start: first byte
+    :type start: int
+    :param end: last byte
+    :type end: int
+    :return: the selected bytes, or the FileRange to stream them
+    :rtype: bytes or memoryview or list
+    """
+    if not isinstance(data, list):
+        return data[start:end + 1]
+    return [FileRange(data[0].file, start, end - start + 1)]
+
+
+def multipart_ranges(data, ranges, size, type_mime, keep_alive=False, fields=None):
+    """
+    Build a multipart/byteranges response with several parts of a file
+    :param data: whole file, in memory, mapped or streamed
+    :type data: bytes or memoryview or list
+    :param ranges: (first byte, last byte) of each part
+    :type ranges: list
+    :param size: size of the file
+    :type size: int
+    :param type_mime: type of the file
+    :type type_mime: str or None
+    :param keep_alive: keep the connection open after the response
+    :type keep_alive: bool
+    :param fields: other header fields, (name, value) pairs
+    :type fields: list or None
+    :return: header and data
+    :rtype: tuple
+    """
+    if type_mime is None:
+        type_mime = "application/octet-stream"
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for (start, end) in ranges:
+        part_header = ("\r\n--" + boundary + "\r\n"
+                       "Content-Type: " + type_mime + "\r\n"
+                       "Content-Range: bytes " + str(start) + "-" + str(end) + "/" + str(size) + "\r\n\r\n")
+        part_header = part_header.encode('utf-8')
+        part = body_part(data, start, end)
+        parts.append(part_header)
+        parts.extend(part if isinstance(part, list) else [part])
+        length += len(part_header) + end - start + 1
+    parts.append(("\r\n--" + boundary + "--\r\n").encode('utf-8'))
+    length += len(parts[-1])
+    if not isinstance(data, list):
+        parts = b"".join(parts)
+    header = generate_header(206, length, "multipart/byteranges; boundary=" + boundary, keep_alive, fields)
+    return header, parts
+
+
 def build_file_path(first_line):
     """
     Build the file directory from first line of HTTP header
@@ -72,23 +687,33 @@ def build_file_path(first_line):
     # GET /index.html HTTP/1.1 -> /index.html
     file_path_on_first_line = first_line.split(" ")[1]
 
+    # == no/blank directory --> index.html
+    if 'HTTP' in file_path_on_first_line:
+        return config_srv.CONFIGURATION['Path'] + 'index.html'
+    return target_path(file_path_on_first_line)
+
+
+def target_path(target):
+    """
+    Build the file directory from the target of a request
+    :param target: the target from the request line, like /index.html
+    :type target: str
+    :return: final_path to a file, or index.html by default if not specified
+    :rtype: str
+    """
     # Make /index.html default directory
     default_file = 'index.html'
     default = config_srv.CONFIGURATION['Path'] + default_file
 
-    # == no/blank directory --> index.html
-    if 'HTTP' in file_path_on_first_line:
-        return default
-
     # Cleaning path
-    file_path_on_first_line_cleaned = urllib.parse.unquote(file_path_on_first_line)
+    file_path_on_first_line_cleaned = urllib.parse.unquote(target)
 
     # If path include question mark, don't take the following
     if "?" in file_path_on_first_line_cleaned:
         file_path_on_first_line_cleaned = file_path_on_first_line_cleaned.split("?")[0]
 
     # If no file specified, open default
-    if file_path_on_first_line.endswith("/"):
+    if file_path_on_first_line_cleaned.endswith("/"):
         final_path = config_srv.CONFIGURATION['Path'][:-1] + file_path_on_first_line_cleaned + default_file
     else:
         try:
@@ -98,6 +723,198 @@ def build_file_path(first_line):
     return final_path
 
 
+def path_key(target):
+    """
+    :param target: the target from the request line, like /index.html
+    :type target: str
+    :return: key of its resolution in the path cache, for the current document root
+    :rtype: tuple
+    """
+    return config_srv.CONFIGURATION['Path'], target
+
+
+def resolve_target(target):
+    """
+    Find the file asked by the target of a request, with its status.
+    Files outside the document root, through ".." or a symbolic link, are refused.
+    The result is cached by target for PathCacheTTL seconds,
+    and dropped when the document root changes.
+    :param target: the target from the request line, like /index.html
+    :type target: str
+    :return: full path of the file, None if refused, and its status, None if missing
+    :rtype: tuple
+    """
+    root = config_srv.CONFIGURATION['Path']
+    key = path_key(target)
+    now = time.monotonic()
+    cached = cache_http.lookup_path(key, now)
+    if cached is not None:
+        return cached
+    path = target_path(target)
+    real_root = os.path.realpath(root)
+    try:
+        real_path = os.path.realpath(path)
+    except ValueError:
+        # Null byte in the target: no such file
+        real_path = real_root
+    if real_path != real_root and not real_path.startswith(os.path.join(real_root, "")):
+        (path, st) = (None, None)
+    else:
+        try:
+            st = os.stat(path)
+        except (OSError, ValueError):
+            st = None
+    cache_http.store_path(key, path, st, now + config_srv.CONFIGURATION['PathCacheTTL'])
+    return path, st
+
+
+def scan_directory(directory, st):
+    """
+    List the entries of a directory, the directories first, then by name.
+    Only the names and types are read, from the directory itself: the entries of
+    the page shown are stat'ed when it is rendered.
+    The entries are cached until a file is added, removed or renamed in the directory.
+    :param directory: full path of the directory
+    :type directory: str
+    :param st: status of the directory
+    :type st: os.stat_result
+    :return: (name, is a directory) of each entry
+    :rtype: list
+    :raise: OSError
+    """
+    entries = cache_http.lookup_listing(directory, st)
+    if entries is not None:
+        return entries
+    entries = []
+    with os.scandir(directory) as iterator:
+        for entry in iterator:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                # Removed meanwhile
+                continue
+            entries.append((entry.name, is_dir))
+    entries.sort(key=lambda entry: (not entry[1], entry[0]))
+    cache_http.store_listing(directory, st, entries)
+    return entries
+
+
+def stat_entries(directory, entries):
+    """
+    Get the size and modification time of the entries of a page of a listing
+    :param directory: full path of the directory
+    :type directory: str
+    :param entries: (name, is a directory) of the entries, from scan_directory
+    :type entries: list
+    :return: (name, is a directory, size, modification time) of each entry still there
+    :rtype: list
+    """
+    shown = []
+    for (name, is_dir) in entries:
+        try:
+            entry_st = os.stat(os.path.join(directory, name))
+        except OSError:
+            # Removed since the scan, or broken symbolic link
+            continue
+        shown.append((name, is_dir, entry_st.st_size, entry_st.st_mtime))
+    return shown
+
+
+def render_listing(url_path, shown, page, pages, total, as_json):
+    """
+    Render a page of the listing of a directory
+    :param url_path: path of the directory in the URLs, like /test/
+    :type url_path: str
+    :param shown: entries of the page, from stat_entries
+    :type shown: list
+    :param page: page rendered, from 1
+    :type page: int
+    :param pages: number of pages
+    :type pages: int
+    :param total: number of entries in the directory
+    :type total: int
+    :param as_json: render JSON instead of HTML
+    :type as_json: bool
+    :return: the page
+    :rtype: bytes
+    """
+    if as_json:
+        return json.dumps({"path": url_path, "page": page, "pages": pages, "total": total,
+                           "entries": [{"name": name, "type": "directory" if is_dir else "file",
+                                        "size": None if is_dir else size, "mtime": int(mtime)}
+                                       for (name, is_dir, size, mtime) in shown]}).encode('utf-8')
+    title = html.escape("Index of " + url_path)
+    rows = []
+    if url_path != "/":
+        parent = posixpath.dirname(url_path.rstrip("/")).rstrip("/") + "/"
+        rows.append('<tr><td><a href="' + html.escape(urllib.parse.quote(parent)) + '">../</a></td></tr>')
+    for (name, is_dir, size, mtime) in shown:
+        if is_dir:
+            name += "/"
+        rows.append('<tr><td><a href="' + html.escape(urllib.parse.quote(url_path + name)) + '">' + html.escape(name)
+                    + "</a></td><td>" + email.utils.formatdate(mtime, usegmt=True) + "</td><td>"
+                    + ("-" if is_dir else str(size)) + "</td></tr>")
+    navigation = []
+    if page > 1:
+        navigation.append('<a href="?page=' + str(page - 1) + '">Previous</a>')
+    navigation.append("Page " + str(page) + " of " + str(pages))
+    if page < pages:
+        navigation.append('<a href="?page=' + str(page + 1) + '">Next</a>')
+    return ('<html><head><meta charset="utf-8"><title>' + title + "</title></head><body><h1>" + title + "</h1>"
+            "<table><tr><th>Name</th><th>Last modified</th><th>Size</th></tr>" + "".join(rows) + "</table><p>"
+            + " - ".join(navigation) + "</p></body></html>").encode('utf-8')
+
+
+def directory_listing(path, req, keep_alive=False):
+    """
+    Answer the listing of a directory without index.html, in HTML,
+    or in JSON for ?format=json or a client accepting application/json.
+    The ?page parameter selects the page, the rendered pages are kept in the content cache.
+    :param path: full path of the directory, or of the index.html missing in it
+    :type path: str
+    :param req: request
+    :type req: Request
+    :param keep_alive: keep the connection open after the response
+    :type keep_alive: bool
+    :return: header and data
+    :rtype: tuple
+    """
+    directory = path[:-len("index.html")] if path.endswith("/index.html") else os.path.join(path, "")
+    (url_path, _, query) = req.target.partition("?")
+    url_path = urllib.parse.unquote(url_path)
+    if not url_path.endswith("/"):
+        url_path += "/"
+    params = urllib.parse.parse_qs(query)
+    as_json = params.get("format") == ["json"] or req.headers.get("accept", "").startswith("application/json")
+    try:
+        page = int(params.get("page", ["1"])[0])
+    except ValueError:
+        page = 0
+    page_size = config_srv.CONFIGURATION['AutoIndexPageSize']
+    type_mime = "application/json" if as_json else "text/html; charset=utf-8"
+    key = ("listing", directory, page, page_size, as_json)
+    try:
+        st = os.stat(directory)
+        # A page already rendered spares the scan of the directory
+        cached = cache_http.lookup(key, st)
+        entries = scan_directory(directory, st) if cached is None else None
+    except (OSError, ValueError):
+        # ValueError for a null byte in the path
+        (cached, entries) = (None, None)
+    if cached is not None:
+        data = cached[0]
+    else:
+        pages = max(1, -(-len(entries) // page_size)) if entries is not None else 0
+        if not 1 <= page <= pages:
+            data = gen_data_error(404)
+            return generate_header(404, len(data), data_type(None), keep_alive), data
+        shown = stat_entries(directory, entries[(page - 1) * page_size:page * page_size])
+        data = render_listing(url_path, shown, page, pages, len(entries), as_json)
+        cache_http.store(key, st, data, type_mime)
+    fields = [("Vary", "Accept"), ("Last-Modified", email.utils.formatdate(st.st_mtime, usegmt=True))]
+    return generate_header(200, len(data), type_mime, keep_alive, fields), data
+
+
 def gen_data_error(code):
     """
     :param code: HTTP error code or OK code
@@ -110,63 +927,156 @@ def gen_data_error(code):
     error = {
         400: b"<html><body><center><h1>Error 400: Bad request error</h1></center><p>Head back to <a href=\"/\">home "
              b"page</a>.</p></body></html>",
+        403: b"<html><body><center><h1>Error 403: Forbidden</h1></center><p>Head back to <a href=\"/\">home "
+             b"page</a>.</p></body></html>",
         404: b"<html><body><center><h1>Error 404: Not found</h1></center><p>Head back to <a href=\"/\">home "
              b"page</a>.</p></body></html>",
         405: b"<html><body><center><h1>Error 405: Method not allowed</h1></center><p>Head back to <a href=\"/\">home "
              b"page</a>.</p></body></html>",
+        408: b"<html><body><center><h1>Error 408: Request timeout</h1></center><p>Head back to <a "
+             b"href=\"/\">home page</a>.</p></body></html>",
+        416: b"<html><body><center><h1>Error 416: Range not satisfiable</h1></center><p>Head back to <a "
+             b"href=\"/\">home page</a>.</p></body></html>",
+        429: b"<html><body><center><h1>Error 429: Too many requests</h1></center><p>Please retry in a few "
+             b"seconds.</p></body></html>",
+        431: b"<html><body><center><h1>Error 431: Request header fields too large</h1></center><p>Head back to "
+             b"<a href=\"/\">home page</a>.</p></body></html>",
         500: b"<html><body><center><h1>Error 500: Internal server error</h1></center><p>Head back to <a "
              b"href=\"/\">home page</a>.</p></body></html>",
+        502: b"<html><body><center><h1>Error 502: Bad gateway</h1></center><p>Please retry in a few "
+             b"seconds.</p></body></html>",
+        503: b"<html><body><center><h1>Error 503: Service unavailable</h1></center><p>Please retry in a few "
+             b"seconds.</p></body></html>",
+        504: b"<html><body><center><h1>Error 504: Gateway timeout</h1></center><p>Please retry in a few "
+             b"seconds.</p></body></html>",
     }
     if code not in error:
         code = 500
     return error[code]
 
 
-def generate_header(code_response, length=None, type_mime="text/html; charset=UTF-8"):
+def http_date():
+    """
+    Date field of the responses, in the RFC 7231 format,
+    computed at most once per second and shared by every thread
+    :return: Date field line
+    :rtype: bytes
+    """
+    global date_field
+    now = int(time.time())
+    (second, field) = date_field
+    if second != now:
+        field = ("Date: " + email.utils.formatdate(now, usegmt=True) + "\r\n").encode('utf-8')
+        date_field = (now, field)
+    return field
+
+
+def header_template(type_mime, keep_alive):
+    """
+    Pre-encoded fields following the Date in every response of a type
+    :param type_mime: type and subtype of the response
+    :type type_mime: str
+    :param keep_alive: announce a persistent connection instead of closing it
+    :type keep_alive: bool
+    :return: Server, Connection and Content-Type field lines
+    :rtype: bytes
+    """
+    template = header_templates.get((type_mime, keep_alive))
+    if template is None:
+        connection = "keep-alive" if keep_alive else "close"
+        template = ("Server: Tobi\r\n"
+                    "Connection: " + connection + "\r\n"
+                    "Content-Type: " + type_mime + "\r\n").encode('utf-8')
+        # Multipart types have a boundary of their own
+        if len(header_templates) < MAX_TEMPLATES and not type_mime.startswith("multipart/"):
+            header_templates[(type_mime, keep_alive)] = template
+    return template
+
+
+def generate_header(code_response, length=None, type_mime="text/html; charset=UTF-8", keep_alive=False, extra=None):
     """
     Generates a response to the request according to the response code
     :param type_mime: type and subtype of requested file
     :param length: length of the header
     :param code_response: HTTP server code
     :type code_response: int
-    :return response_header = "HTTP/1.1 200 OK\r\n"\
-                    "Date: ven., 24 nov. 2017 15:34:41 CET"\
-                    "Server: HacheTTP"\
-                    "Content-Type: text/html; charset=UTF-8"\
-                    "Content-Length: 449"
-    :rtype: str
+    :param keep_alive: announce a persistent connection instead of closing it
+    :type keep_alive: bool
+    :param extra: other header fields, (name, value) pairs
+    :type extra: list or None
+    :return response_header = b"HTTP/1.1 200 OK\r\n"\
+                    b"Date: Fri, 24 Nov 2017 14:34:41 GMT\r\n"\
+                    b"Server: Tobi\r\n"\
+                    b"Connection: close\r\n"\
+                    b"Content-Type: text/html; charset=UTF-8\r\n"\
+                    b"Content-Length: 449\r\n\r\n"
+    :rtype: bytes
     """
-
-    code = {
-        200: "200 OK",
-        400: "400 BAD REQUEST",
-        404: "404 NOT FOUND",
-        405: "405 METHOD NOT ALLOWED",
-        500: "500 INTERNAL SERVER ERROR",
-    }
-
-    date = time.strftime("%a, %d %b %Y %H:%M:%S")
-
-    if code_response not in code:
+    if code_response not in STATUS_LINES:
         code_response = 500
-    codeutil = code[code_response]
+    # Unknown type
+    if type_mime is None:
+        type_mime = "application/octet-stream"
 
     # Generate response header
-    response_header = "HTTP/1.1 " + codeutil + "\r\n"
-    response_header += "Date: " + date + "\r\n"
-    response_header += "Server: Tobi\r\n"
-    response_header += "Connection: close\r\n"
-    response_header += "Content-Type: " + type_mime + "\r\n"
+    response_header = [STATUS_LINES[code_response], http_date(), header_template(type_mime, keep_alive)]
     # Don't put Content-Length if length is null
     if length is not None:
-        response_header += "Content-Length: " + str(length) + "\r\n"
-    else:
-        # print("/!\\ Length is None")
-        pass
+        response_header.append(b"Content-Length: %d\r\n" % length)
+    if extra is not None:
+        for (name, value) in extra:
+            response_header.append((name + ": " + value + "\r\n").encode('utf-8'))
+    response_header.append(b"\r\n")
 
-    response_header += "\r\n"
+    return b"".join(response_header)
 
-    return response_header
+
+class Request:
+    """
+    Request of a client, parsed once and used by every step of the response
+    """
+    __slots__ = ("method", "target", "version", "headers")
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        # Field names in lower case
+        self.headers = headers
+
+
+def parse_request(req):
+    """
+    Check and parse the content of the request in a single pass
+    :param req: request
+    :type req: str
+    :return: HTTP code, and the parsed request when the code is 200
+    :rtype: tuple
+    """
+    lines = req.split("\r\n")
+    # test the content of the first line
+    first_line = lines[0].split(" ")
+    if len(first_line) != 3:
+        return 400, None
+    (method, target, protocol_with_version) = first_line  # GET /index.html HTTP/1.1
+    (protocol, slash, version) = protocol_with_version.partition("/")
+    if method not in METHODS or protocol != "HTTP" or version not in ("1.1", "1.0"):
+        return 405, None
+    # test the rest of the header content
+    headers = {}
+    for line in lines[1:]:
+        if line == "":
+            continue
+        match = HEADER_LINE.match(line)
+        if match is None:
+            return 400, None
+        name = match.group(1).strip().lower()
+        value = match.group(2).strip()
+        if name in headers:
+            headers[name] += ", " + value
+        else:
+            headers[name] = value
+    return 200, Request(method, target, version, headers)
 
 
 def verify_request(req):
@@ -177,94 +1087,460 @@ def verify_request(req):
     :return: HTTP error code
     :rtype: int
     """
-    # If there is a fail, return 500 error code
-    request = 500
+    return parse_request(req)[0]
+
 
+def wants_keep_alive(req):
+    """
+    Tells if the client asked to keep the connection open after the response.
+    HTTP/1.1 connections are persistent unless "Connection: close" is sent,
+    HTTP/1.0 connections are closed unless "Connection: keep-alive" is sent.
+    :param req: request
+    :type req: Request
+    :return: True if the connection must stay open
+    :rtype: bool
+    """
+    connection = req.headers.get("connection", "").lower()
+    if req.version == "1.0":
+        return "keep-alive" in connection
+    return "close" not in connection
+
+
+def take_request(buffer, searched=0):
+    """
+    Take the first complete request header out of the buffer of a connection,
+    the bytes received after it stay in the buffer for the next request
+    :param buffer: bytes received from the client
+    :type buffer: bytearray
+    :param searched: number of bytes at the start of the buffer already searched for the end of the header
+    :type searched: int
+    :return: code and request, (200, request) when complete, (None, None) when more data is needed,
+             (431, None) when the header is larger than MaxHeaderSize, (400, None) when it is not UTF-8
+    :rtype: tuple
+    """
+    max_size = config_srv.CONFIGURATION['MaxHeaderSize']
+    # The end of the header may be split between the previous data and the new one
+    end = buffer.find(b"\r\n\r\n", max(0, searched - 3))
+    if end == -1:
+        if len(buffer) >= max_size:
+            return 431, None
+        return None, None
+    end += 4
+    if end > max_size:
+        return 431, None
+    request = bytes(buffer[:end])
+    del buffer[:end]
     try:
-        # Cutting the big block in lines
-        header = req.split("\n")
-        # Insulation of the first line
-        first_line = header[0].split(" ")
-    except OSError:
-        print(request, "Internal server error.")
-        return request
-    # test the content of the first line
-    if len(first_line) == 3:
-        method = first_line[0]  # GET POST ...
-        global directory
-        directory = first_line[1]  # /index.html
-        protocol_with_version = first_line[2].split("/")  # HTTP 1.1
-        protocol = protocol_with_version[0]  # HTTP
-        version = protocol_with_version[1]  # 1.1
-        if method == "GET" and protocol == "HTTP" and (version == "1.1\r" or version == "1.0\r"):
-            # test the rest of the header content
-            for elt in header[1:]:
-                if re.match("^[A-Za-z- ]*[:].*", elt) or elt == "\r" or elt == "":
-                    request = 200
-                else:
-                    request = 400
-                    return request
+        return 200, request.decode("utf-8")
+    except UnicodeDecodeError:
+        return 400, None
+
+
+def read_request(sock_client, buffer):
+    """
+    Get the user request.
+    Waiting for a new request lasts at most KeepAliveTimeout seconds,
+    receiving a started request at most RequestTimeout seconds.
+    :param sock_client: socket representing the connection with the client
+    :type sock_client: socket
+    :param buffer: bytes received from the client and not used yet, kept between the requests
+    :type buffer: bytearray
+    :return: code and request, (None, None) when the connection is over,
+             (408, None) when the request is not received in time, see take_request for the others
+    :rtype: tuple
+    """
+    deadline = None
+    started = time.perf_counter()
+    searched = 0
+    while True:
+        (code, request) = take_request(buffer, searched)
+        if code is not None:
+            metrics_http.observe("read", time.perf_counter() - started)
+            return code, request
+        if deadline is None and buffer:
+            # A request has started, the time spent waiting for it is not counted
+            started = time.perf_counter()
+            deadline = time.monotonic() + config_srv.CONFIGURATION['RequestTimeout']
+        if deadline is None:
+            timeout = config_srv.CONFIGURATION['KeepAliveTimeout']
         else:
-            request = 405
-    else:
-        request = 400
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return 408, None
+        try:
+            sock_client.settimeout(timeout)
+            data = sock_client.recv(RECV_SIZE)
+        except socket.timeout:
+            if buffer:
+                return 408, None
+            # Idle connection
+            return None, None
+        except OSError:
+            return None, None
+        if not data:
+            # Connection closed by the client
+            return None, None
+        searched = len(buffer)
+        buffer += data
+
+
+def stream_response(req, source, keep_alive, type_mime="text/plain; charset=utf-8", length=None, code=200,
+                    extra=None):
+    """
+    Build a response whose body is produced while it is sent, for the functions of METHODS.
+    Without length, the body is sent in chunks to the HTTP/1.1 clients,
+    and to the HTTP/1.0 ones until the connection is closed.
+    :param req: request
+    :type req: Request
+    :param source: body: iterable of bytes or str (like a generator), or object with a read method
+    :param keep_alive: keep the connection open after the response
+    :type keep_alive: bool
+    :param type_mime: type and subtype of the body
+    :type type_mime: str
+    :param length: bytes the source gives, None when unknown
+    :type length: int or None
+    :param code: HTTP status code
+    :type code: int
+    :param extra: other header fields, (name, value) pairs
+    :type extra: list or None
+    :return: header and data
+    :rtype: tuple
+    """
+    chunked = length is None and req.version != "1.0"
+    if length is None and not chunked:
+        keep_alive = False
+    fields = list(extra or ())
+    if chunked:
+        fields.append(("Transfer-Encoding", "chunked"))
+    return generate_header(code, length, type_mime, keep_alive, fields or None), BodyStream(source, length, chunked)
+
+
+def body_length(data):
+    """
+    Count the bytes of a response body, the BodyStream parts counting what they have sent
+    :param data: response body, bytes or list of bytes, FileRange and BodyStream
+    :type data: bytes or memoryview or list or BodyStream
+    :return: number of bytes
+    :rtype: int
+    """
+    if isinstance(data, BodyStream):
+        return data.sent
+    if not isinstance(data, list):
+        return len(data)
+    return sum(part.count if isinstance(part, FileRange) else part.sent if isinstance(part, BodyStream)
+               else len(part) for part in data)
+
 
-    return request
+def close_body(data):
+    """
+    Close the files and the sources of a response body, sent or not
+    :param data: response body, bytes or list of bytes, FileRange and BodyStream
+    :type data: bytes or memoryview or list or BodyStream
+    :return: None
+    :rtype: None
+    """
+    for part in (data if isinstance(data, list) else [data]):
+        if isinstance(part, FileRange):
+            part.file.close()
+        elif isinstance(part, BodyStream):
+            part.close()
+    return None
+
+
+def chunk_frame(stream, chunk):
+    """
+    Frame a chunk of a BodyStream as it is sent
+    :type stream: BodyStream
+    :param chunk: bytes read, empty at the end of the body
+    :type chunk: bytes
+    :return: the bytes to send
+    :rtype: bytes
+    """
+    stream.sent += len(chunk)
+    if not stream.chunked:
+        return chunk
+    if not chunk:
+        return b"0\r\n\r\n"
+    return b"%x\r\n" % len(chunk) + chunk + b"\r\n"
 
 
-def read_request(sock_client):
+def send_stream(sock_client, stream):
     """
-    Get the user request
+    Send a BodyStream chunk after chunk. sendall only returns once the socket took the previous chunk,
+    so the source is never more than a chunk ahead of what the client received.
     :param sock_client: socket representing the connection with the client
     :type sock_client: socket
-    :return: The request in str
-    :rtype: str
+    :type stream: BodyStream
+    :return: None
+    :rtype: None
     """
-    stop = False
-    data = b""
-    buf = b""
-    try:
-        while not stop:
-            try:
-                buf = sock_client.recv(1024)
-                data += buf
-                if buf.endswith(b"\r\n\r\n"):
-                    stop = True
-            except Exception as e:
-                print(e)
-                return None
-    except OSError:
-        return None
+    while True:
+        chunk = stream.read()
+        data = chunk_frame(stream, chunk)
+        if data:
+            sock_client.sendall(data)
+        if not chunk:
+            return None
 
-    return data.decode("utf-8")
 
+def send_buffers(sock_client, buffers):
+    """
+    Send buffers without joining them, in one call when the socket takes them all:
+    a mapped file is not copied. TLS sockets have no sendmsg, the buffers are sent in turn.
+    :param sock_client: socket representing the connection with the client
+    :type sock_client: socket
+    :param buffers: bytes or memoryview
+    :type buffers: list
+    :return: None
+    :rtype: None
+    """
+    if not hasattr(sock_client, "sendmsg") or isinstance(sock_client, ssl.SSLSocket):
+        for buffer in buffers:
+            sock_client.sendall(buffer)
+        return None
+    buffers = [memoryview(buffer) for buffer in buffers]
+    while buffers:
+        sent = sock_client.sendmsg(buffers)
+        while buffers and sent >= buffers[0].nbytes:
+            sent -= buffers.pop(0).nbytes
+        if sent:
+            buffers[0] = buffers[0][sent:]
+    return None
 
-def client_processing(sock_client):
+
+def send_response(sock_client, header, data):
     """
+    Send a response to the client.
+    Small bodies are sent with the header in one call, joined to it
+    unless they are mapped files, the FileRange parts are sent with sendfile and closed,
+    the BodyStream parts as they are produced.
     :param sock_client: socket representing the connection with the client
+    :type sock_client: socket
+    :param header: response header
+    :type header: bytes
+    :param data: response body, bytes or list of bytes, FileRange and BodyStream
+    :type data: bytes or memoryview or list or BodyStream
     :return: None
     :rtype: None
     """
-    print("Processing the client's request.")
-    request = read_request(sock_client)
-    if request is None:
+    if isinstance(data, BodyStream):
+        data = [data]
+    if isinstance(data, memoryview):
+        send_buffers(sock_client, [header, data])
+        return None
+    if not isinstance(data, list):
+        sock_client.sendall(header + data)
         return None
+    try:
+        sock_client.sendall(header)
+        for part in data:
+            if isinstance(part, FileRange):
+                sock_client.sendfile(part.file, part.offset, part.count)
+            elif isinstance(part, BodyStream):
+                send_stream(sock_client, part)
+            else:
+                sock_client.sendall(part)
+    finally:
+        close_body(data)
+    return None
 
-    code = verify_request(request)
+
+def handle_request(request, keep_alive=True):
+    """
+    Build the response to a request
+    :param request: request
+    :type request: str
+    :param keep_alive: the connection may stay open if the client wants it
+    :type keep_alive: bool
+    :return: header, data and whether the connection stays open
+    :rtype: tuple
+    """
+    begin = time.perf_counter()
+    (code, req) = parse_request(request)
+    metrics_http.observe("parse", time.perf_counter() - begin)
     if code == 200:
-        path = build_file_path(request.split("\r\n")[0])
-        (header, data) = data_reader(path)
+        keep_alive = keep_alive and wants_keep_alive(req)
+        (header, data) = METHODS[req.method](req, keep_alive)
+        if isinstance(data, BodyStream) and data.length is None and not data.chunked:
+            # The end of the body is told by closing the connection
+            keep_alive = False
     else:
-        length = len(directory)
-        header = generate_header(code, length)
+        # Malformed request: the rest of the stream can't be trusted
+        keep_alive = False
         data = gen_data_error(code)
+        header = generate_header(code, len(data), extra=[("Allow", ALLOW)] if code == 405 else None)
+    return header, data, keep_alive
+
+
+def get(req, keep_alive):
+    """
+    Answer a GET request: the metrics, a file, or the listing of a directory.
+    A directory asked without its trailing slash is redirected to it,
+    for its index.html or its listing and for the relative links they hold.
+    :param req: request
+    :type req: Request
+    :param keep_alive: keep the connection open after the response
+    :type keep_alive: bool
+    :return: header and data
+    :rtype: tuple
+    """
+    if req.target == config_srv.CONFIGURATION['MetricsPath']:
+        data = metrics_http.render().encode('utf-8')
+        return generate_header(200, len(data), "text/plain; version=0.0.4; charset=utf-8", keep_alive), data
+    begin = time.perf_counter()
+    (path, st) = resolve_target(req.target)
+    resolved = time.perf_counter()
+    metrics_http.observe("resolve", resolved - begin)
+    if path is None:
+        data = gen_data_error(403)
+        header = generate_header(403, len(data), keep_alive=keep_alive)
+    elif st is not None and stat.S_ISDIR(st.st_mode):
+        (directory, mark, query) = req.target.partition("?")
+        data = b""
+        header = generate_header(301, 0, keep_alive=keep_alive, extra=[("Location", directory + "/" + mark + query)])
+    elif config_srv.CONFIGURATION['AutoIndex'] and st is None and path.endswith("/index.html"):
+        (header, data) = directory_listing(path, req, keep_alive)
+    else:
+        (header, data) = data_reader(path, keep_alive, req, st)
+        metrics_http.observe("file", time.perf_counter() - resolved)
+    return header, data
+
 
+def head(req, keep_alive):
+    """
+    Answer a HEAD request: the header of the GET response, files are not read
+    :param req: request
+    :type req: Request
+    :param keep_alive: keep the connection open after the response
+    :type keep_alive: bool
+    :return: header and no data
+    :rtype: tuple
+    """
+    (header, data) = get(req, keep_alive)
+    close_body(data)
+    return header, b""
+
+
+def options(req, keep_alive):
+    """
+    Answer an OPTIONS request with the methods supported, for the server ("*") or any target
+    :param req: request
+    :type req: Request
+    :param keep_alive: keep the connection open after the response
+    :type keep_alive: bool
+    :return: header and no data
+    :rtype: tuple
+    """
+    return generate_header(200, 0, keep_alive=keep_alive, extra=[("Allow", ALLOW)]), b""
+
+
+# Method -> function answering it, a new method only has to be added here
+METHODS = {"GET": get, "HEAD": head, "OPTIONS": options}
+ALLOW = ", ".join(METHODS)
+
+
+def reject(sock_client, code=503, extra=None):
+    """
+    Answer an error and close the connection, used when the server
+    can't afford to serve the client or can't read its request.
+    :param sock_client: socket representing the connection with the client
+    :type sock_client: socket
+    :param code: HTTP error code
+    :type code: int
+    :param extra: other header fields, (name, value) pairs
+    :type extra: list or None
+    :return: None
+    :rtype: None
+    """
+    data = gen_data_error(code)
+    response = generate_header(code, len(data), extra=extra) + data
     try:
-        data_to_send = header.encode('utf-8') + data
-        sock_client.sendall(data_to_send)
-        print("Client request done successfully.")
+        sock_client.sendall(response)
+        metrics_http.response(code, len(response))
     except socket.error:
-        print("Socket Error")
+        pass
+    finally:
+        sock_client.close()
+    return None
+
+
+def client_processing(sock_client):
+    """
+    Serve the requests of a client until the connection is closed,
+    the idle timeout expires or the maximum number of requests is reached.
+    Pipelined requests are answered in order.
+    The TLS handshake of an HTTPS connection is done first.
+    :param sock_client: socket representing the connection with the client
+    :return: None
+    :rtype: None
+    """
+    log_http.debug("Processing the client's request.")
+    metrics_http.connection_opened()
+    try:
+        address = sock_client.getpeername()[0]
+    except (OSError, IndexError):
+        address = "-"
+    max_requests = config_srv.CONFIGURATION['KeepAliveMax']
+    buffer = bytearray()
+    served = 0
+    try:
+        protocol = tls_http.handshake(sock_client)
+        if protocol == "h2":
+            # Chosen with ALPN, the client starts with the HTTP/2 preface
+            h2_http.serve(sock_client, buffer, h2_http.Connection(address))
+        keep_alive = protocol == "http/1.1"
+        while keep_alive:
+            (code, request) = read_request(sock_client, buffer)
+            if code is None:
+                break
+            if code != 200:
+                reject(sock_client, code)
+                log_http.access(address, None, code, len(gen_data_error(code)), 0)
+                break
+            if not limit_http.allow(address):
+                # Refused before any work is spent on the request
+                reject(sock_client, 429, [("Retry-After", limit_http.retry_after())])
+                log_http.access(address, request, 429, len(gen_data_error(429)), 0)
+                break
+            connection = h2_http.start(request, address)
+            if connection is not None:
+                h2_http.serve(sock_client, buffer, connection)
+                break
+            received = time.perf_counter()
+            sock_client.settimeout(config_srv.CONFIGURATION['KeepAliveTimeout'])
+            served += 1
+            upstream = proxy_http.route(request)
+            if upstream is not None:
+                try:
+                    (code, header_length, length, keep_alive) = proxy_http.forward(
+                        sock_client, buffer, request, upstream, served < max_requests, address)
+                except socket.error:
+                    log_http.debug("Socket Error")
+                    break
+                if header_length is None:
+                    reject(sock_client, code)
+                    log_http.access(address, request, code, len(gen_data_error(code)), 0)
+                    break
+                metrics_http.response(code, header_length + length)
+                log_http.access(address, request, code, length, time.perf_counter() - received)
+                continue
+            (header, data, keep_alive) = handle_request(request, served < max_requests)
+            try:
+                begin = time.perf_counter()
+                send_response(sock_client, header, data)
+                sent = time.perf_counter()
+                metrics_http.observe("send", sent - begin)
+                code = int(header[9:12])
+                length = body_length(data)
+                metrics_http.response(code, len(header) + length)
+                log_http.access(address, request, code, length, sent - received)
+                log_http.debug("Client request done successfully.")
+            except socket.error:
+                log_http.debug("Socket Error")
+                break
+    finally:
+        sock_client.close()
+        metrics_http.connection_closed()
 
     return None
 
@@ -272,6 +1548,9 @@ def client_processing(sock_client):
 def main():
     # Test
 
+    def parsed(text):
+        return parse_request(text)[1]
+
     # ----- verify_request()
 
     header = 'GET /file HTTP/1.1\r\n'
@@ -353,49 +1632,133 @@ def main():
     assert verify_request(request) == 400
     print("Test verify_request OK")
 
+    # ----- parse_request()
+
+    (code, req) = parse_request('GET /src/index.html?a=b HTTP/1.0\r\n' + core + 'Accept-Encoding: zstd\r\n\r\n')
+    assert code == 200
+    assert (req.method, req.target, req.version) == ("GET", "/src/index.html?a=b", "1.0")
+    assert req.headers["accept-encoding"] == "gzip, deflate, br, zstd"
+    assert req.headers["user-agent"].startswith("Mozilla/5.0") and "range" not in req.headers
+    assert parse_request('GET /file HTTP\r\n' + core) == (405, None)
+    print("Test parse_request OK")
+
+    # ----- wants_keep_alive()
+
+    try:
+        # HTTP/1.1 IS PERSISTENT BY DEFAULT
+        assert wants_keep_alive(parsed('GET / HTTP/1.1\r\nHost: 127.0.0.1:8000\r\n\r\n')) is True
+        assert wants_keep_alive(parsed('GET / HTTP/1.1\r\n' + core + '\r\n')) is True
+        assert wants_keep_alive(parsed('GET / HTTP/1.1\r\nconnection: Close\r\n\r\n')) is False
+        # HTTP/1.0 IS CLOSED BY DEFAULT
+        assert wants_keep_alive(parsed('GET / HTTP/1.0\r\n\r\n')) is False
+        assert wants_keep_alive(parsed('GET / HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\n')) is True
+    except AssertionError:
+        print("Test wants_keep_alive ERROR")
+    print("Test wants_keep_alive OK")
+
+    # ----- read_request()
+
+    # PIPELINED REQUESTS ARE READ ONE BY ONE, IN ORDER
+    (server_side, client_side) = socket.socketpair()
+    client_side.sendall(b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\nGET /c")
+    client_side.shutdown(socket.SHUT_WR)
+    buffer = bytearray()
+    assert read_request(server_side, buffer) == (200, "GET /a HTTP/1.1\r\n\r\n")
+    assert read_request(server_side, buffer) == (200, "GET /b HTTP/1.1\r\n\r\n")
+    # INCOMPLETE REQUEST THEN CONNECTION CLOSED
+    assert read_request(server_side, buffer) == (None, None)
+    server_side.close()
+    client_side.close()
+
+    # END OF HEADER SPLIT BETWEEN TWO READS
+    buffer = bytearray(b"GET /a HTTP/1.1\r\n\r")
+    assert take_request(buffer) == (None, None)
+    buffer += b"\nGET"
+    assert take_request(buffer, len(buffer) - 4) == (200, "GET /a HTTP/1.1\r\n\r\n")
+    assert buffer == b"GET"
+
+    # HEADER TOO LARGE
+    buffer = bytearray(b"GET / HTTP/1.1\r\nCookie: " + b"a" * config_srv.CONFIGURATION['MaxHeaderSize'])
+    assert take_request(buffer) == (431, None)
+    buffer = bytearray(b"GET /\xff HTTP/1.1\r\n\r\n")
+    assert take_request(buffer) == (400, None)
+
+    # REQUEST NOT RECEIVED IN TIME
+    config_srv.update({'RequestTimeout': 0.2})
+    (server_side, client_side) = socket.socketpair()
+    client_side.sendall(b"GET / HTTP/1.1\r\n")
+    assert read_request(server_side, bytearray()) == (408, None)
+    # IDLE CONNECTION
+    config_srv.update({'KeepAliveTimeout': 0.2})
+    assert read_request(server_side, bytearray()) == (None, None)
+    server_side.close()
+    client_side.close()
+    config_srv.update({'RequestTimeout': 10})
+    config_srv.update({'KeepAliveTimeout': 5})
+    print("Test read_request OK")
+
     # ----- generate_header()
 
     code = {200: "200 OK", 400: "400 BAD REQUEST", 404: "404 NOT FOUND", 405: "405 METHOD NOT ALLOWED",
             500: "500 INTERNAL SERVER ERROR"}
+    # The clock frozen, the Date field cannot change between a response and the expected one
+    (real_time, clock) = (time.time, [time.time()])
+    time.time = lambda: clock[0]
+    date = email.utils.formatdate(clock[0], usegmt=True)
 
     try:
         # CORRECT
-        assert generate_header(200, 128) == "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close\r\n" + "Content-Type: " + \
+        assert generate_header(200, 128).decode() == "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close\r\n" + "Content-Type: " + \
             "text/html; charset=UTF-8" + "\r\n" + "Content-Length: " + str(128) + "\r\n\r\n"
         # CORRECT with length = None
-        assert generate_header(200, None) == "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close" + "\r\n" + \
+        assert generate_header(200, None).decode() == "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close" + "\r\n" + \
             "Content-Type: " + "text/html; charset=UTF-8" + "\r\n\r\n"
         # CORRECT but no length
-        assert generate_header(200) == "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close" + "\r\n" + \
+        assert generate_header(200).decode() == "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close" + "\r\n" + \
             "Content-Type: " + "text/html; charset=UTF-8" + "\r\n" + "\r\n"
         # ERROR CODE 400 with correct length
-        assert generate_header(400, 128) == "HTTP/1.1 " + code[400] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close\r\n" + "Content-Type: " + \
+        assert generate_header(400, 128).decode() == "HTTP/1.1 " + code[400] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close\r\n" + "Content-Type: " + \
             "text/html; charset=UTF-8" + "\r\n" + "Content-Length: " + str(128) + "\r\n\r\n"
         # ERROR CODE 404 with correct length
-        assert generate_header(404, 128) == "HTTP/1.1 " + code[404] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close\r\n" + "Content-Type: " + \
+        assert generate_header(404, 128).decode() == "HTTP/1.1 " + code[404] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close\r\n" + "Content-Type: " + \
             "text/html; charset=UTF-8" + "\r\n" + "Content-Length: " + str(128) + "\r\n\r\n"
         # ERROR CODE 405 with correct length
-        assert generate_header(405, 128) == "HTTP/1.1 " + code[405] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" \
+        assert generate_header(405, 128).decode() == "HTTP/1.1 " + code[405] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" \
             + "Connection: close\r\n" + "Content-Type: " + "text/html; charset=UTF-8" + "\r\n" + \
             "Content-Length: " + str(128) + "\r\n\r\n"
         # ERROR CODE 500 with correct length
-        assert generate_header(500, 128) == "HTTP/1.1 " + code[500] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" \
+        assert generate_header(500, 128).decode() == "HTTP/1.1 " + code[500] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" \
             + "Connection: close\r\n" + "Content-Type: " + "text/html; charset=UTF-8" + "\r\n" + "Content-Length: " + \
             str(128) + "\r\n\r\n"
+        # ERROR CODE 503 with correct length
+        assert generate_header(503, 128).decode().startswith("HTTP/1.1 503 SERVICE UNAVAILABLE\r\n")
         # INCORRECT ERROR CODE with correct length
-        assert generate_header(-399, 128) == "HTTP/1.1 " + code[500] + "\r\n" + "Date: " + time.strftime(
-            "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" \
+        assert generate_header(-399, 128).decode() == "HTTP/1.1 " + code[500] + "\r\n" + "Date: " + date + \
+            "\r\n" + "Server: Tobi" + "\r\n" \
             + "Connection: close\r\n" + "Content-Type: " + "text/html; charset=UTF-8" + "\r\n" + \
             "Content-Length: " + str(128) + "\r\n\r\n"
+        # KEEP-ALIVE
+        assert "Connection: keep-alive\r\n" in generate_header(200, 128, keep_alive=True).decode()
     except AssertionError:
         print("Test generate_header ERROR")
+    # DATE FIELD SHARED DURING ONE SECOND
+    clock[0] = 1700000000.2
+    try:
+        first = http_date()
+        assert first == ("Date: " + email.utils.formatdate(1700000000, usegmt=True) + "\r\n").encode()
+        clock[0] = 1700000000.9
+        assert http_date() is first
+        clock[0] = 1700000001.0
+        assert http_date() == ("Date: " + email.utils.formatdate(1700000001, usegmt=True) + "\r\n").encode()
+    finally:
+        time.time = real_time
     print("Test generate_header OK")
 
     # ----- gen_data_error()
@@ -415,6 +1778,9 @@ def main():
         # CODE 500
         assert gen_data_error(
             500) == b'<html><body><center><h1>Error 500: Internal server error</h1></center><p>Head back to <a href="/">home page</a>.</p></body></html>'
+        # CODE 503
+        assert gen_data_error(
+            503) == b'<html><body><center><h1>Error 503: Service unavailable</h1></center><p>Please retry in a few seconds.</p></body></html>'
     except AssertionError:
         print("Test gen_data_error ERROR")
     print("Test gen_data_error OK")
@@ -442,18 +1808,181 @@ def main():
         print("Test build_file_path ERROR")
     print("Test build_file_path OK")
 
+    # ----- resolve_target()
+
+    root = config_srv.CONFIGURATION['Path']
+    assert resolve_target("/") == (root + "index.html", os.stat(root + "index.html"))
+    hits = cache_http.stats['path_hits']
+    assert resolve_target("/")[0] == root + "index.html"
+    assert cache_http.stats['path_hits'] == hits + 1
+    assert resolve_target("/missing.html") == (root + "missing.html", None)
+    # OUTSIDE OF THE DOCUMENT ROOT
+    assert resolve_target("/../config_srv.py") == (None, None)
+    assert resolve_target("/test/%2e%2e/%2E%2E/client_http.py") == (None, None)
+    assert resolve_target("/test/../index.html")[1] is not None
+    # NULL BYTE: NOT FOUND
+    assert resolve_target("/%00") == (root + "\0", None)
+    assert handle_request("GET /%00 HTTP/1.1\r\n\r\n")[0].startswith(b"HTTP/1.1 404 NOT FOUND\r\n")
+    # DOCUMENT ROOT CHANGED
+    config_srv.update({'Path': root + "test/"})
+    assert resolve_target("/py.png")[0] == root + "test/py.png"
+    config_srv.update({'Path': root})
+    assert resolve_target("/py.png") == (root + "py.png", None)
+    # STATUS CACHED WHILE THE FILE CHANGES: THE RESPONSE IS THE ONE OF THE FILE OPENED
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        config_srv.update({'Path': directory + "/"})
+        with open(os.path.join(directory, "a.txt"), "w") as file:
+            file.write("old")
+        (path, st) = resolve_target("/a.txt")
+        for (content, threshold) in (("new content", 1024 * 1024), ("streamed content", 8)):
+            config_srv.update({'SendfileThreshold': threshold})
+            with open(path, "w") as file:
+                file.write(content)
+            os.utime(path, ns=(st.st_mtime_ns + 10 ** 9, st.st_mtime_ns + 10 ** 9))
+            # Status of "old" still cached
+            assert resolve_target("/a.txt")[1].st_size == 3
+            (header, data) = data_reader(path, False, None, st)
+            assert b"Content-Length: " + str(len(content)).encode() + b"\r\n" in header
+            assert ("ETag: " + validators(os.stat(path))[0]).encode() in header
+            if isinstance(data, list):
+                assert data[0].count == len(content)
+                close_body(data)
+            else:
+                assert data == content.encode() and cache_http.lookup(path, os.stat(path))[0] == data
+            st = os.stat(path)
+        # CHANGED AGAIN EACH TIME IT IS OPENED: ANSWERED AGAIN ONCE ONLY
+        real_load = load
+
+        def changing(path, st, type_mime):
+            with open(path, "a") as file:
+                file.write("x")
+            return real_load(path, st, type_mime)
+
+        globals()['load'] = changing
+        try:
+            assert data_reader(path, False, None, st)[0].startswith(b"HTTP/1.1 503 SERVICE UNAVAILABLE\r\n")
+        finally:
+            globals()['load'] = real_load
+        # REMOVED WHILE ITS STATUS IS CACHED: NOT FOUND, THE STATUS FORGOTTEN
+        config_srv.update({'SendfileThreshold': 1024 * 1024})
+        os.remove(path)
+        assert resolve_target("/a.txt")[1] is not None
+        assert handle_request("GET /a.txt HTTP/1.1\r\n\r\n")[0].startswith(b"HTTP/1.1 404 NOT FOUND\r\n")
+        assert resolve_target("/a.txt") == (path, None)
+    config_srv.update({'Path': root, 'SendfileThreshold': 1024 * 1024})
+    print("Test resolve_target OK")
+
+    # ----- handle_request()
+
+    (header, data, keep_alive) = handle_request("GET /__metrics HTTP/1.1\r\n\r\n")
+    assert header.startswith(b"HTTP/1.1 200 OK\r\n") and keep_alive
+    assert b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n" in header
+    count = int(data.split(b'http_request_stage_seconds_count{stage="resolve"} ')[1].split(b"\n")[0])
+    handle_request("GET / HTTP/1.1\r\n\r\n")
+    text = handle_request("GET /__metrics HTTP/1.1\r\n\r\n")[1].decode().splitlines()
+    assert 'http_request_stage_seconds_count{stage="resolve"} ' + str(count + 1) in text
+    # DISABLED
+    config_srv.update({'MetricsPath': None})
+    assert handle_request("GET /__metrics HTTP/1.1\r\n\r\n")[0].startswith(b"HTTP/1.1 404 NOT FOUND\r\n")
+    config_srv.update({'MetricsPath': '/__metrics'})
+
+    # HEAD: THE HEADER OF GET, WITHOUT READING THE FILE
+    cache_http.clear()
+    misses = cache_http.stats['misses']
+    (header, data, keep_alive) = handle_request("HEAD /index.html HTTP/1.1\r\nRange: bytes=0-1\r\n\r\n")
+    get_header = handle_request("GET /index.html HTTP/1.1\r\n\r\n")[0]
+    assert header == get_header and data == b"" and keep_alive
+    assert cache_http.stats['misses'] == misses + 1
+    config_srv.update({'CompressMinSize': 0})
+    request = "HEAD /index.html HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"
+    assert b"Content-Length" not in handle_request(request)[0]
+    (get_header, data, keep_alive) = handle_request(request.replace("HEAD", "GET"))
+    assert handle_request(request)[0] == get_header and b"Content-Length: %d\r\n" % len(data) in get_header
+    config_srv.update({'CompressMinSize': 256})
+    (header, data, keep_alive) = handle_request("HEAD /missing.html HTTP/1.1\r\n\r\n")
+    assert header.startswith(b"HTTP/1.1 404 NOT FOUND\r\n") and b"Content-Length: 118\r\n" in header and data == b""
+    # OPTIONS
+    (header, data, keep_alive) = handle_request("OPTIONS * HTTP/1.1\r\n\r\n")
+    assert header.startswith(b"HTTP/1.1 200 OK\r\n") and b"Allow: GET, HEAD, OPTIONS\r\n" in header
+    assert b"Content-Length: 0\r\n" in header and data == b""
+    # OTHER METHODS
+    (header, data, keep_alive) = handle_request("DELETE /index.html HTTP/1.1\r\n\r\n")
+    assert header.startswith(b"HTTP/1.1 405 METHOD NOT ALLOWED\r\n") and b"Allow: GET, HEAD, OPTIONS\r\n" in header
+    print("Test handle_request OK")
+
+    # ----- directory_listing()
+
+    assert handle_request("GET /test/ HTTP/1.1\r\n\r\n")[0].startswith(b"HTTP/1.1 404 NOT FOUND\r\n")
+    config_srv.update({'AutoIndex': True, 'AutoIndexPageSize': 2, 'PathCacheTTL': 0.2})
+    with tempfile.TemporaryDirectory() as directory:
+        config_srv.update({'Path': directory + "/"})
+        os.mkdir(os.path.join(directory, "sub dir"))
+        for name in ("b.txt", "a&b.txt", "c.txt"):
+            with open(os.path.join(directory, "sub dir", name), "w") as file:
+                file.write(name)
+        (header, data, keep_alive) = handle_request("GET /sub%20dir/ HTTP/1.1\r\n\r\n")
+        assert header.startswith(b"HTTP/1.1 200 OK\r\n") and b"Content-Type: text/html; charset=utf-8\r\n" in header
+        assert b"<title>Index of /sub dir/</title>" in data and b'<a href="/">../</a>' in data
+        assert b'<a href="/sub%20dir/a%26b.txt">a&amp;b.txt</a>' in data and b"b.txt</a>" in data
+        assert b"c.txt" not in data and b'<a href="?page=2">Next</a>' in data
+        # PAGES AND JSON
+        data = handle_request("GET /sub%20dir/?page=2&format=json HTTP/1.1\r\n\r\n")[1]
+        assert json.loads(data) == {"path": "/sub dir/", "page": 2, "pages": 2, "total": 3,
+                                    "entries": [{"name": "c.txt", "type": "file", "size": 5,
+                                                 "mtime": int(os.stat(os.path.join(directory, "sub dir", "c.txt"))
+                                                              .st_mtime)}]}
+        data = handle_request("GET /?page=1 HTTP/1.1\r\nAccept: application/json\r\n\r\n")[1]
+        assert json.loads(data)["entries"][0]["name"] == "sub dir"
+        assert json.loads(data)["entries"][0]["type"] == "directory"
+        assert handle_request("GET /sub%20dir/?page=3 HTTP/1.1\r\n\r\n")[0].startswith(b"HTTP/1.1 404")
+        assert handle_request("GET /nodir/ HTTP/1.1\r\n\r\n")[0].startswith(b"HTTP/1.1 404")
+        # CACHED UNTIL THE DIRECTORY CHANGES
+        hits = cache_http.stats['hits']
+        first = handle_request("GET /sub%20dir/ HTTP/1.1\r\n\r\n")[1]
+        # A rendered page does not scan the directory again
+        scan = globals()['scan_directory']
+        globals()['scan_directory'] = None
+        assert handle_request("GET /sub%20dir/ HTTP/1.1\r\n\r\n")[1] is first
+        globals()['scan_directory'] = scan
+        assert cache_http.stats['hits'] == hits + 2
+        # ONLY THE ENTRIES STILL THERE ARE SHOWN
+        assert stat_entries(os.path.join(directory, "sub dir"), [("b.txt", False), ("gone.txt", False)]) == [
+            ("b.txt", False, 5, os.stat(os.path.join(directory, "sub dir", "b.txt")).st_mtime)]
+        os.remove(os.path.join(directory, "sub dir", "a&b.txt"))
+        assert b"a&amp;b.txt" not in handle_request("GET /sub%20dir/ HTTP/1.1\r\n\r\n")[1]
+        # DIRECTORY WITHOUT ITS TRAILING SLASH REDIRECTED TO IT
+        header = handle_request("GET /sub%20dir?page=2 HTTP/1.1\r\n\r\n")[0]
+        assert header.startswith(b"HTTP/1.1 301 MOVED PERMANENTLY\r\n")
+        assert b"Location: /sub%20dir/?page=2\r\n" in header
+        # INDEX.HTML IS SERVED INSTEAD, ONCE THE STATUS OF THE MISSING ONE CACHED BY resolve_target EXPIRES
+        with open(os.path.join(directory, "sub dir", "index.html"), "w") as file:
+            file.write("index")
+        assert b"Index of /sub dir/" in handle_request("GET /sub%20dir/ HTTP/1.1\r\n\r\n")[1]
+        time.sleep(config_srv.CONFIGURATION['PathCacheTTL'])
+        assert handle_request("GET /sub%20dir/ HTTP/1.1\r\n\r\n")[1] == b"index"
+        assert handle_request("GET /sub%20dir HTTP/1.1\r\n\r\n")[0].startswith(b"HTTP/1.1 301")
+    config_srv.update({'Path': root, 'AutoIndex': False, 'AutoIndexPageSize': 1000, 'PathCacheTTL': 1})
+    print("Test directory_listing OK")
+
     # ----- data_reader()
 
+    (real_time, clock) = (time.time, [time.time()])
+    time.time = lambda: clock[0]
+    date = email.utils.formatdate(clock[0], usegmt=True)
     # FILE FOUND
     first_line = "GET / HTTP/1.1"
     path = build_file_path(first_line)
     size = os.path.getsize(path)
-    expected_response_header = "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + time.strftime(
-        "%a, %d %b %Y %H:%M:%S") + "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close" + "\r\n" + \
-        "Content-Type: " + "text/html; charset=UTF-8" + "\r\n" + "Content-Length: " + str(size) + "\r\n\r\n"
+    (etag, last_modified) = validators(os.stat(path))
+    expected_response_header = "HTTP/1.1 " + code[200] + "\r\n" + "Date: " + date + \
+        "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close" + "\r\n" + \
+        "Content-Type: " + "text/html; charset=UTF-8" + "\r\n" + "Content-Length: " + str(size) + "\r\n" + \
+        "Accept-Ranges: bytes" + "\r\n" + "Vary: Accept-Encoding" + "\r\n" + "ETag: " + etag + "\r\n" + \
+        "Last-Modified: " + last_modified + "\r\n" + "Cache-Control: max-age=0" + "\r\n\r\n"
     expected_response_data = b'<!DOCTYPE html><html lang="fr"><head><meta charset="UTF-8"><title>test</title></head><body><div style="text-align: center;"><h1>TEST PAGE</h1><h2>I think it\'s working...</h2></div></body></html>'
     try:
-        assert data_reader(path) == (expected_response_header, expected_response_data)
+        assert data_reader(path) == (expected_response_header.encode(), expected_response_data)
     except AssertionError:
         print("POSSIBLE ERROR 1 : check date time between read data and expect header\r\n")
         print(data_reader(path)[0])
@@ -463,16 +1992,20 @@ def main():
     first_line = "GET /thisisnotafile.html HTTP/1.1"
     path = build_file_path(first_line)
     size = len(gen_data_error(404))
-    expected_response_header = "HTTP/1.1 " + code[404] + "\r\n" + "Date: " + time.strftime("%a, %d %b %Y %H:%M:%S") + \
+    expected_response_header = "HTTP/1.1 " + code[404] + "\r\n" + "Date: " + date + \
                                "\r\n" + "Server: Tobi" + "\r\n" + "Connection: close" + "\r\n" + "Content-Type: " + \
                                "text/html; charset=UTF-8" + "\r\n" + "Content-Length: " + str(size) + "\r\n\r\n"
     expected_response_data = gen_data_error(404)
     try:
-        assert data_reader(path) == (expected_response_header, expected_response_data)
+        assert data_reader(path) == (expected_response_header.encode(), expected_response_data)
     except AssertionError:
         print("POSSIBLE ERROR 2 : check date time between read data and expect header\r\n")
         print(expected_response_header)
         print(data_reader(path)[0])
+    finally:
+        time.time = real_time
+    # NULL BYTE IN THE PATH
+    assert data_reader(path + "\0")[0].startswith(b"HTTP/1.1 404 NOT FOUND\r\n")
 
     # #  ANY READING PROBLEMS like no perms on a file requested first_line = "GET /no_perms HTTP/1.1" path =
     # build_file_path(first_line) size = len(gen_data_error(500)) expected_response_header = "HTTP/1.1 " + code[500]
@@ -481,8 +2014,167 @@ def main():
     # str(size) + "\r\n\r\n" expected_response_data = gen_data_error(500) assert data_reader(path) == (
     # expected_response_header, expected_response_data)
 
+    # FILE SERVED AGAIN FROM THE CACHE
+    first_line = "GET / HTTP/1.1"
+    path = build_file_path(first_line)
+    hits = cache_http.stats['hits']
+    assert data_reader(path)[1] == data_reader(path)[1]
+    assert cache_http.stats['hits'] >= hits + 1
+
+    # BIG FILE STREAMED
+    config_srv.update({'SendfileThreshold': 64})
+    (header, data) = data_reader(path)
+    assert isinstance(data, list) and isinstance(data[0], FileRange)
+    assert data[0].offset == 0 and data[0].count == os.path.getsize(path)
+    (server_side, client_side) = socket.socketpair()
+    send_response(server_side, header, data)
+    server_side.close()
+    assert data[0].file.closed
+    response = b""
+    while True:
+        buf = client_side.recv(4096)
+        if not buf:
+            break
+        response += buf
+    client_side.close()
+    assert response == header + open(path, "rb").read()
+    config_srv.update({'SendfileThreshold': 1024 * 1024})
+
+    # RANGES
+    content = open(path, "rb").read()
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nRange: bytes=0-14\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 206 PARTIAL CONTENT\r\n")
+    assert b"Content-Range: bytes 0-14/%d\r\n" % len(content) in header
+    assert data == b"<!DOCTYPE html>"
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nRange: bytes=0-0,-7\r\n\r\n"))
+    assert b"Content-Type: multipart/byteranges; boundary=" in header
+    assert data.endswith(b"</html>\r\n--" + header.split(b"boundary=")[1].split(b"\r\n")[0] + b"--\r\n")
+    assert b"Content-Length: %d\r\n" % len(data) in header
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nRange: bytes=99999-\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 416 RANGE NOT SATISFIABLE\r\n")
+    # OUTDATED If-Range: WHOLE FILE
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nRange: bytes=0-14\r\n"
+                                                  "If-Range: Mon, 01 Jan 2001 00:00:00 GMT\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 200 OK\r\n") and data == content
+
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nRange: bytes=0-14\r\n"
+                                                  "If-Range: " + etag + "\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 206 PARTIAL CONTENT\r\n")
+
+    # CONDITIONAL REQUESTS
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nIf-None-Match: " + etag + "\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 304 NOT MODIFIED\r\n") and data == b""
+    assert ("ETag: " + etag + "\r\n").encode() in header and b"Content-Length" not in header
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nIf-None-Match: \"old\", W/" + etag + "\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 304 NOT MODIFIED\r\n")
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nIf-None-Match: \"old\"\r\n"
+                                                  "If-Modified-Since: " + last_modified + "\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 200 OK\r\n")
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nIf-Modified-Since: " + last_modified + "\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 304 NOT MODIFIED\r\n")
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nIf-Modified-Since: Mon, 01 Jan 2001 00:00:00 GMT"
+                                                  "\r\n\r\n"))
+    assert header.startswith(b"HTTP/1.1 200 OK\r\n")
+
+    # COMPRESSED ON THE FLY
+    config_srv.update({'CompressMinSize': 0})
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nAccept-Encoding: gzip;q=0.5, br;q=0\r\n\r\n"))
+    assert b"Content-Encoding: gzip\r\n" in header and b"Vary: Accept-Encoding\r\n" in header
+    assert ("ETag: " + etag[:-1] + "-gzip\"\r\n").encode() in header
+    assert gzip.decompress(data) == content and b"Content-Length: %d\r\n" % len(data) in header
+    assert data_reader(path, req=parsed("GET / HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"))[1] is data
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nAccept-Encoding: gzip\r\n"
+                                                  "Range: bytes=0-14\r\n\r\n"))
+    assert b"Content-Encoding" not in header and data == b"<!DOCTYPE html>"
+    config_srv.update({'CompressMinSize': 256})
+    # PRECOMPRESSED FILE
+    path = build_file_path("GET /test/py.svg HTTP/1.1")
+    with open(path + ".gz", "wb") as file:
+        file.write(b"precompressed")
+    try:
+        (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nAccept-Encoding: gzip, deflate, br\r\n\r\n"))
+        assert b"Content-Encoding: gzip\r\n" in header and data == b"precompressed"
+        assert b"Content-Type: image/svg+xml;\r\n" in header
+    finally:
+        os.remove(path + ".gz")
+    # ALREADY COMPRESSED TYPE
+    path = build_file_path("GET /test/py.png HTTP/1.1")
+    (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nAccept-Encoding: gzip, deflate, br\r\n\r\n"))
+    assert b"Content-Encoding" not in header and b"Vary" not in header
+
     print("Test data_reader OK")
 
+    # ----- preload()
+
+    root = config_srv.CONFIGURATION['Path']
+    config_srv.update({'PreloadMaxFileSize': 1024})
+    config_srv.update({'CompressMinSize': 0})
+    (table, in_memory, mapped) = preload(root)
+    config_srv.update({'PreloadMaxFileSize': 256 * 1024})
+    assert set(table) == {root + "index.html", root + "fichiertest.html", root + "test/py.gif", root + "test/py.jpg",
+                          root + "test/py.pdf", root + "test/py.png", root + "test/py.svg"}
+    path = root + "index.html"
+    st = os.stat(path)
+    with open(path, "rb") as file:
+        content = file.read()
+    assert isinstance(table[path][2], bytes) and "gzip" in table[path][6]
+    assert isinstance(table[root + "test/py.pdf"][2], memoryview) and not table[root + "test/py.pdf"][6]
+    assert mapped == 3097 and in_memory > sum(len(entry[2]) for entry in table.values()) - mapped
+    cache_http.install_preloaded(table)
+    try:
+        # SERVED WITHOUT READING THE FILE
+        assert load(path, st, None)[0] is table[path][2]
+        (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"))
+        assert data is table[path][6]["gzip"] and gzip.decompress(data) == content
+        # MAPPED FILE
+        path = root + "test/py.pdf"
+        with open(path, "rb") as file:
+            content = file.read()
+        (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nRange: bytes=0-3,-4\r\n\r\n"))
+        assert content[:4] in data and content[-4:] in data
+        (header, data) = data_reader(path, req=parsed("GET / HTTP/1.1\r\nRange: bytes=1-3\r\n\r\n"))
+        assert bytes(data) == content[1:4]
+    finally:
+        cache_http.install_preloaded({})
+        config_srv.update({'CompressMinSize': 256})
+    print("Test preload OK")
+
+    # ----- accepted_encodings()
+
+    assert accepted_encodings(parsed("GET / HTTP/1.1\r\n" + core)) == {"gzip", "deflate", "br"}
+    assert accepted_encodings(parsed("GET / HTTP/1.1\r\nAccept-Encoding: gzip;q=0, identity\r\n")) == {"identity"}
+    assert accepted_encodings(parsed("GET / HTTP/1.1\r\nAccept-Encoding: *\r\n")) == {"*", "br", "gzip"}
+    assert accepted_encodings(parsed("GET / HTTP/1.1\r\n")) == set()
+    print("Test accepted_encodings OK")
+
+    # ----- max_age()
+
+    assert max_age(config_srv.CONFIGURATION['Path'] + "index.html") == 0
+    assert max_age(config_srv.CONFIGURATION['Path'] + "test/py.PNG") == 86400
+    max_ages = config_srv.CONFIGURATION['MaxAge']
+    config_srv.update({'MaxAge': dict(max_ages, **{'/test/': 60})})
+    assert max_age(config_srv.CONFIGURATION['Path'] + "test/py.png") == 60
+    assert max_age(config_srv.CONFIGURATION['Path'] + "py.png") == 86400
+    config_srv.update({'MaxAge': max_ages})
+    print("Test max_age OK")
+
+    # ----- parse_range()
+
+    assert parse_range("bytes=0-99", 1000) == [(0, 99)]
+    assert parse_range("bytes=900-", 1000) == [(900, 999)]
+    assert parse_range("bytes=-100, 10-20", 1000) == [(900, 999), (10, 20)]
+    assert parse_range("bytes=990-2000", 1000) == [(990, 999)]
+    # NOT SATISFIABLE
+    assert parse_range("bytes=1000-", 1000) == []
+    assert parse_range("bytes=-0", 1000) == []
+    # INVALID: IGNORED
+    assert parse_range("bytes=20-10", 1000) is None
+    assert parse_range("bytes=a-10", 1000) is None
+    assert parse_range("bytes=--5", 1000) is None
+    assert parse_range("lines=0-5", 1000) is None
+    assert parse_range("bytes=" + ",".join(["0-1"] * (MAX_RANGES + 1)), 1000) is None
+    print("Test parse_range OK")
+
     # ----- data_type()
 
     try:
@@ -502,6 +2194,96 @@ def main():
         print("Test data_type ERROR")
     print("Test data_type OK")
 
+    # ----- stream_response() / send_response()
+
+    import io
+    import threading
+
+    def received(header, data):
+        (server_side, client_side) = socket.socketpair()
+        send_response(server_side, header, data)
+        server_side.close()
+        response = b""
+        while True:
+            buf = client_side.recv(4096)
+            if not buf:
+                break
+            response += buf
+        client_side.close()
+        return response
+
+    def produce(chunks, state):
+        try:
+            for chunk in chunks:
+                state['produced'] += 1
+                yield chunk
+        finally:
+            state['closed'] = True
+
+    # CHUNKED, THE EMPTY CHUNKS SKIPPED
+    state = {'produced': 0, 'closed': False}
+    (header, data) = stream_response(parsed("GET /log HTTP/1.1\r\n\r\n"), produce([b"ab", b"", "cd"], state), True)
+    assert b"Transfer-Encoding: chunked\r\n" in header and b"Content-Length" not in header
+    assert b"Connection: keep-alive\r\n" in header
+    assert received(header, data) == header + b"2\r\nab\r\n2\r\ncd\r\n0\r\n\r\n"
+    assert body_length(data) == 4 and state['closed']
+    # KNOWN LENGTH, FROM A FILE-LIKE OBJECT
+    (header, data) = stream_response(parsed("GET /log HTTP/1.1\r\n\r\n"), io.BytesIO(b"x" * 100000), True,
+                                     length=100000)
+    assert b"Content-Length: 100000\r\n" in header and b"Transfer-Encoding" not in header
+    assert received(header, data) == header + b"x" * 100000
+    # HTTP/1.0: UNTIL THE CONNECTION IS CLOSED
+    METHODS["POST"] = lambda req, keep_alive: stream_response(req, [b"abc"], keep_alive)
+    (header, data, keep_alive) = handle_request("POST /log HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+    del METHODS["POST"]
+    assert b"Connection: close\r\n" in header and b"Transfer-Encoding" not in header and not keep_alive
+    assert received(header, data) == header + b"abc"
+    # MAPPED FILE SENT WITH THE HEADER WITHOUT BEING COPIED, WHATEVER THE SOCKET TAKES AT ONCE
+    mapped = memoryview(mmap.mmap(-1, 100000))
+    mapped[:5] = b"begin"
+
+    class Socket:
+        def __init__(self):
+            (self.calls, self.sent) = ([], b"")
+
+        def sendmsg(self, buffers):
+            self.calls.append(list(buffers))
+            self.sent += b"".join(buffers)[:30000]
+            return min(30000, sum(buffer.nbytes for buffer in buffers))
+
+    sock = Socket()
+    send_response(sock, b"header", mapped)
+    assert sock.sent == b"header" + mapped and len(sock.calls) == 4
+    assert sock.calls[0][1].obj is mapped.obj and sock.calls[-1][0].obj is mapped.obj
+    assert received(b"header", mapped) == b"header" + mapped
+
+    # THE SOURCE IS ONLY READ AS FAST AS THE CLIENT RECEIVES
+    state = {'produced': 0, 'closed': False}
+    (header, data) = stream_response(parsed("GET /log HTTP/1.1\r\n\r\n"),
+                                     produce((b"x" * STREAM_CHUNK for i in range(1000)), state), True)
+    (server_side, client_side) = socket.socketpair()
+    for sock in (server_side, client_side):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+
+    def sender():
+        try:
+            send_response(server_side, header, data)
+        except OSError:
+            pass
+
+    thread = threading.Thread(target=sender)
+    thread.start()
+    client_side.recv(STREAM_CHUNK)
+    time.sleep(0.2)
+    assert state['produced'] < 20
+    # CLIENT GONE: THE SOURCE IS CLOSED
+    client_side.close()
+    thread.join()
+    server_side.close()
+    assert state['closed'] and state['produced'] < 20
+    print("Test stream_response OK")
+
     return
 
 
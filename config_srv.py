@@ -2,54 +2,314 @@
 # -*- coding: utf-8 -*-
 
 # System modules
+import ast
+import configparser
+import json
 import os
 import threading
+import types
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11
+    tomllib = None
+
+DEFAULTS = {'Host': '', 'Port': 8000, 'Path': os.getcwd() + '/html/',
+            'KeepAliveTimeout': 5, 'KeepAliveMax': 100,
+            # Largest request header accepted, and seconds given to a client to send it once started
+            'MaxHeaderSize': 16 * 1024, 'RequestTimeout': 10,
+            # "thread": one thread per connection, "asyncio": one event loop for every connection
+            'Engine': 'thread',
+            # Threads serving the connections, accepted connections waiting for one of them,
+            # and what to do when the waiting queue is full: "block" the accept loop or answer "503"
+            'Workers': 32, 'QueueSize': 128, 'QueuePolicy': 'block',
+            # Worker processes (0: one per CPU, 1: no pre-fork), each binding its own socket with SO_REUSEPORT
+            # or sharing the listening socket of the master
+            'Processes': 1, 'ReusePort': True,
+            # File content cache bounds, in bytes and in number of files
+            'CacheMaxBytes': 64 * 1024 * 1024, 'CacheMaxEntries': 1024, 'CacheMaxFileSize': 1024 * 1024,
+            # Files from this size are streamed with sendfile instead of being read in memory
+            'SendfileThreshold': 1024 * 1024,
+            # Read the document root at startup (and on SIGHUP): files smaller than PreloadMaxFileSize in memory,
+            # up to PreloadMaxBytes, the bigger ones below SendfileThreshold mapped with mmap
+            'Preload': False, 'PreloadMaxFileSize': 256 * 1024, 'PreloadMaxBytes': 64 * 1024 * 1024,
+            # Access log file, "-" for the standard output, None to disable it, in the "combined" Log Format
+            # or "json" lines, written in batches every AccessLogFlushInterval seconds by a thread, rotated at
+            # AccessLogMaxBytes keeping AccessLogBackups old files, lines dropped beyond AccessLogQueueSize waiting
+            'AccessLog': '-', 'AccessLogFormat': 'combined', 'AccessLogFlushInterval': 1,
+            'AccessLogMaxBytes': 10 * 1024 * 1024, 'AccessLogBackups': 5, 'AccessLogQueueSize': 100000,
+            # Display the processing of each request
+            'Debug': False,
+            # Connections served at once for each client IP address (0: no limit), answered 503 beyond,
+            # and requests per second of each client after a burst of RateBurst (0: no limit), answered 429 beyond,
+            # remembered for the RateLimitEntries most recent clients; each process of the pre-fork mode counts its own
+            'MaxConnectionsPerIP': 0, 'RateLimit': 0, 'RateBurst': 100, 'RateLimitEntries': 65536,
+            # Requests forwarded to upstream servers by target prefix: {"/api/": ["127.0.0.1:9000", ...]},
+            # balanced "round-robin" or "least-connections" between the healthy servers below UpstreamMaxConnections,
+            # UpstreamPoolSize idle connections kept open to each, UpstreamHealthPath asked every UpstreamHealthInterval
+            # seconds (0 to not check) and UpstreamTimeout seconds to connect or answer
+            'Upstreams': {}, 'UpstreamBalancing': 'round-robin', 'UpstreamMaxConnections': 256, 'UpstreamPoolSize': 16,
+            'UpstreamHealthPath': '/', 'UpstreamHealthInterval': 5, 'UpstreamTimeout': 30,
+            # Accept HTTP/2 without TLS (h2c), from clients with prior knowledge or upgrading an HTTP/1.1 request,
+            # with at most Http2MaxStreams requests at once on a connection
+            'Http2': True, 'Http2MaxStreams': 100,
+            # HTTPS with this certificate chain and private key (None: in the certificate file) in PEM, None for HTTP,
+            # the returning clients resuming their session with a ticket when TlsSessionTickets is True
+            # or by session ID, and seconds given to a client for its handshake
+            'TlsCertificate': None, 'TlsKey': None, 'TlsSessionTickets': True, 'TlsHandshakeTimeout': 10,
+            # Target answering the metrics in the Prometheus text format, None to disable it
+            'MetricsPath': '/__metrics',
+            # List the directories without index.html, AutoIndexPageSize entries per page,
+            # the entries of ListingCacheEntries directories being kept until they change
+            'AutoIndex': False, 'AutoIndexPageSize': 1000, 'ListingCacheEntries': 64,
+            # Request targets resolved to files, and seconds their file status is trusted
+            'PathCacheEntries': 4096, 'PathCacheTTL': 1,
+            # Cache-Control max-age in seconds by directory ("/test/") or extension (".png")
+            'MaxAge': {'.gif': 86400, '.jpg': 86400, '.png': 86400, '.svg': 86400, '.pdf': 86400},
+            'DefaultMaxAge': 0,
+            # Compress text files of at least CompressMinSize bytes when the client accepts it
+            'Compression': True, 'CompressMinSize': 256, 'GzipLevel': 6,
+            # Seconds between two checks of the configuration file given to the server, 0 to not watch it
+            'ConfigPollInterval': 1}
+
+
+def freeze(value):
+    """
+    Make a value of the configuration read-only
+    :param value: value
+    :return: the value, a read-only copy for the dicts
+    """
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return types.MappingProxyType(dict(value))
+    return value
+
+
+# Settings set to None to disable them, besides the ones None by default
+DISABLEABLE = {'AccessLog', 'MetricsPath'} | {key for (key, value) in DEFAULTS.items() if value is None}
 
-CONFIGURATION = {'Host': '', 'Port': 8000, 'Path': os.getcwd() + '/html/'}
+# Snapshot of the configuration, never modified: read it without lock,
+# update() replaces it as a whole, so a reader sees either the old or the new configuration.
+# Read it as config_srv.CONFIGURATION, a name imported from this module would keep the first snapshot.
+CONFIGURATION = types.MappingProxyType({key: freeze(value) for (key, value) in DEFAULTS.items()})
 
+# Serializes the updates, the readers never take it
 lock = threading.Lock()
+# Configuration file given to load, and its (mtime, size) when it was read
+source = None
+source_version = None
+# Values given by override, applied again over the file by load and reload
+overrides = {}
+watcher = None
+
+
+def update(values):
+    """
+    Replace the configuration by a new snapshot with some values changed.
+    A value must have the type of the default one, ints and floats being interchangeable but not bools,
+    and None allowed only for the settings which can be disabled (DISABLEABLE).
+    :param values: key -> new value
+    :type values: dict
+    :return: None
+    :rtype: None
+    :raise: KeyError for an unknown key, TypeError for a value of the wrong type
+    """
+    global CONFIGURATION
+    with lock:
+        CONFIGURATION = types.MappingProxyType(changed(CONFIGURATION, values))
+    return None
+
+
+def changed(configuration, values):
+    """
+    Check new values and apply them to a copy of a configuration
+    :param configuration: key -> value
+    :type configuration: Mapping
+    :param values: key -> new value
+    :type values: dict
+    :return: the new configuration
+    :rtype: dict
+    :raise: KeyError for an unknown key, TypeError for a value of the wrong type
+    """
+    new = dict(configuration)
+    for (key, value) in values.items():
+        if key not in new:
+            raise KeyError(key)
+        default = DEFAULTS[key]
+        if value is None:
+            if key not in DISABLEABLE:
+                raise TypeError(key + " can't be None")
+        elif not (default is None or type(value) is type(default)
+                  or type(value) in (int, float) and type(default) in (int, float)
+                  or isinstance(value, types.MappingProxyType) and type(default) is dict):
+            raise TypeError(key + " must be of type " + type(default).__name__)
+        new[key] = freeze(value)
+    return new
+
+
+def override(values):
+    """
+    Change some values like update, and keep them over the configuration file when it is loaded again,
+    like the settings given on the command line
+    :param values: key -> new value
+    :type values: dict
+    :return: None
+    :rtype: None
+    :raise: KeyError for an unknown key, TypeError for a value of the wrong type
+    """
+    update(values)
+    with lock:
+        overrides.update(values)
+    return None
 
 
 def get_config(key):
     """
     return the specific config key value
     """
-    lock.acquire()
     try:
-        key_val = CONFIGURATION[key]
-    except KeyError:
-        key_val = None
-    except OSError:
-        key_val = None
-        print("Fatal Error")
-    finally:
-        # Always called, even if exception is raised in try block
-        lock.release()
-    return key_val
+        return CONFIGURATION[key]
+    except (KeyError, TypeError):
+        return None
 
 
 def set_config(key, value):
     """
     change the specific config key value
     """
-    lock.acquire()
+    if type(value) is not str and type(value) is not int:
+        return False
     try:
-        if key not in CONFIGURATION:
-            return False
-        if type(value) is not str and type(value) is not int:
-            return False
-        CONFIGURATION[key] = value
-    except KeyError:
+        update({key: value})
+    except (KeyError, TypeError):
         return False
-    except OSError:
-        print("Fatal Error")
+    return True
+
+
+def parse_value(text):
+    """
+    Get the value of a setting written in an INI file
+    :param text: value as written, like 8000, 0.5, True, None or /var/www/
+    :type text: str
+    :return: the Python literal, the text itself when it is not one
+    """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def read_file(path):
+    """
+    Read the settings of a configuration file, by its extension: .toml, .json, or .ini (.cfg, .conf).
+    Settings have the names of CONFIGURATION, they may be grouped in tables or sections like [server].
+    :param path: configuration file
+    :type path: str
+    :return: key -> value
+    :rtype: dict
+    :raise: OSError, ValueError
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".toml":
+        if tomllib is None:
+            raise ValueError("TOML configuration files need Python 3.11")
+        with open(path, "rb") as file:
+            document = tomllib.load(file)
+    elif extension == ".json":
+        with open(path, encoding="utf-8") as file:
+            document = json.load(file)
+    elif extension in (".ini", ".cfg", ".conf"):
+        parser = configparser.ConfigParser(interpolation=None)
+        # Keep the case of the names
+        parser.optionxform = str
+        try:
+            parser.read(path, encoding="utf-8")
+        except configparser.Error as e:
+            raise ValueError(str(e))
+        document = {section: {key: parse_value(value) for (key, value) in parser.items(section)}
+                    for section in parser.sections()}
+    else:
+        raise ValueError("Unknown configuration file type: " + path)
+    values = {}
+    for (key, value) in document.items():
+        if key not in DEFAULTS and isinstance(value, dict):
+            # Table or section
+            values.update(value)
+        else:
+            values[key] = value
+    if isinstance(values.get('Path'), str) and not values['Path'].endswith("/"):
+        values['Path'] += "/"
+    return values
+
+
+def load(path):
+    """
+    Build the configuration from the default values, the settings of a configuration file
+    and the overrides, and remember the file for reload and watch.
+    A setting removed from the file gets its default value back.
+    :param path: configuration file
+    :type path: str
+    :return: None
+    :rtype: None
+    :raise: OSError, ValueError, KeyError, TypeError
+    """
+    global CONFIGURATION, source, source_version
+    st = os.stat(path)
+    values = read_file(path)
+    with lock:
+        defaults = {key: freeze(value) for (key, value) in DEFAULTS.items()}
+        CONFIGURATION = types.MappingProxyType(changed(changed(defaults, values), overrides))
+    (source, source_version) = (path, (st.st_mtime_ns, st.st_size))
+    return None
+
+
+def reload():
+    """
+    Apply the configuration file again, the current configuration is kept if it is invalid
+    :return: True if the configuration was reloaded
+    :rtype: bool
+    """
+    if source is None:
+        return False
+    try:
+        load(source)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("Configuration not reloaded from", source + ":", repr(e))
         return False
-    finally:
-        # Always called, even if exception is raised in try block
-        lock.release()
+    print("Configuration reloaded from", source)
     return True
 
 
+def watch_forever():
+    """
+    Reload the configuration file each time it changes, checked every ConfigPollInterval seconds
+    :return: None
+    :rtype: None
+    """
+    event = threading.Event()
+    while not event.wait(CONFIGURATION['ConfigPollInterval']):
+        try:
+            st = os.stat(source)
+        except OSError:
+            continue
+        if (st.st_mtime_ns, st.st_size) != source_version:
+            reload()
+
+
+def watch():
+    """
+    Start watching the configuration file given to load, in each process using it:
+    the thread of the parent is not in the forked processes
+    :return: None
+    :rtype: None
+    """
+    global watcher
+    if source is None or not CONFIGURATION['ConfigPollInterval']:
+        return None
+    watcher = threading.Thread(target=watch_forever, daemon=True)
+    watcher.start()
+    return None
+
+
 def main():
 
     # Test get_config function working with thread
@@ -151,6 +411,81 @@ def main():
 
     print("Test set_config OK")
 
+    # ----- update()
+
+    snapshot = CONFIGURATION
+    update({'Port': 8080, 'KeepAliveTimeout': 0.5, 'MetricsPath': None})
+    # READERS HOLDING THE OLD SNAPSHOT DON'T SEE THE UPDATE
+    assert snapshot['Port'] != 8080 and CONFIGURATION['Port'] == 8080 and CONFIGURATION['MetricsPath'] is None
+    try:
+        CONFIGURATION['Port'] = 1
+        assert False
+    except TypeError:
+        pass
+    update({'MaxAge': {'.png': 60}})
+    try:
+        CONFIGURATION['MaxAge']['.png'] = 1
+        assert False
+    except TypeError:
+        pass
+    # NONE ONLY FOR THE SETTINGS WHICH CAN BE DISABLED, NO BOOL FOR A NUMBER OR NUMBER FOR A BOOL
+    update({'AccessLog': None, 'TlsCertificate': None})
+    update({'AccessLog': '-', 'TlsCertificate': "cert.pem", 'Debug': False})
+    update({'TlsCertificate': None})
+    for values in ({'Port': "80"}, {'Nope': 1}, {'Port': 80, 'Workers': "many"}, {'Port': None},
+                   {'Path': None}, {'Port': True}, {'KeepAliveTimeout': False}, {'Debug': 1}):
+        try:
+            update(values)
+            assert False
+        except (KeyError, TypeError):
+            pass
+    # NOTHING CHANGED BY AN UPDATE REFUSED
+    assert CONFIGURATION['Port'] == 8080
+    print("Test update OK")
+
+    # ----- read_file() / load() / reload()
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        files = {"server.toml": '[server]\nPort = 9000\nPath = "/srv/www"\nMaxAge = {".css" = 3600}\n',
+                 "server.json": '{"Port": 9000, "Path": "/srv/www", "MaxAge": {".css": 3600}}',
+                 "server.ini": "[server]\nPort = 9000\nPath = /srv/www\nMaxAge = {'.css': 3600}\n"}
+        for (name, text) in files.items():
+            path = os.path.join(directory, name)
+            with open(path, "w") as file:
+                file.write(text)
+            if name.endswith(".toml") and tomllib is None:
+                continue
+            assert read_file(path) == {'Port': 9000, 'Path': "/srv/www/", 'MaxAge': {".css": 3600}}
+        load(path)
+        assert CONFIGURATION['Port'] == 9000 and CONFIGURATION['MaxAge'] == {".css": 3600}
+        # INVALID FILE, THE CONFIGURATION IS KEPT
+        with open(path, "w") as file:
+            file.write("[server]\nPort = nine\n")
+        assert reload() is False and CONFIGURATION['Port'] == 9000
+        with open(path, "w") as file:
+            file.write("[server]\nPort = 9001\n")
+        assert reload() is True and CONFIGURATION['Port'] == 9001
+        # A SETTING REMOVED FROM THE FILE GETS ITS DEFAULT VALUE BACK, THE OVERRIDES ARE KEPT
+        assert CONFIGURATION['MaxAge'] == DEFAULTS['MaxAge'] and CONFIGURATION['Path'] == DEFAULTS['Path']
+        assert isinstance(CONFIGURATION['MaxAge'], types.MappingProxyType)
+        override({'Host': "example.com"})
+        update({'KeepAliveMax': 7})
+        assert reload() is True and CONFIGURATION['Host'] == "example.com"
+        assert CONFIGURATION['KeepAliveMax'] == DEFAULTS['KeepAliveMax']
+        overrides.clear()
+        # CHANGE OF THE FILE WATCHED
+        update({'ConfigPollInterval': 0.05})
+        watch()
+        with open(path, "w") as file:
+            file.write("[server]\nPort = 9002\nKeepAliveMax = 5\n")
+        for i in range(100):
+            if CONFIGURATION['Port'] == 9002:
+                break
+            threading.Event().wait(0.05)
+        assert CONFIGURATION['Port'] == 9002 and CONFIGURATION['KeepAliveMax'] == 5
+    print("Test load OK")
+
 
 if __name__ == "__main__":
     main()
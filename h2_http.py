@@ -0,0 +1,1030 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import base64
+import concurrent.futures
+import functools
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+# Internal modules
+import client_http
+import config_srv
+import hpack_http
+import limit_http
+import log_http
+import metrics_http
+import proxy_http
+
+# Start of the connection preface of HTTP/2 clients, read like an HTTP/1 request header,
+# and the rest of it
+PREFACE_REQUEST = "PRI * HTTP/2.0\r\n\r\n"
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+PREFACE_END = b"SM\r\n\r\n"
+# Answer to an HTTP/1.1 request asking to upgrade to h2c
+SWITCHING = b"HTTP/1.1 101 Switching Protocols\r\nConnection: Upgrade\r\nUpgrade: h2c\r\n\r\n"
+
+# Frame types
+(DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, GOAWAY, WINDOW_UPDATE,
+ CONTINUATION) = range(10)
+PRIORITY_UPDATE = 0x10
+# Frame flags
+END_STREAM = ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+# Settings
+(HEADER_TABLE_SIZE, ENABLE_PUSH, MAX_CONCURRENT_STREAMS, INITIAL_WINDOW_SIZE, MAX_FRAME_SIZE,
+ MAX_HEADER_LIST_SIZE) = range(1, 7)
+# Error codes
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+INTERNAL_ERROR = 0x2
+FLOW_CONTROL_ERROR = 0x3
+STREAM_CLOSED = 0x5
+FRAME_SIZE_ERROR = 0x6
+REFUSED_STREAM = 0x7
+COMPRESSION_ERROR = 0x9
+ENHANCE_YOUR_CALM = 0xb
+HTTP_1_1_REQUIRED = 0xd
+
+# Default frame size and flow control window of the protocol
+FRAME_SIZE = 16384
+WINDOW_SIZE = 65535
+MAX_WINDOW = 2 ** 31 - 1
+# Bytes given to the socket at once, before looking for frames received
+SEND_BUDGET = 256 * 1024
+# Header fields of HTTP/1 connections, forbidden in HTTP/2
+CONNECTION_FIELDS = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade"}
+# Priority of the streams without priority field (RFC 9218), from 0 (highest) to 7, and RFC 7540 weight
+DEFAULT_URGENCY = 3
+DEFAULT_WEIGHT = 16
+
+
+class ProtocolError(Exception):
+    """
+    Error closing the whole connection, with the error code sent in GOAWAY
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class Stream:
+    """
+    Request of a connection and the response being sent
+    """
+    __slots__ = ("id", "window", "parts", "urgency", "weight", "virtual", "code", "length", "request", "started",
+                 "producing")
+
+    def __init__(self, stream_id, window, virtual):
+        self.id = stream_id
+        # Bytes of DATA the client accepts on this stream
+        self.window = window
+        # Response body left to send: memoryview, client_http.FileRange and BodyStream, None before the response
+        self.parts = None
+        self.urgency = DEFAULT_URGENCY
+        self.weight = DEFAULT_WEIGHT
+        # Bytes sent divided by the weight: the streams of an urgency which sent the least go first
+        self.virtual = virtual
+        self.code = None
+        self.length = 0
+        # Request line and fields of the access log
+        self.request = None
+        self.started = time.perf_counter()
+        # The engine is reading the next chunk of the BodyStream first in parts
+        self.producing = False
+
+    def take(self, size):
+        """
+        Take at most size bytes of the response body, from the memory or read from the file,
+        up to a BodyStream whose next chunk is not produced yet
+        :type size: int
+        :return: the bytes, empty when the body is over
+        :rtype: bytes
+        """
+        while self.parts:
+            part = self.parts[0]
+            if isinstance(part, client_http.BodyStream):
+                return b""
+            if isinstance(part, client_http.FileRange):
+                data = os.pread(part.file.fileno(), min(size, part.count), part.offset) if part.count else b""
+                part.offset += len(data)
+                part.count -= len(data)
+                if not data or not part.count:
+                    part.file.close()
+                    self.parts.pop(0)
+            else:
+                data = part[:size]
+                if len(part) > size:
+                    self.parts[0] = part[size:]
+                else:
+                    self.parts.pop(0)
+            if data:
+                return bytes(data)
+        return b""
+
+    def close(self):
+        """
+        Close the files of a response not sent entirely,
+        except the BodyStream being read, closed by Connection.produced once its chunk is read
+        :return: None
+        :rtype: None
+        """
+        client_http.close_body((self.parts or [])[1 if self.producing else 0:])
+        self.parts = None
+        return None
+
+
+def frame(frame_type, flags, stream_id, payload=b""):
+    """
+    :return: the frame with its header
+    :rtype: bytes
+    """
+    return len(payload).to_bytes(3, "big") + bytes((frame_type, flags)) + stream_id.to_bytes(4, "big") + payload
+
+
+def response_fields(header):
+    """
+    Turn an HTTP/1 response header built by client_http into HTTP/2 fields
+    :param header: response header
+    :type header: bytes
+    :return: status code and the fields, :status first
+    :rtype: tuple
+    """
+    lines = header.decode("utf-8").split("\r\n")
+    code = int(lines[0][9:12])
+    fields = [(":status", str(code))]
+    for line in lines[1:]:
+        (name, colon, value) = line.partition(":")
+        name = name.lower()
+        if colon and name not in CONNECTION_FIELDS:
+            fields.append((name, value.strip()))
+    return code, fields
+
+
+class Connection:
+    """
+    State of an HTTP/2 connection, independent of the engine: the bytes received are given to receive,
+    the bytes to send are taken from data_to_send.
+    Requests are answered by the handlers of client_http as soon as their header is received,
+    the responses being sent in DATA frames interleaved by priority within the flow control windows.
+    """
+
+    def __init__(self, address, preface=PREFACE):
+        self.address = address
+        # Bytes of the preface still expected from the client
+        self.preface = preface
+        self.inbound = bytearray()
+        # Frames waiting to be sent before any DATA
+        self.outbound = []
+        # Stream id -> Stream being answered
+        self.streams = {}
+        self.last_stream = 0
+        self.decoder = hpack_http.Decoder()
+        self.encoder = hpack_http.Encoder()
+        # Bytes of DATA the client accepts on the connection, and on each new stream
+        self.window = WINDOW_SIZE
+        self.initial_window = WINDOW_SIZE
+        self.max_frame = FRAME_SIZE
+        # (stream id, END_STREAM, header block fragments) of a header block continued in CONTINUATION frames
+        self.continued = None
+        self.clock = 0.0
+        # GOAWAY received, no new stream
+        self.going_away = False
+        # GOAWAY sent, the connection is closed once it is sent
+        self.closed = False
+        settings = b"".join(key.to_bytes(2, "big") + value.to_bytes(4, "big") for (key, value) in (
+            (MAX_CONCURRENT_STREAMS, config_srv.CONFIGURATION['Http2MaxStreams']),
+            (MAX_HEADER_LIST_SIZE, config_srv.CONFIGURATION['MaxHeaderSize'])))
+        self.outbound.append(frame(SETTINGS, 0, 0, settings))
+
+    def upgrade(self, method, target, fields, settings):
+        """
+        Answer on stream 1 the HTTP/1.1 request which asked for h2c, after the 101 response
+        :param method: method of the request
+        :type method: str
+        :param target: target of the request
+        :type target: str
+        :param fields: (name, value) fields of the request
+        :type fields: list
+        :param settings: payload of the HTTP2-Settings field
+        :type settings: bytes
+        :return: None
+        :rtype: None
+        """
+        self.outbound.insert(0, SWITCHING)
+        try:
+            self.settings(settings)
+        except ProtocolError as e:
+            self.close(e.code)
+            return None
+        self.last_stream = 1
+        stream = Stream(1, self.initial_window, self.clock)
+        self.streams[1] = stream
+        headers = [(":method", method), (":path", target), (":scheme", "http"),
+                   (":authority", proxy_http.field(fields, "host"))]
+        self.respond(stream, headers + [(name.lower(), value) for (name, value) in proxy_http.relayed(fields)
+                                        if name.lower() not in ("http2-settings", "host")])
+        return None
+
+    def receive(self, data):
+        """
+        Handle the bytes received from the client
+        :type data: bytes
+        :return: None
+        :rtype: None
+        """
+        if self.closed:
+            return None
+        self.inbound += data
+        try:
+            if self.preface:
+                expected = self.preface[:len(self.inbound)]
+                if not self.inbound.startswith(expected):
+                    raise ProtocolError(PROTOCOL_ERROR, "Invalid connection preface")
+                del self.inbound[:len(expected)]
+                self.preface = self.preface[len(expected):]
+                if self.preface:
+                    return None
+            while len(self.inbound) >= 9:
+                length = int.from_bytes(self.inbound[:3], "big")
+                if length > FRAME_SIZE:
+                    raise ProtocolError(FRAME_SIZE_ERROR, "Frame larger than SETTINGS_MAX_FRAME_SIZE")
+                if len(self.inbound) < 9 + length:
+                    break
+                (frame_type, flags) = (self.inbound[3], self.inbound[4])
+                stream_id = int.from_bytes(self.inbound[5:9], "big") & MAX_WINDOW
+                payload = bytes(self.inbound[9:9 + length])
+                del self.inbound[:9 + length]
+                self.handle(frame_type, flags, stream_id, payload)
+        except ProtocolError as e:
+            log_http.debug("HTTP/2 connection error: " + str(e))
+            self.close(e.code)
+        return None
+
+    def handle(self, frame_type, flags, stream_id, payload):
+        """
+        Handle a frame received
+        :raise: ProtocolError
+        """
+        if self.continued is not None and (frame_type != CONTINUATION or stream_id != self.continued[0]):
+            raise ProtocolError(PROTOCOL_ERROR, "Header block interrupted")
+        if frame_type in (DATA, HEADERS, PRIORITY, RST_STREAM, CONTINUATION) and stream_id == 0:
+            raise ProtocolError(PROTOCOL_ERROR, "Frame on stream 0")
+        if frame_type in (SETTINGS, PING, GOAWAY) and stream_id != 0:
+            raise ProtocolError(PROTOCOL_ERROR, "Connection frame on a stream")
+        if frame_type == DATA:
+            self.data(flags, stream_id, payload)
+        elif frame_type == HEADERS:
+            if stream_id % 2 == 0:
+                raise ProtocolError(PROTOCOL_ERROR, "Stream initiated with an even id")
+            payload = self.unpad(flags, payload)
+            weight = None
+            if flags & PRIORITY_FLAG:
+                if len(payload) < 5:
+                    raise ProtocolError(FRAME_SIZE_ERROR, "Truncated priority")
+                weight = payload[4] + 1
+                payload = payload[5:]
+            self.continued = (stream_id, flags & END_STREAM, [payload], weight)
+            if flags & END_HEADERS:
+                self.headers()
+        elif frame_type == CONTINUATION:
+            if self.continued is None:
+                raise ProtocolError(PROTOCOL_ERROR, "CONTINUATION without HEADERS")
+            self.continued[2].append(payload)
+            if sum(len(fragment) for fragment in self.continued[2]) > config_srv.CONFIGURATION['MaxHeaderSize']:
+                raise ProtocolError(ENHANCE_YOUR_CALM, "Header block too large")
+            if flags & END_HEADERS:
+                self.headers()
+        elif frame_type == PRIORITY:
+            if len(payload) != 5:
+                raise ProtocolError(FRAME_SIZE_ERROR, "PRIORITY frame of %d bytes" % len(payload))
+            if stream_id in self.streams:
+                self.streams[stream_id].weight = payload[4] + 1
+        elif frame_type == PRIORITY_UPDATE:
+            if len(payload) < 4:
+                raise ProtocolError(FRAME_SIZE_ERROR, "Truncated PRIORITY_UPDATE frame")
+            stream = self.streams.get(int.from_bytes(payload[:4], "big") & MAX_WINDOW)
+            if stream is not None:
+                stream.urgency = urgency(payload[4:].decode("latin-1"))
+        elif frame_type == RST_STREAM:
+            if len(payload) != 4:
+                raise ProtocolError(FRAME_SIZE_ERROR, "RST_STREAM frame of %d bytes" % len(payload))
+            if stream_id > self.last_stream:
+                raise ProtocolError(PROTOCOL_ERROR, "RST_STREAM on an idle stream")
+            stream = self.streams.pop(stream_id, None)
+            if stream is not None:
+                stream.close()
+                self.finish(stream)
+        elif frame_type == SETTINGS:
+            if flags & ACK:
+                if payload:
+                    raise ProtocolError(FRAME_SIZE_ERROR, "SETTINGS acknowledgement with a payload")
+                return None
+            self.settings(payload)
+            self.outbound.append(frame(SETTINGS, ACK, 0))
+        elif frame_type == PING:
+            if len(payload) != 8:
+                raise ProtocolError(FRAME_SIZE_ERROR, "PING frame of %d bytes" % len(payload))
+            if not flags & ACK:
+                self.outbound.append(frame(PING, ACK, 0, payload))
+        elif frame_type == GOAWAY:
+            self.going_away = True
+            if not self.streams:
+                self.close(NO_ERROR)
+        elif frame_type == WINDOW_UPDATE:
+            if len(payload) != 4:
+                raise ProtocolError(FRAME_SIZE_ERROR, "WINDOW_UPDATE frame of %d bytes" % len(payload))
+            increment = int.from_bytes(payload, "big") & MAX_WINDOW
+            if stream_id == 0:
+                if increment == 0:
+                    raise ProtocolError(PROTOCOL_ERROR, "WINDOW_UPDATE of 0")
+                self.window += increment
+                if self.window > MAX_WINDOW:
+                    raise ProtocolError(FLOW_CONTROL_ERROR, "Connection window too large")
+            elif stream_id in self.streams:
+                stream = self.streams[stream_id]
+                stream.window += increment
+                if increment == 0 or stream.window > MAX_WINDOW:
+                    self.reset(stream, PROTOCOL_ERROR if increment == 0 else FLOW_CONTROL_ERROR)
+        # Other frame types are ignored, PUSH_PROMISE included since clients don't push
+        return None
+
+    @staticmethod
+    def unpad(flags, payload):
+        """
+        :return: the payload of a DATA or HEADERS frame without its padding
+        :rtype: bytes
+        :raise: ProtocolError
+        """
+        if not flags & PADDED:
+            return payload
+        if not payload or payload[0] >= len(payload):
+            raise ProtocolError(PROTOCOL_ERROR, "Invalid padding")
+        return payload[1:len(payload) - payload[0]]
+
+    def data(self, flags, stream_id, payload):
+        """
+        Handle a DATA frame: request bodies are not used, the client may send more at once
+        """
+        if stream_id > self.last_stream:
+            raise ProtocolError(PROTOCOL_ERROR, "DATA on an idle stream")
+        self.unpad(flags, payload)
+        if payload:
+            # The whole frame, padding included, counts for the flow control
+            self.outbound.append(frame(WINDOW_UPDATE, 0, 0, len(payload).to_bytes(4, "big")))
+            if stream_id in self.streams and not flags & END_STREAM:
+                self.outbound.append(frame(WINDOW_UPDATE, 0, stream_id, len(payload).to_bytes(4, "big")))
+        return None
+
+    def settings(self, payload):
+        """
+        Apply the settings of the client
+        :type payload: bytes
+        :raise: ProtocolError
+        """
+        if len(payload) % 6:
+            raise ProtocolError(FRAME_SIZE_ERROR, "SETTINGS frame of %d bytes" % len(payload))
+        for position in range(0, len(payload), 6):
+            key = int.from_bytes(payload[position:position + 2], "big")
+            value = int.from_bytes(payload[position + 2:position + 6], "big")
+            if key == HEADER_TABLE_SIZE:
+                self.encoder.resize(value)
+            elif key == ENABLE_PUSH and value > 1:
+                raise ProtocolError(PROTOCOL_ERROR, "Invalid SETTINGS_ENABLE_PUSH")
+            elif key == INITIAL_WINDOW_SIZE:
+                if value > MAX_WINDOW:
+                    raise ProtocolError(FLOW_CONTROL_ERROR, "Invalid SETTINGS_INITIAL_WINDOW_SIZE")
+                for stream in self.streams.values():
+                    stream.window += value - self.initial_window
+                self.initial_window = value
+            elif key == MAX_FRAME_SIZE:
+                if not FRAME_SIZE <= value <= 2 ** 24 - 1:
+                    raise ProtocolError(PROTOCOL_ERROR, "Invalid SETTINGS_MAX_FRAME_SIZE")
+                self.max_frame = value
+        return None
+
+    def headers(self):
+        """
+        Handle a complete header block: a new request, or the trailer of a request body
+        :raise: ProtocolError
+        """
+        (stream_id, end_stream, fragments, weight) = self.continued
+        self.continued = None
+        try:
+            fields = self.decoder.decode(b"".join(fragments))
+        except ValueError as e:
+            raise ProtocolError(COMPRESSION_ERROR, str(e))
+        if stream_id <= self.last_stream:
+            if end_stream:
+                # Trailer of a request body, its response may be sent already
+                return None
+            raise ProtocolError(STREAM_CLOSED, "HEADERS on a closed stream")
+        self.last_stream = stream_id
+        stream = Stream(stream_id, self.initial_window, self.clock)
+        if weight is not None:
+            stream.weight = weight
+        if self.going_away:
+            return None
+        if len(self.streams) >= config_srv.CONFIGURATION['Http2MaxStreams']:
+            self.reset(stream, REFUSED_STREAM)
+            return None
+        self.streams[stream_id] = stream
+        self.respond(stream, fields)
+        return None
+
+    def respond(self, stream, fields):
+        """
+        Answer the request of a stream with the handlers of client_http
+        :type stream: Stream
+        :param fields: decoded (name, value) fields
+        :type fields: list
+        :return: None
+        :rtype: None
+        """
+        pseudo = {}
+        headers = {}
+        size = 0
+        for (name, value) in fields:
+            size += len(name) + len(value) + hpack_http.ENTRY_OVERHEAD
+            if name.startswith(":"):
+                if headers or name not in (":method", ":path", ":scheme", ":authority") or name in pseudo:
+                    return self.reset(stream, PROTOCOL_ERROR)
+                pseudo[name] = value
+            elif name != name.lower() or name in CONNECTION_FIELDS or name == "te" and value != "trailers":
+                return self.reset(stream, PROTOCOL_ERROR)
+            elif name in headers:
+                headers[name] += ("; " if name == "cookie" else ", ") + value
+            else:
+                headers[name] = value
+        if not all(name in pseudo for name in (":method", ":path", ":scheme")):
+            return self.reset(stream, PROTOCOL_ERROR)
+        if "host" not in headers and ":authority" in pseudo:
+            headers["host"] = pseudo[":authority"]
+        (method, target) = (pseudo[":method"], pseudo[":path"])
+        stream.request = "%s %s HTTP/2.0\r\n" % (method, target) + "".join(
+            "%s: %s\r\n" % (name, headers[name]) for name in ("referer", "user-agent") if name in headers)
+        if "priority" in headers:
+            stream.urgency = urgency(headers["priority"])
+        if proxy_http.route(stream.request) is not None:
+            # The upstream servers are reached by HTTP/1.1 connections
+            return self.reset(stream, HTTP_1_1_REQUIRED)
+        if size > config_srv.CONFIGURATION['MaxHeaderSize']:
+            code = 431
+        elif not limit_http.allow(self.address):
+            code = 429
+        elif method not in client_http.METHODS:
+            code = 405
+        else:
+            code = 200
+        if code == 200:
+            (header, data) = client_http.METHODS[method](client_http.Request(method, target, "1.1", headers), False)
+        else:
+            data = client_http.gen_data_error(code)
+            extra = [("Allow", client_http.ALLOW)] if code == 405 else None
+            header = client_http.generate_header(code, len(data), extra=extra)
+        (stream.code, response) = response_fields(header)
+        # HTTP/2 frames the body itself, the BodyStream parts are never chunked
+        stream.parts = [part if isinstance(part, (client_http.FileRange, client_http.BodyStream)) else memoryview(part)
+                        for part in (data if isinstance(data, list) else [data])
+                        if isinstance(part, (client_http.FileRange, client_http.BodyStream)) or len(part)]
+        block = self.encoder.encode(response)
+        # Header blocks larger than a frame go on in CONTINUATION frames
+        fragments = [block[i:i + self.max_frame] for i in range(0, len(block), self.max_frame)]
+        flags = (0 if stream.parts else END_STREAM) | (END_HEADERS if len(fragments) == 1 else 0)
+        self.outbound.append(frame(HEADERS, flags, stream.id, fragments[0]))
+        for (i, fragment) in enumerate(fragments[1:], 2):
+            self.outbound.append(frame(CONTINUATION, END_HEADERS if i == len(fragments) else 0, stream.id, fragment))
+        stream.length = len(block)
+        if not stream.parts:
+            del self.streams[stream.id]
+            self.finish(stream)
+        return None
+
+    def reset(self, stream, code):
+        """
+        End a stream with RST_STREAM
+        :type stream: Stream
+        :param code: error code
+        :type code: int
+        :return: None
+        :rtype: None
+        """
+        self.outbound.append(frame(RST_STREAM, 0, stream.id, code.to_bytes(4, "big")))
+        if self.streams.pop(stream.id, None) is not None:
+            stream.close()
+            self.finish(stream)
+        return None
+
+    def finish(self, stream):
+        """
+        Record a stream which ended, answered or not
+        :type stream: Stream
+        :return: None
+        :rtype: None
+        """
+        if stream.code is not None:
+            metrics_http.response(stream.code, stream.length)
+            log_http.access(self.address, stream.request, stream.code, stream.length,
+                            time.perf_counter() - stream.started)
+        if self.going_away and not self.streams:
+            self.close(NO_ERROR)
+        return None
+
+    def close(self, code):
+        """
+        Send GOAWAY and stop answering, the connection being closed once it is sent
+        :param code: error code, NO_ERROR for a graceful end
+        :type code: int
+        :return: None
+        :rtype: None
+        """
+        if self.closed:
+            return None
+        self.outbound.append(frame(GOAWAY, 0, 0, self.last_stream.to_bytes(4, "big") + code.to_bytes(4, "big")))
+        self.closed = True
+        for stream in self.streams.values():
+            stream.close()
+        self.streams.clear()
+        return None
+
+    def next_stream(self):
+        """
+        Choose the stream sending the next DATA frame: the most urgent one,
+        then the one which sent the least for its weight, so that the responses are interleaved
+        :return: the stream, None when no stream can send
+        :rtype: Stream or None
+        """
+        chosen = None
+        for stream in self.streams.values():
+            if stream.parts is None or stream.parts and isinstance(stream.parts[0], client_http.BodyStream):
+                # No response yet, or the next chunk of its body not produced yet
+                continue
+            # A body over only has END_STREAM left to send
+            if stream.window > 0 or not stream.parts:
+                if chosen is None or (stream.urgency, stream.virtual) < (chosen.urgency, chosen.virtual):
+                    chosen = stream
+        return chosen
+
+    def sendable(self):
+        """
+        Tells if data_to_send has something to give without receiving anything
+        :rtype: bool
+        """
+        return bool(self.outbound) or self.window > 0 and self.next_stream() is not None
+
+    def data_to_send(self):
+        """
+        Take the frames to send: the control and HEADERS frames, then DATA frames
+        within the flow control windows, about SEND_BUDGET bytes at most
+        :return: bytes to send, empty when there is nothing to send
+        :rtype: bytes
+        """
+        out = self.outbound
+        self.outbound = []
+        size = sum(len(part) for part in out)
+        while size < SEND_BUDGET and self.window > 0 and not self.closed:
+            stream = self.next_stream()
+            if stream is None:
+                break
+            data = stream.take(min(self.max_frame, self.window, stream.window))
+            end = not stream.parts
+            out.append(frame(DATA, END_STREAM if end else 0, stream.id, data))
+            size += len(data) + 9
+            self.window -= len(data)
+            stream.window -= len(data)
+            stream.length += len(data)
+            self.clock = stream.virtual
+            stream.virtual += len(data) / stream.weight
+            if end:
+                del self.streams[stream.id]
+                self.finish(stream)
+        return b"".join(out)
+
+    def to_produce(self):
+        """
+        Take the BodyStream parts whose next chunk must be read: the ones first in the body left
+        to send of their stream, not being read yet. The engine reads each one out of the loop serving
+        the connection and gives the chunk to produced, so that a slow source only delays its own stream,
+        never more than one chunk ahead of what is sent.
+        :return: (Stream, client_http.BodyStream) pairs
+        :rtype: list
+        """
+        pairs = []
+        for stream in self.streams.values():
+            if stream.parts and not stream.producing and isinstance(stream.parts[0], client_http.BodyStream):
+                stream.producing = True
+                pairs.append((stream, stream.parts[0]))
+        return pairs
+
+    def produced(self, stream, body, chunk):
+        """
+        Give the chunk read by the engine from a BodyStream given by to_produce
+        :type stream: Stream
+        :type body: client_http.BodyStream
+        :param chunk: bytes read, empty at the end of the body, None when the source failed
+        :type chunk: bytes or None
+        :return: None
+        :rtype: None
+        """
+        stream.producing = False
+        if self.streams.get(stream.id) is not stream:
+            # Stream reset or connection ended meanwhile
+            body.close()
+            return None
+        if chunk:
+            body.sent += len(chunk)
+            stream.parts.insert(0, memoryview(chunk))
+            return None
+        body.close()
+        stream.parts.pop(0)
+        if chunk is None:
+            self.reset(stream, INTERNAL_ERROR)
+        return None
+
+    def producing(self):
+        """
+        Tells if a stream waits for the next chunk of its body, the connection not being idle meanwhile
+        :rtype: bool
+        """
+        return any(stream.producing for stream in self.streams.values())
+
+    def release(self):
+        """
+        Close the files of the responses not sent when the connection ends
+        :return: None
+        :rtype: None
+        """
+        for stream in self.streams.values():
+            stream.close()
+        self.streams.clear()
+        return None
+
+
+def urgency(value):
+    """
+    :param value: priority field (RFC 9218), like "u=1, i"
+    :type value: str
+    :return: urgency, from 0 to 7
+    :rtype: int
+    """
+    for parameter in value.split(","):
+        (key, equal, number) = parameter.strip().partition("=")
+        if key == "u" and number.isdigit() and int(number) <= 7:
+            return int(number)
+    return DEFAULT_URGENCY
+
+
+def start(request, address):
+    """
+    Tells if an HTTP/1 request starts an HTTP/2 connection: the preface of a client with prior knowledge,
+    or a request without body asking to upgrade to h2c
+    :param request: request header
+    :type request: str
+    :param address: IP address of the client
+    :type address: str
+    :return: the connection, None to answer the request in HTTP/1
+    :rtype: Connection or None
+    """
+    if not config_srv.CONFIGURATION['Http2']:
+        return None
+    if request == PREFACE_REQUEST:
+        return Connection(address, PREFACE_END)
+    if "h2c" not in request:
+        return None
+    try:
+        (first, fields) = proxy_http.parse_head(request)
+        length = proxy_http.request_length(fields)
+        settings = base64.urlsafe_b64decode(proxy_http.field(fields, "http2-settings") + "==")
+    except ValueError:
+        return None
+    upgrade = {token.strip().lower() for token in proxy_http.field(fields, "upgrade").split(",")}
+    if "h2c" not in upgrade or not proxy_http.field(fields, "http2-settings") or length or first[2] != "HTTP/1.1":
+        return None
+    connection = Connection(address)
+    connection.upgrade(first[0], first[1], fields, settings)
+    return connection
+
+
+def read_chunk(body):
+    """
+    Read the next chunk of a BodyStream, in a thread of the executor of an engine
+    :type body: client_http.BodyStream
+    :return: the bytes, empty at the end of the body, None when the source failed
+    :rtype: bytes or None
+    """
+    try:
+        return body.read()
+    except Exception as e:
+        print("Response body failure:", repr(e))
+        return None
+
+
+# Threads reading the BodyStream chunks of the connections served by serve
+producers = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="h2-producer")
+
+
+class Produced:
+    """
+    Chunks read by the producers for a connection served by serve,
+    a byte written to a pipe waking up its select for each one
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        # (Stream, BodyStream, chunk) read and not given to the connection yet
+        self.ready = []
+        # The connection has ended, the chunks read after are given to it right away to close their source
+        self.ended = False
+        (self.readable, self.writable) = os.pipe()
+
+    def start(self):
+        """
+        Read in the producers the chunks the connection needs
+        :return: None
+        :rtype: None
+        """
+        for (stream, body) in self.connection.to_produce():
+            producers.submit(read_chunk, body).add_done_callback(functools.partial(self.done, stream, body))
+        return None
+
+    def done(self, stream, body, future):
+        # Called by the producer thread
+        with self.lock:
+            if self.ended:
+                self.connection.produced(stream, body, future.result())
+                return
+            self.ready.append((stream, body, future.result()))
+            os.write(self.writable, b"\0")
+
+    def give(self):
+        """
+        Give the chunks read to the connection, once select told the pipe is readable
+        :return: None
+        :rtype: None
+        """
+        with self.lock:
+            os.read(self.readable, len(self.ready) or 1)
+            (ready, self.ready) = (self.ready, [])
+        for (stream, body, chunk) in ready:
+            self.connection.produced(stream, body, chunk)
+        return None
+
+    def end(self):
+        """
+        Close the sources of the chunks read for a connection released
+        :return: None
+        :rtype: None
+        """
+        with self.lock:
+            self.ended = True
+            (ready, self.ready) = (self.ready, [])
+            for (stream, body, chunk) in ready:
+                self.connection.produced(stream, body, chunk)
+        os.close(self.readable)
+        os.close(self.writable)
+        return None
+
+
+def serve(sock_client, buffer, connection):
+    """
+    Serve an HTTP/2 connection on a thread of the threads engine,
+    until it is closed or idle for KeepAliveTimeout seconds,
+    the BodyStream chunks being read by the producers meanwhile
+    :param sock_client: socket representing the connection with the client
+    :type sock_client: socket.socket
+    :param buffer: bytes received after the request which started HTTP/2
+    :type buffer: bytearray
+    :param connection: connection given by start
+    :type connection: Connection
+    :return: None
+    :rtype: None
+    """
+    produced = Produced(connection)
+    connection.receive(bytes(buffer))
+    buffer.clear()
+    try:
+        while True:
+            out = connection.data_to_send()
+            if out:
+                sock_client.sendall(out)
+            if connection.closed:
+                break
+            produced.start()
+            # Look for frames without waiting while there is something to send
+            timeout = 0 if connection.sendable() else config_srv.CONFIGURATION['KeepAliveTimeout']
+            # Bytes already decrypted by TLS are not seen by select
+            if isinstance(sock_client, ssl.SSLSocket) and sock_client.pending():
+                readable = [sock_client]
+            else:
+                readable = select.select([sock_client, produced.readable], [], [], timeout)[0]
+            if produced.readable in readable:
+                produced.give()
+            if sock_client in readable:
+                data = sock_client.recv(proxy_http.COPY_SIZE)
+                if not data:
+                    break
+                connection.receive(data)
+            elif not readable and timeout and not connection.producing():
+                connection.close(NO_ERROR)
+    except socket.error:
+        log_http.debug("HTTP/2 socket error")
+    finally:
+        connection.release()
+        produced.end()
+    return None
+
+
+def main():
+    # Test
+    import threading
+
+    def client_frames(data):
+        frames = []
+        while data:
+            length = int.from_bytes(data[:3], "big")
+            frames.append((data[3], data[4], int.from_bytes(data[5:9], "big"), data[9:9 + length]))
+            data = data[9 + length:]
+        return frames
+
+    def request_block(encoder, path, method="GET"):
+        return encoder.encode([(":method", method), (":scheme", "http"), (":path", path), (":authority", "x")])
+
+    # ----- Connection.receive() / data_to_send()
+
+    connection = Connection("127.0.0.1")
+    encoder = hpack_http.Encoder()
+    decoder = hpack_http.Decoder()
+    connection.receive(PREFACE + frame(SETTINGS, 0, 0, (INITIAL_WINDOW_SIZE).to_bytes(2, "big") +
+                                       (150).to_bytes(4, "big")) + frame(PING, 0, 0, b"12345678"))
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM, 1, request_block(encoder, "/index.html")) +
+                       frame(HEADERS, END_HEADERS | END_STREAM, 3, request_block(encoder, "/nofile")))
+    frames = client_frames(connection.data_to_send())
+    assert [(t, f, s) for (t, f, s, p) in frames[:3]] == [(SETTINGS, 0, 0), (SETTINGS, ACK, 0), (PING, ACK, 0)]
+    # 404 ANSWERED AT ONCE, INDEX WAITING FOR THE WINDOW UPDATES
+    headers = [(s, dict(decoder.decode(p))) for (t, f, s, p) in frames if t == HEADERS]
+    assert headers[0][0] == 1 and headers[0][1][":status"] == "200" and "connection" not in headers[0][1]
+    assert headers[1][0] == 3 and headers[1][1][":status"] == "404"
+    data = [(f, s, p) for (t, f, s, p) in frames if t == DATA]
+    assert sum(len(p) for (f, s, p) in data if s == 1) == 150 and not any(f for (f, s, p) in data if s == 1)
+    assert b"".join(p for (f, s, p) in data if s == 3) == client_http.gen_data_error(404)
+    connection.receive(frame(WINDOW_UPDATE, 0, 1, (1 << 20).to_bytes(4, "big")))
+    frames = client_frames(connection.data_to_send())
+    with open(config_srv.CONFIGURATION['Path'] + "index.html", "rb") as file:
+        index = file.read()
+    assert b"".join(p for (t, f, s, p) in frames) == index[150:] and frames[-1][1] == END_STREAM
+    assert not connection.streams and not connection.sendable()
+    # BODY PRODUCED WHILE IT IS SENT, FRAMED BY HTTP/2 INSTEAD OF CHUNKED
+    client_http.METHODS["POST"] = lambda req, keep_alive: client_http.stream_response(req, [b"abc", b"defgh"], False)
+    connection = Connection("127.0.0.1", b"")
+    (encoder, decoder) = (hpack_http.Encoder(), hpack_http.Decoder())
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM, 1, request_block(encoder, "/log", "POST")))
+    del client_http.METHODS["POST"]
+    frames = client_frames(connection.data_to_send())
+    assert "transfer-encoding" not in dict(decoder.decode(frames[1][3]))
+    # NOTHING READ FROM THE SOURCE BY data_to_send, THE ENGINE READING EACH CHUNK ASKED BY to_produce
+    assert frames[-1][0] == HEADERS and not connection.sendable() and not connection.producing()
+    while True:
+        pairs = connection.to_produce()
+        if not pairs:
+            break
+        assert connection.producing() and not connection.to_produce()
+        for (stream, body) in pairs:
+            connection.produced(stream, body, read_chunk(body))
+        frames += client_frames(connection.data_to_send())
+    assert b"".join(p for (t, f, s, p) in frames if t == DATA) == b"abcdefgh" and frames[-1][:2] == (DATA, END_STREAM)
+    assert not connection.streams
+
+    # SOURCE FAILING, OR READ WHILE ITS STREAM IS RESET
+
+    def source(fail, closed):
+        try:
+            yield b"abc"
+            if fail:
+                raise OSError("source failure")
+            yield b"def"
+        finally:
+            closed.append(True)
+
+    closed = []
+    client_http.METHODS["POST"] = lambda req, keep_alive: client_http.stream_response(
+        req, source(req.target == "/fail", closed), False)
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM, 3, request_block(encoder, "/fail", "POST")) +
+                       frame(HEADERS, END_HEADERS | END_STREAM, 5, request_block(encoder, "/reset", "POST")))
+    del client_http.METHODS["POST"]
+    connection.data_to_send()
+    pairs = dict((stream.id, (stream, body)) for (stream, body) in connection.to_produce())
+    for stream_id in (3, 3):
+        connection.produced(*pairs[stream_id], read_chunk(pairs[stream_id][1]))
+        pairs.update((stream.id, (stream, body)) for (stream, body) in connection.to_produce())
+    assert client_frames(connection.data_to_send())[-1][:3] == (RST_STREAM, 0, 3) and closed == [True]
+    connection.receive(frame(RST_STREAM, 0, 5, bytes(4)))
+    # THE GENERATOR READ BY THE ENGINE IS CLOSED ONCE ITS CHUNK IS GIVEN
+    assert closed == [True]
+    connection.produced(*pairs[5], read_chunk(pairs[5][1]))
+    assert closed == [True, True] and not connection.streams
+    print("Test Connection OK")
+
+    # ----- next_stream(): responses interleaved by weight, after the urgent ones
+
+    connection = Connection("127.0.0.1", b"")
+    encoder = hpack_http.Encoder()
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM | PRIORITY_FLAG, 1,
+                             b"\x00\x00\x00\x00\x07" + request_block(encoder, "/index.html")))
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM | PRIORITY_FLAG, 3,
+                             b"\x00\x00\x00\x00\x1f" + request_block(encoder, "/index.html")))
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM, 5, encoder.encode(
+        [(":method", "GET"), (":scheme", "http"), (":path", "/index.html"), ("priority", "u=0")])))
+    connection.max_frame = 16
+    order = [s for (t, f, s, p) in client_frames(connection.data_to_send()) if t == DATA]
+    count = -(-len(index) // 16)
+    assert order[:count] == [5] * count and order[count:count + 5] == [1, 3, 3, 3, 3]
+    assert order.count(1) == order.count(3) == count
+    print("Test next_stream OK")
+
+    # ----- errors
+
+    for received in (b"GET / HTTP/1.1\r\n\r\n", frame(HEADERS, END_HEADERS, 2, b""),
+                     frame(DATA, 0, 1, b"x"), frame(HEADERS, END_HEADERS, 1, b"\xff")):
+        connection = Connection("127.0.0.1", PREFACE if received.startswith(b"GET") else b"")
+        connection.receive(received)
+        assert connection.closed and client_frames(connection.data_to_send())[-1][0] == GOAWAY
+    connection = Connection("127.0.0.1", b"")
+    (encoder, decoder) = (hpack_http.Encoder(), hpack_http.Decoder())
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM, 1, request_block(encoder, "/", "DELETE")))
+    frames = client_frames(connection.data_to_send())
+    assert dict(decoder.decode(frames[1][3]))["allow"] == client_http.ALLOW
+    connection.receive(frame(HEADERS, END_HEADERS | END_STREAM, 3, hpack_http.Encoder().encode(
+        [(":method", "GET"), (":path", "/")])))
+    assert client_frames(connection.data_to_send())[0][:3] == (RST_STREAM, 0, 3)
+    print("Test errors OK")
+
+    # ----- start() / serve(): h2c upgrade on a socket
+
+    settings = base64.urlsafe_b64encode((ENABLE_PUSH).to_bytes(2, "big") + bytes(4)).decode().rstrip("=")
+    request = "GET /index.html HTTP/1.1\r\nHost: x\r\nConnection: Upgrade, HTTP2-Settings\r\n" \
+              "Upgrade: h2c\r\nHTTP2-Settings: " + settings + "\r\n\r\n"
+    assert start("GET / HTTP/1.1\r\n\r\n", "-") is None
+    (server_side, client_side) = socket.socketpair()
+
+    def served():
+        serve(server_side, bytearray(PREFACE), start(request, "-"))
+        server_side.close()
+
+    thread = threading.Thread(target=served)
+    thread.start()
+    client_side.sendall(frame(SETTINGS, 0, 0) + frame(GOAWAY, 0, 0, bytes(8)))
+    received = b""
+    while True:
+        data = client_side.recv(65536)
+        if not data:
+            break
+        received += data
+    thread.join()
+    client_side.close()
+    assert received.startswith(SWITCHING)
+    frames = client_frames(received[len(SWITCHING):])
+    assert b"".join(p for (t, f, s, p) in frames if t == DATA and s == 1) == index
+    assert frames[-1][0] == GOAWAY
+
+    # SLOW BODY READ BY A PRODUCER, THE OTHER STREAMS AND THE PINGS SERVED MEANWHILE
+
+    def slow():
+        for chunk in (b"abc", b"def"):
+            time.sleep(0.3)
+            yield chunk
+
+    client_http.METHODS["POST"] = lambda req, keep_alive: client_http.stream_response(req, slow(), False)
+    (server_side, client_side) = socket.socketpair()
+    thread = threading.Thread(target=serve, args=(server_side, bytearray(), Connection("127.0.0.1")))
+    thread.start()
+    encoder = hpack_http.Encoder()
+    client_side.sendall(PREFACE + frame(SETTINGS, 0, 0) +
+                        frame(HEADERS, END_HEADERS | END_STREAM, 1, request_block(encoder, "/", "POST")))
+    time.sleep(0.1)
+    client_side.sendall(frame(HEADERS, END_HEADERS | END_STREAM, 3, request_block(encoder, "/index.html")) +
+                        frame(PING, 0, 0, b"12345678"))
+    (received, frames) = (b"", [])
+    while not any(s == 1 and f & END_STREAM for (t, f, s, p) in frames):
+        received += client_side.recv(65536)
+        frames = client_frames(received)
+    del client_http.METHODS["POST"]
+    client_side.sendall(frame(GOAWAY, 0, 0, bytes(8)))
+    thread.join()
+    server_side.close()
+    client_side.close()
+    order = [(t, f, s) for (t, f, s, p) in frames if t in (PING, DATA)]
+    assert order.index((PING, ACK, 0)) < order.index((DATA, END_STREAM, 3)) < order.index((DATA, 0, 1))
+    assert b"".join(p for (t, f, s, p) in frames if t == DATA and s == 1) == b"abcdef"
+    print("Test serve OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import collections
+
+# HPACK, the header compression of HTTP/2 (RFC 7541)
+
+# Huffman code and its length in bits of each byte (RFC 7541 Appendix B)
+HUFFMAN_CODES = (
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28), (0xfffffe4, 28), (0xfffffe5, 28),
+    (0xfffffe6, 28), (0xfffffe7, 28), (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28),
+    (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28), (0xfffffec, 28), (0xfffffed, 28), (0xfffffee, 28),
+    (0xfffffef, 28), (0xffffff0, 28), (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28),
+    (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28), (0xffffff8, 28), (0xffffff9, 28),
+    (0xffffffa, 28), (0xffffffb, 28), (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12), (0x1ff9, 13), (0x15, 6),
+    (0xf8, 8), (0x7fa, 11), (0x3fa, 10), (0x3fb, 10), (0xf9, 8), (0x7fb, 11), (0xfa, 8), (0x16, 6), (0x17, 6),
+    (0x18, 6), (0x0, 5), (0x1, 5), (0x2, 5), (0x19, 6), (0x1a, 6), (0x1b, 6), (0x1c, 6), (0x1d, 6), (0x1e, 6),
+    (0x1f, 6), (0x5c, 7), (0xfb, 8), (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10), (0x1ffa, 13), (0x21, 6),
+    (0x5d, 7), (0x5e, 7), (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7), (0x63, 7), (0x64, 7), (0x65, 7), (0x66, 7),
+    (0x67, 7), (0x68, 7), (0x69, 7), (0x6a, 7), (0x6b, 7), (0x6c, 7), (0x6d, 7), (0x6e, 7), (0x6f, 7), (0x70, 7),
+    (0x71, 7), (0x72, 7), (0xfc, 8), (0x73, 7), (0xfd, 8), (0x1ffb, 13), (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14),
+    (0x22, 6), (0x7ffd, 15), (0x3, 5), (0x23, 6), (0x4, 5), (0x24, 6), (0x5, 5), (0x25, 6), (0x26, 6), (0x27, 6),
+    (0x6, 5), (0x74, 7), (0x75, 7), (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5), (0x2b, 6), (0x76, 7), (0x2c, 6),
+    (0x8, 5), (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7), (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15),
+    (0x7fc, 11), (0x3ffd, 14), (0x1ffd, 13), (0xffffffc, 28), (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20),
+    (0xfffe8, 20), (0x3fffd3, 22), (0x3fffd4, 22), (0x3fffd5, 22), (0x7fffd9, 23), (0x3fffd6, 22), (0x7fffda, 23),
+    (0x7fffdb, 23), (0x7fffdc, 23), (0x7fffdd, 23), (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23), (0xffffec, 24),
+    (0xffffed, 24), (0x3fffd7, 22), (0x7fffe0, 23), (0xffffee, 24), (0x7fffe1, 23), (0x7fffe2, 23), (0x7fffe3, 23),
+    (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22), (0x7fffe5, 23), (0x3fffd9, 22), (0x7fffe6, 23), (0x7fffe7, 23),
+    (0xffffef, 24), (0x3fffda, 22), (0x1fffdd, 21), (0xfffe9, 20), (0x3fffdb, 22), (0x3fffdc, 22), (0x7fffe8, 23),
+    (0x7fffe9, 23), (0x1fffde, 21), (0x7fffea, 23), (0x3fffdd, 22), (0x3fffde, 22), (0xfffff0, 24), (0x1fffdf, 21),
+    (0x3fffdf, 22), (0x7fffeb, 23), (0x7fffec, 23), (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21),
+    (0x7fffed, 23), (0x3fffe1, 22), (0x7fffee, 23), (0x7fffef, 23), (0xfffea, 20), (0x3fffe2, 22), (0x3fffe3, 22),
+    (0x3fffe4, 22), (0x7ffff0, 23), (0x3fffe5, 22), (0x3fffe6, 22), (0x7ffff1, 23), (0x3ffffe0, 26),
+    (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19), (0x3fffe7, 22), (0x7ffff2, 23), (0x3fffe8, 22), (0x1ffffec, 25),
+    (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27), (0x7ffffdf, 27), (0x3ffffe5, 26),
+    (0xfffff1, 24), (0x1ffffed, 25), (0x7fff2, 19), (0x1fffe3, 21), (0x3ffffe6, 26), (0x7ffffe0, 27),
+    (0x7ffffe1, 27), (0x3ffffe7, 26), (0x7ffffe2, 27), (0xfffff2, 24), (0x1fffe4, 21), (0x1fffe5, 21),
+    (0x3ffffe8, 26), (0x3ffffe9, 26), (0xffffffd, 28), (0x7ffffe3, 27), (0x7ffffe4, 27), (0x7ffffe5, 27),
+    (0xfffec, 20), (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21), (0x3fffe9, 22), (0x1fffe7, 21), (0x1fffe8, 21),
+    (0x7ffff3, 23), (0x3fffea, 22), (0x3fffeb, 22), (0x1ffffee, 25), (0x1ffffef, 25), (0xfffff4, 24),
+    (0xfffff5, 24), (0x3ffffea, 26), (0x7ffff4, 23), (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26),
+    (0x3ffffed, 26), (0x7ffffe7, 27), (0x7ffffe8, 27), (0x7ffffe9, 27), (0x7ffffea, 27), (0x7ffffeb, 27),
+    (0xffffffe, 28), (0x7ffffec, 27), (0x7ffffed, 27), (0x7ffffee, 27), (0x7ffffef, 27), (0x7fffff0, 27),
+    (0x3ffffee, 26),
+)
+# End of string code, only allowed as padding
+EOS = (0x3fffffff, 30)
+# Fields of the static table, index 1 first (RFC 7541 Appendix A)
+STATIC_TABLE = (
+    (":authority", ""), (":method", "GET"), (":method", "POST"), (":path", "/"), (":path", "/index.html"),
+    (":scheme", "http"), (":scheme", "https"), (":status", "200"), (":status", "204"), (":status", "206"),
+    (":status", "304"), (":status", "400"), (":status", "404"), (":status", "500"), ("accept-charset", ""),
+    ("accept-encoding", "gzip, deflate"), ("accept-language", ""), ("accept-ranges", ""), ("accept", ""),
+    ("access-control-allow-origin", ""), ("age", ""), ("allow", ""), ("authorization", ""), ("cache-control", ""),
+    ("content-disposition", ""), ("content-encoding", ""), ("content-language", ""), ("content-length", ""),
+    ("content-location", ""), ("content-range", ""), ("content-type", ""), ("cookie", ""), ("date", ""),
+    ("etag", ""), ("expect", ""), ("expires", ""), ("from", ""), ("host", ""), ("if-match", ""),
+    ("if-modified-since", ""), ("if-none-match", ""), ("if-range", ""), ("if-unmodified-since", ""),
+    ("last-modified", ""), ("link", ""), ("location", ""), ("max-forwards", ""), ("proxy-authenticate", ""),
+    ("proxy-authorization", ""), ("range", ""), ("referer", ""), ("refresh", ""), ("retry-after", ""),
+    ("server", ""), ("set-cookie", ""), ("strict-transport-security", ""), ("transfer-encoding", ""),
+    ("user-agent", ""), ("vary", ""), ("via", ""), ("www-authenticate", ""),
+)
+# Fields the encoder doesn't add to the dynamic table, their values rarely repeating
+NOT_INDEXED = {"content-length", "content-range", "etag", "last-modified", "set-cookie", "authorization"}
+# Bytes of a dynamic table entry besides its name and value
+ENTRY_OVERHEAD = 32
+
+# (name, value) -> first static index, and name -> first static index
+static_fields = {}
+static_names = {}
+for (index, entry) in enumerate(STATIC_TABLE, 1):
+    static_fields.setdefault(entry, index)
+    static_names.setdefault(entry[0], index)
+
+
+def huffman_tree():
+    """
+    Build the Huffman decoding tree, then its transitions by 4 bits at once
+    :return: (state, nibble) -> (next state, decoded bytes, whether the state ends a valid padding),
+             and the states a valid padding may end on
+    :rtype: tuple
+    """
+    # Internal node -> [child of bit 0, child of bit 1], a child being a node, or -1 - byte for a leaf
+    children = [[None, None]]
+    for (byte, (code, length)) in enumerate(HUFFMAN_CODES + (EOS,)):
+        node = 0
+        for shift in range(length - 1, -1, -1):
+            bit = (code >> shift) & 1
+            if shift == 0:
+                children[node][bit] = -1 - byte
+            else:
+                if children[node][bit] is None:
+                    children.append([None, None])
+                    children[node][bit] = len(children) - 1
+                node = children[node][bit]
+    # Padding: up to 7 bits set to 1, the most significant bits of EOS
+    padding = {0}
+    node = 0
+    for i in range(7):
+        node = children[node][1]
+        padding.add(node)
+    transitions = []
+    for state in range(len(children)):
+        for nibble in range(16):
+            node = state
+            decoded = bytearray()
+            for shift in (3, 2, 1, 0):
+                child = children[node][(nibble >> shift) & 1]
+                if child < 0:
+                    if child == -1 - 256:
+                        # EOS in the string
+                        decoded = None
+                        break
+                    decoded.append(-1 - child)
+                    node = 0
+                else:
+                    node = child
+            transitions.append(None if decoded is None else (node, bytes(decoded)))
+    return transitions, padding
+
+
+(HUFFMAN_TRANSITIONS, HUFFMAN_PADDING) = huffman_tree()
+
+
+def huffman_decode(data):
+    """
+    :param data: Huffman encoded string
+    :type data: bytes
+    :return: the decoded string
+    :rtype: bytes
+    :raise: ValueError for an invalid code or padding
+    """
+    state = 0
+    decoded = []
+    for byte in data:
+        for nibble in (byte >> 4, byte & 15):
+            transition = HUFFMAN_TRANSITIONS[state * 16 + nibble]
+            if transition is None:
+                raise ValueError("EOS in a Huffman string")
+            (state, part) = transition
+            if part:
+                decoded.append(part)
+    if state not in HUFFMAN_PADDING:
+        raise ValueError("Invalid Huffman padding")
+    return b"".join(decoded)
+
+
+def huffman_encode(data):
+    """
+    :param data: string
+    :type data: bytes
+    :return: the Huffman encoded string
+    :rtype: bytes
+    """
+    value = 0
+    bits = 0
+    for byte in data:
+        (code, length) = HUFFMAN_CODES[byte]
+        value = (value << length) | code
+        bits += length
+    padding = -bits % 8
+    value = (value << padding) | ((1 << padding) - 1)
+    return value.to_bytes((bits + padding) // 8, "big")
+
+
+def encode_integer(value, prefix, flags=0):
+    """
+    :param value: integer
+    :type value: int
+    :param prefix: bits of the first byte used by the integer
+    :type prefix: int
+    :param flags: bits of the first byte before the integer
+    :type flags: int
+    :rtype: bytes
+    """
+    limit = (1 << prefix) - 1
+    if value < limit:
+        return bytes((flags | value,))
+    encoded = bytearray((flags | limit,))
+    value -= limit
+    while value >= 128:
+        encoded.append((value & 127) | 128)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_integer(data, position, prefix):
+    """
+    :param data: header block
+    :type data: bytes
+    :param position: index of the first byte of the integer
+    :type position: int
+    :param prefix: bits of the first byte used by the integer
+    :type prefix: int
+    :return: the integer and the position after it
+    :rtype: tuple
+    :raise: ValueError for a truncated or too large integer
+    """
+    limit = (1 << prefix) - 1
+    value = data[position] & limit
+    position += 1
+    if value < limit:
+        return value, position
+    shift = 0
+    while True:
+        if position >= len(data) or shift > 28:
+            raise ValueError("Invalid integer")
+        byte = data[position]
+        position += 1
+        value += (byte & 127) << shift
+        shift += 7
+        if byte < 128:
+            return value, position
+
+
+def encode_string(value):
+    """
+    :param value: string
+    :type value: bytes
+    :return: the string with its length, Huffman encoded when it is shorter
+    :rtype: bytes
+    """
+    if sum(HUFFMAN_CODES[byte][1] for byte in value) < len(value) * 8 - 7:
+        value = huffman_encode(value)
+        return encode_integer(len(value), 7, 0x80) + value
+    return encode_integer(len(value), 7) + value
+
+
+def decode_string(data, position):
+    """
+    :param data: header block
+    :type data: bytes
+    :param position: index of the first byte of the string
+    :type position: int
+    :return: the string and the position after it
+    :rtype: tuple
+    :raise: ValueError
+    """
+    huffman = data[position] & 0x80
+    (length, position) = decode_integer(data, position, 7)
+    end = position + length
+    if end > len(data):
+        raise ValueError("Truncated string")
+    value = data[position:end]
+    return (huffman_decode(value) if huffman else value), end
+
+
+class Table:
+    """
+    Dynamic table of a direction of a connection, the newest entry first
+    """
+    __slots__ = ("entries", "size", "max_size")
+
+    def __init__(self, max_size=4096):
+        # (name, value) as bytes
+        self.entries = collections.deque()
+        self.size = 0
+        self.max_size = max_size
+
+    def add(self, name, value):
+        self.entries.appendleft((name, value))
+        self.size += len(name) + len(value) + ENTRY_OVERHEAD
+        self.evict()
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            (name, value) = self.entries.pop()
+            self.size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+    def get(self, index):
+        """
+        :param index: index in the static table followed by the dynamic one, from 1
+        :type index: int
+        :return: (name, value)
+        :rtype: tuple
+        :raise: ValueError for an index out of the tables
+        """
+        if 0 < index <= len(STATIC_TABLE):
+            (name, value) = STATIC_TABLE[index - 1]
+            return name.encode("latin-1"), value.encode("latin-1")
+        index -= len(STATIC_TABLE) + 1
+        if not 0 <= index < len(self.entries):
+            raise ValueError("Invalid index")
+        return self.entries[index]
+
+
+class Decoder:
+    """
+    Decode the header blocks received on a connection
+    """
+    __slots__ = ("table", "max_size")
+
+    def __init__(self, max_size=4096):
+        self.table = Table(max_size)
+        # Largest table size the peer may ask for, the SETTINGS_HEADER_TABLE_SIZE sent to it
+        self.max_size = max_size
+
+    def decode(self, data):
+        """
+        :param data: header block
+        :type data: bytes
+        :return: (name, value) fields, in their order
+        :rtype: list
+        :raise: ValueError for a malformed block, which leaves the connection unusable
+        """
+        fields = []
+        position = 0
+        try:
+            while position < len(data):
+                byte = data[position]
+                if byte & 0x80:
+                    # Indexed field
+                    (index, position) = decode_integer(data, position, 7)
+                    fields.append(self.table.get(index))
+                    continue
+                if byte & 0xe0 == 0x20:
+                    # Dynamic table size update
+                    (size, position) = decode_integer(data, position, 5)
+                    if size > self.max_size:
+                        raise ValueError("Table size larger than the setting")
+                    self.table.resize(size)
+                    continue
+                # Literal field, with incremental indexing or not
+                prefix = 6 if byte & 0x40 else 4
+                (index, position) = decode_integer(data, position, prefix)
+                if index:
+                    name = self.table.get(index)[0]
+                else:
+                    (name, position) = decode_string(data, position)
+                (value, position) = decode_string(data, position)
+                if prefix == 6:
+                    self.table.add(name, value)
+                fields.append((name, value))
+        except IndexError:
+            raise ValueError("Truncated header block")
+        return [(name.decode("utf-8"), value.decode("utf-8")) for (name, value) in fields]
+
+
+class Encoder:
+    """
+    Encode the header blocks sent on a connection
+    """
+    __slots__ = ("table", "resized")
+
+    def __init__(self):
+        self.table = Table()
+        # Smallest and last table sizes set since the previous block, to announce in the next one
+        self.resized = None
+
+    def resize(self, max_size):
+        """
+        Follow the SETTINGS_HEADER_TABLE_SIZE of the peer, up to 4096 bytes
+        :type max_size: int
+        :return: None
+        :rtype: None
+        """
+        max_size = min(max_size, 4096)
+        smallest = max_size if self.resized is None else min(self.resized[0], max_size)
+        self.resized = (smallest, max_size)
+        self.table.resize(max_size)
+        return None
+
+    def encode(self, fields):
+        """
+        :param fields: (name, value) fields, names in lower case
+        :type fields: list
+        :return: header block
+        :rtype: bytes
+        """
+        block = []
+        if self.resized is not None:
+            (smallest, last) = self.resized
+            if smallest < last:
+                block.append(encode_integer(smallest, 5, 0x20))
+            block.append(encode_integer(last, 5, 0x20))
+            self.resized = None
+        for (name, value) in fields:
+            index = static_fields.get((name, value))
+            (name, value) = (name.encode("utf-8"), value.encode("utf-8"))
+            if index is None:
+                for (position, entry) in enumerate(self.table.entries):
+                    if entry == (name, value):
+                        index = len(STATIC_TABLE) + 1 + position
+                        break
+            if index is not None:
+                block.append(encode_integer(index, 7, 0x80))
+                continue
+            name_index = static_names.get(name.decode("utf-8"), 0)
+            if name.decode("utf-8") in NOT_INDEXED:
+                block.append(encode_integer(name_index, 4))
+            else:
+                block.append(encode_integer(name_index, 6, 0x40))
+                self.table.add(name, value)
+            if not name_index:
+                block.append(encode_string(name))
+            block.append(encode_string(value))
+        return b"".join(block)
+
+
+def main():
+    # Test
+
+    # ----- huffman_encode() / huffman_decode()
+
+    assert huffman_encode(b"www.example.com") == bytes.fromhex("f1e3c2e5f23a6ba0ab90f4ff")
+    assert huffman_decode(bytes.fromhex("f1e3c2e5f23a6ba0ab90f4ff")) == b"www.example.com"
+    assert all(huffman_decode(huffman_encode(bytes((byte,)) * 3)) == bytes((byte,)) * 3 for byte in range(256))
+    # PADDING OF 8 BITS
+    for invalid in (huffman_encode(b"a") + b"\xff", b"\x00"):
+        try:
+            huffman_decode(invalid)
+            assert False
+        except ValueError:
+            pass
+    print("Test huffman OK")
+
+    # ----- encode_integer() / decode_integer()
+
+    assert encode_integer(10, 5) == b"\x0a" and encode_integer(1337, 5) == b"\x1f\x9a\x0a"
+    assert decode_integer(b"\x1f\x9a\x0a", 0, 5) == (1337, 3) and decode_integer(b"\x2a", 0, 8) == (42, 1)
+    print("Test integer OK")
+
+    # ----- Decoder.decode(): RFC 7541 C.4, requests with Huffman
+
+    decoder = Decoder()
+    assert decoder.decode(bytes.fromhex("828684418cf1e3c2e5f23a6ba0ab90f4ff")) == [
+        (":method", "GET"), (":scheme", "http"), (":path", "/"), (":authority", "www.example.com")]
+    assert decoder.decode(bytes.fromhex("828684be5886a8eb10649cbf")) == [
+        (":method", "GET"), (":scheme", "http"), (":path", "/"), (":authority", "www.example.com"),
+        ("cache-control", "no-cache")]
+    assert decoder.decode(bytes.fromhex("828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf")) == [
+        (":method", "GET"), (":scheme", "https"), (":path", "/index.html"), (":authority", "www.example.com"),
+        ("custom-key", "custom-value")]
+    assert decoder.table.size == 164
+    for invalid in ("c5", "3fe21f", "418c"):
+        try:
+            Decoder().decode(bytes.fromhex(invalid))
+            assert False
+        except ValueError:
+            pass
+    print("Test decode OK")
+
+    # ----- Encoder.encode()
+
+    (encoder, decoder) = (Encoder(), Decoder())
+    fields = [(":status", "200"), ("server", "Tobi"), ("content-type", "text/html; charset=UTF-8"),
+              ("content-length", "449")]
+    first = encoder.encode(fields)
+    assert decoder.decode(first) == fields
+    # THE REPEATED FIELDS TAKE ONE BYTE
+    second = encoder.encode(fields)
+    assert decoder.decode(second) == fields and second[:3] == first[:1] + b"\xbf\xbe"
+    assert len(second) == 3 + len(encode_integer(28, 4)) + len(encode_string(b"449"))
+    encoder.resize(0)
+    assert encoder.encode(fields[:2])[0] == 0x20 and not encoder.table.entries
+    print("Test encode OK")
+
+
+if __name__ == "__main__":
+    main()
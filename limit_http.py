@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import collections
+import math
+import threading
+import time
+# Internal modules
+import config_srv
+import metrics_http
+
+# IP address -> connections being served
+connections = {}
+# IP address -> (tokens, time.monotonic() of the last request), least recently used first
+buckets = collections.OrderedDict()
+stats = {'connections_refused': 0, 'requests_limited': 0, 'buckets_expired': 0, 'buckets_evicted': 0}
+
+lock = threading.Lock()
+
+
+def connection_opened(address):
+    """
+    Count a new connection of a client, unless it already has MaxConnectionsPerIP of them.
+    Only the connections counted are given to connection_closed.
+    :param address: IP address of the client
+    :type address: str
+    :return: False if the connection must be refused, True if it was counted,
+             None if it is accepted without being counted, MaxConnectionsPerIP being 0
+    :rtype: bool or None
+    """
+    max_connections = config_srv.CONFIGURATION['MaxConnectionsPerIP']
+    if not max_connections:
+        return None
+    with lock:
+        count = connections.get(address, 0)
+        if count >= max_connections:
+            stats['connections_refused'] += 1
+            return False
+        connections[address] = count + 1
+    return True
+
+
+def connection_closed(address):
+    """
+    Forget a connection counted by connection_opened
+    :param address: IP address of the client
+    :type address: str
+    :return: None
+    :rtype: None
+    """
+    with lock:
+        count = connections.get(address, 0) - 1
+        if count > 0:
+            connections[address] = count
+        else:
+            connections.pop(address, None)
+    return None
+
+
+def allow(address, now=None):
+    """
+    Token bucket of the requests of a client: RateBurst requests at once,
+    then RateLimit requests per second.
+    The buckets of the clients idle long enough to be full again are dropped,
+    and the least recently used ones beyond RateLimitEntries.
+    :param address: IP address of the client
+    :type address: str
+    :param now: time.monotonic(), given by the tests
+    :type now: float or None
+    :return: False if the request must be refused
+    :rtype: bool
+    """
+    rate = config_srv.CONFIGURATION['RateLimit']
+    if not rate:
+        return True
+    burst = config_srv.CONFIGURATION['RateBurst']
+    if now is None:
+        now = time.monotonic()
+    with lock:
+        bucket = buckets.get(address)
+        if bucket is None:
+            tokens = burst
+        else:
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            buckets.move_to_end(address)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            stats['requests_limited'] += 1
+        buckets[address] = (tokens, now)
+        while len(buckets) > 1:
+            (oldest, (oldest_tokens, last)) = next(iter(buckets.items()))
+            if oldest_tokens + (now - last) * rate >= burst:
+                stats['buckets_expired'] += 1
+            elif len(buckets) > config_srv.CONFIGURATION['RateLimitEntries']:
+                stats['buckets_evicted'] += 1
+            else:
+                break
+            del buckets[oldest]
+    return allowed
+
+
+def retry_after():
+    """
+    Retry-After field of the requests refused by allow: the seconds for a new token
+    :return: whole seconds, at least 1
+    :rtype: str
+    """
+    return str(max(1, math.ceil(1 / config_srv.CONFIGURATION['RateLimit'])))
+
+
+metrics_http.counters['http_limit_connections_refused_total'] = (
+    "Connections refused because their client had MaxConnectionsPerIP open.", lambda: stats['connections_refused'])
+metrics_http.counters['http_limit_requests_limited_total'] = (
+    "Requests refused by the RateLimit of their client.", lambda: stats['requests_limited'])
+metrics_http.counters['http_limit_buckets_expired_total'] = (
+    "Rate limit buckets dropped once full again, their client idle.", lambda: stats['buckets_expired'])
+metrics_http.counters['http_limit_buckets_evicted_total'] = (
+    "Rate limit buckets dropped before being full again, beyond RateLimitEntries.", lambda: stats['buckets_evicted'])
+metrics_http.gauges['http_limit_clients'] = ("Clients with connections being served.", lambda: len(connections))
+metrics_http.gauges['http_limit_buckets'] = ("Rate limit buckets of the recent clients.", lambda: len(buckets))
+
+
+def main():
+    # Test
+
+    # ----- connection_opened() / connection_closed()
+
+    assert connection_opened("10.0.0.1") is None and connections == {}
+    config_srv.update({'MaxConnectionsPerIP': 2})
+    assert connection_opened("10.0.0.1") and connection_opened("10.0.0.1")
+    assert not connection_opened("10.0.0.1") and stats['connections_refused'] == 1
+    # OTHER CLIENTS ARE NOT LIMITED
+    assert connection_opened("10.0.0.2")
+    connection_closed("10.0.0.1")
+    assert connection_opened("10.0.0.1")
+    for address in ("10.0.0.1", "10.0.0.1", "10.0.0.2"):
+        connection_closed(address)
+    assert connections == {}
+    # A CONNECTION ACCEPTED BEFORE THE LIMIT WAS SET IS NOT FORGOTTEN IN PLACE OF A COUNTED ONE
+    assert connection_opened("10.0.0.1")
+    config_srv.update({'MaxConnectionsPerIP': 0})
+    assert connection_opened("10.0.0.1") is None and connections == {"10.0.0.1": 1}
+    connection_closed("10.0.0.1")
+    assert connections == {}
+    print("Test connection_opened OK")
+
+    # ----- allow()
+
+    assert all(allow("10.0.0.1", 0) for i in range(1000))
+    config_srv.update({'RateLimit': 10, 'RateBurst': 3, 'RateLimitEntries': 2})
+    assert [allow("10.0.0.1", 0) for i in range(4)] == [True, True, True, False]
+    # ONE TOKEN EVERY 0.1 SECOND
+    assert allow("10.0.0.1", 0.1) and not allow("10.0.0.1", 0.1)
+    assert allow("10.0.0.2", 0.1) and allow("10.0.0.3", 0.1)
+    # BUCKETS KEPT FOR RateLimitEntries CLIENTS
+    assert list(buckets) == ["10.0.0.2", "10.0.0.3"] and stats['buckets_evicted'] == 1
+    # FULL AGAIN AFTER 0.3 SECOND, DROPPED
+    assert allow("10.0.0.4", 0.5) and list(buckets) == ["10.0.0.4"] and stats['buckets_expired'] == 2
+    assert stats['requests_limited'] == 2 and retry_after() == "1"
+    config_srv.update({'RateLimit': 0.25})
+    assert retry_after() == "4"
+    print("Test allow OK")
+
+    text = metrics_http.render().splitlines()
+    assert "# TYPE http_limit_requests_limited_total counter" in text and "http_limit_requests_limited_total 2" in text
+    assert "http_limit_buckets_expired_total 2" in text and "http_limit_buckets_evicted_total 1" in text
+    print("Test metrics OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import fcntl
+import json
+import os
+import queue
+import sys
+import threading
+import time
+# Internal modules
+import config_srv
+
+# Lines most written at once by the writer thread
+BATCH_SIZE = 512
+
+# Records waiting for the writer thread: access entries, or (None, message) for the debug messages
+records = queue.SimpleQueue()
+writer = None
+# Records dropped because the writer thread was behind by more than AccessLogQueueSize
+stats = {'dropped': 0}
+
+
+def access(address, request, code, length, duration):
+    """
+    Log a response sent, without waiting: the line is formatted and written by the writer thread
+    :param address: IP address of the client
+    :type address: str
+    :param request: request answered, None if it was not received
+    :type request: str or None
+    :param code: HTTP status code
+    :type code: int
+    :param length: bytes of the response body
+    :type length: int
+    :param duration: seconds taken to answer the request
+    :type duration: float
+    :return: None
+    :rtype: None
+    """
+    if writer is None or config_srv.CONFIGURATION['AccessLog'] is None:
+        return None
+    if records.qsize() >= config_srv.CONFIGURATION['AccessLogQueueSize']:
+        stats['dropped'] += 1
+        return None
+    records.put((time.time(), address, request, code, length, duration))
+    return None
+
+
+def debug(message):
+    """
+    Display a message of the request processing, when Debug is enabled
+    :param message: message
+    :type message: str
+    :return: None
+    :rtype: None
+    """
+    if not config_srv.CONFIGURATION['Debug']:
+        return None
+    if writer is None:
+        print(message)
+    else:
+        records.put((None, message))
+    return None
+
+
+def request_fields(request):
+    """
+    Get the fields of a request used in the access log, without parsing all of it
+    :param request: request, None if it was not received
+    :type request: str or None
+    :return: request line, Referer and User-Agent, "-" when missing
+    :rtype: tuple
+    """
+    if request is None:
+        return "-", "-", "-"
+    lines = request.split("\r\n")
+    (referer, agent) = ("-", "-")
+    for line in lines[1:]:
+        (name, _, value) = line.partition(":")
+        name = name.lower()
+        if name == "referer":
+            referer = value.strip()
+        elif name == "user-agent":
+            agent = value.strip()
+    return lines[0], referer, agent
+
+
+def format_record(record):
+    """
+    Format an access record in the AccessLogFormat:
+    "combined" for the Combined Log Format, "json" for JSON lines
+    :param record: access record, as given to access
+    :type record: tuple
+    :return: line of the access log
+    :rtype: str
+    """
+    (when, address, request, code, length, duration) = record
+    (request_line, referer, agent) = request_fields(request)
+    if config_srv.CONFIGURATION['AccessLogFormat'] == "json":
+        return json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(when)),
+                           "remote": address, "request": request_line, "status": code, "bytes": length,
+                           "referer": referer, "user_agent": agent, "duration_ms": round(duration * 1000, 3)})
+    escaped = [field.replace("\\", "\\\\").replace('"', '\\"') for field in (request_line, referer, agent)]
+    return '%s - - [%s] "%s" %d %s "%s" "%s"' % (address, time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(when)),
+                                               escaped[0], code, length or "-", escaped[1], escaped[2])
+
+
+def open_log():
+    """
+    Open the access log file in append mode, or get the standard output for "-"
+    :return: the stream to write to
+    :rtype: io.TextIOBase
+    """
+    path = config_srv.CONFIGURATION['AccessLog']
+    if path == "-":
+        return sys.stdout
+    return open(path, "a", encoding="utf-8")
+
+
+def rotate(stream):
+    """
+    Rename the access log file to file.1, file.1 to file.2 and so on
+    up to AccessLogBackups, and open a new one
+    :param stream: the access log file, closed once renamed: the lock taken by write_lines is kept meanwhile
+    :type stream: io.TextIOBase
+    :return: the new access log file
+    :rtype: io.TextIOBase
+    """
+    path = config_srv.CONFIGURATION['AccessLog']
+    backups = config_srv.CONFIGURATION['AccessLogBackups']
+    try:
+        for i in range(backups - 1, 0, -1):
+            if os.path.exists(path + "." + str(i)):
+                os.replace(path + "." + str(i), path + "." + str(i + 1))
+        if backups > 0:
+            os.replace(path, path + ".1")
+        else:
+            os.remove(path)
+    except OSError:
+        print("Cannot rotate the access log.")
+    stream.close()
+    return open_log()
+
+
+def write_forever():
+    """
+    Writer thread: wait for records, gather them for AccessLogFlushInterval seconds
+    or BATCH_SIZE records, and write them at once.
+    The access log file is rotated when it reaches AccessLogMaxBytes,
+    and opened again when another process rotated it (write_lines).
+    :return: None
+    :rtype: None
+    """
+    stream = None
+    running = True
+    while running:
+        batch = [records.get()]
+        deadline = time.monotonic() + config_srv.CONFIGURATION['AccessLogFlushInterval']
+        while len(batch) < BATCH_SIZE and batch[-1] is not None:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(records.get(timeout=timeout) if timeout > 0 else records.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            # Stop asked
+            running = False
+            batch.pop()
+        messages = [record[1] for record in batch if record[0] is None]
+        if messages:
+            sys.stdout.write("\n".join(messages) + "\n")
+            sys.stdout.flush()
+        lines = [format_record(record) for record in batch if record[0] is not None]
+        if not lines:
+            continue
+        try:
+            stream = write_lines(stream, "\n".join(lines) + "\n")
+        except OSError:
+            print("Access log writing error.")
+    if stream is not None and stream is not sys.stdout:
+        stream.close()
+    return None
+
+
+def write_lines(stream, text):
+    """
+    Write lines to the access log, rotating the file when it reaches AccessLogMaxBytes.
+    With pre-fork, every process has the file open: they take turns with an exclusive lock on it,
+    so that the file is rotated once by the process filling it, the others writing to the new one.
+    :param stream: the access log open, None if not open yet
+    :type stream: io.TextIOBase or None
+    :param text: lines, each one ended by a newline
+    :type text: str
+    :return: the access log open, another file when it was rotated
+    :rtype: io.TextIOBase
+    :raise: OSError
+    """
+    if stream is None:
+        stream = open_log()
+    if stream is sys.stdout:
+        stream.write(text)
+        stream.flush()
+        return stream
+    while True:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+        if same_file(stream):
+            break
+        # Rotated by another process, the lock is released with the file
+        stream.close()
+        stream = open_log()
+    try:
+        stream.write(text)
+        stream.flush()
+        if os.fstat(stream.fileno()).st_size >= config_srv.CONFIGURATION['AccessLogMaxBytes']:
+            # Renamed while locked, the processes waiting see it was rotated
+            stream = rotate(stream)
+    finally:
+        if not stream.closed:
+            fcntl.flock(stream.fileno(), fcntl.LOCK_UN)
+    return stream
+
+
+def same_file(stream):
+    """
+    Tells if the access log file is still the one open
+    :param stream: the access log file open
+    :type stream: io.TextIOBase
+    :return: False when it was rotated or removed
+    :rtype: bool
+    """
+    try:
+        return os.stat(config_srv.CONFIGURATION['AccessLog']).st_ino == os.fstat(stream.fileno()).st_ino
+    except OSError:
+        return False
+
+
+def start():
+    """
+    Start the writer thread, from each process serving connections
+    :return: None
+    :rtype: None
+    """
+    global writer
+    writer = threading.Thread(target=write_forever, daemon=True)
+    writer.start()
+    return None
+
+
+def stop():
+    """
+    Write the records still waiting and stop the writer thread
+    :return: None
+    :rtype: None
+    """
+    global writer
+    if writer is None:
+        return None
+    records.put(None)
+    writer.join(5)
+    writer = None
+    return None
+
+
+def main():
+    # Test
+    import tempfile
+
+    request = "GET /index.html HTTP/1.1\r\nHost: x\r\nReferer: http://a/\r\nUser-Agent: curl \"8\"\r\n\r\n"
+
+    # ----- request_fields()
+
+    assert request_fields(request) == ("GET /index.html HTTP/1.1", "http://a/", 'curl "8"')
+    assert request_fields("GET / HTTP/1.1\r\n\r\n") == ("GET / HTTP/1.1", "-", "-")
+    assert request_fields(None) == ("-", "-", "-")
+    print("Test request_fields OK")
+
+    # ----- format_record()
+
+    line = format_record((0, "127.0.0.1", request, 200, 194, 0.001))
+    assert line.startswith('127.0.0.1 - - [' + time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(0)) + '] ')
+    assert line.endswith('] "GET /index.html HTTP/1.1" 200 194 "http://a/" "curl \\"8\\""')
+    assert format_record((0, "127.0.0.1", None, 408, 0, 0)).endswith('] "-" 408 - "-" "-"')
+    config_srv.update({'AccessLogFormat': "json"})
+    entry = json.loads(format_record((0, "127.0.0.1", request, 200, 194, 0.001)))
+    assert entry["status"] == 200 and entry["user_agent"] == 'curl "8"' and entry["duration_ms"] == 1
+    config_srv.update({'AccessLogFormat': "combined"})
+    print("Test format_record OK")
+
+    # ----- access() / write_forever()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "access.log")
+        config_srv.update({'AccessLog': path})
+        config_srv.update({'AccessLogMaxBytes': 1000})
+        config_srv.update({'AccessLogBackups': 2})
+        # NOT STARTED
+        access("127.0.0.1", request, 200, 194, 0.001)
+        assert records.empty()
+        # ONE BATCH OF 12 LINES IS BIGGER THAN AccessLogMaxBytes
+        for batch in range(4):
+            start()
+            for i in range(12 if batch < 3 else 1):
+                access("127.0.0.1", request, 200, batch, 0.001)
+            stop()
+        logs = []
+        for name in (path, path + ".1", path + ".2"):
+            with open(name) as file:
+                logs.append([line.split()[-4] for line in file.read().splitlines()])
+        # ROTATED, THE OLDEST ONES REMOVED
+        assert logs == [["3"], ["2"] * 12, ["1"] * 12] and not os.path.exists(path + ".3")
+        # FILE WRITTEN BY TWO PROCESSES (TWO STREAMS): ROTATED ONCE EACH TIME IT IS FULL
+        path = os.path.join(directory, "shared.log")
+        config_srv.update({'AccessLog': path, 'AccessLogBackups': 100})
+
+        def process():
+            stream = None
+            for i in range(50):
+                stream = write_lines(stream, "x" * 99 + "\n")
+            stream.close()
+
+        threads = [threading.Thread(target=process) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        backups = [path + "." + str(i) for i in range(1, 100) if os.path.exists(path + "." + str(i))]
+        assert sum(os.path.getsize(name) for name in [path] + backups) == 2 * 50 * 100
+        assert len(backups) == 10 and all(os.path.getsize(name) == 1000 for name in backups)
+        config_srv.update({'AccessLogBackups': 5})
+        config_srv.update({'AccessLog': "-"})
+        config_srv.update({'AccessLogMaxBytes': 10 * 1024 * 1024})
+    print("Test write_forever OK")
+
+
+if __name__ == "__main__":
+    main()
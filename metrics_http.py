@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import bisect
+import threading
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Steps of a request, in the order they happen
+STAGES = ("read", "parse", "resolve", "file", "send")
+
+# Metrics of every thread, each one only written by its own thread so that recording takes no lock
+shards = []
+shards_lock = threading.Lock()
+local = threading.local()
+# name -> (help, function giving the current value), registered by the engines, like the waiting queue depth
+gauges = {}
+# name -> (help, function giving the current count), registered by the other modules, like the rate limiter
+counters = {}
+
+
+class Shard:
+    """
+    Metrics recorded by one thread since it started
+    """
+    __slots__ = ("stages", "responses", "bytes_sent", "opened", "closed")
+
+    def __init__(self):
+        # stage -> [count of each bucket, the last one for +Inf, sum of the seconds]
+        self.stages = {stage: [[0] * (len(BUCKETS) + 1), 0.0] for stage in STAGES}
+        # status code -> responses sent
+        self.responses = {}
+        self.bytes_sent = 0
+        self.opened = 0
+        self.closed = 0
+
+
+def shard():
+    """
+    Get the metrics of the current thread, created on its first use
+    :return: metrics of the thread
+    :rtype: Shard
+    """
+    try:
+        return local.shard
+    except AttributeError:
+        local.shard = Shard()
+        with shards_lock:
+            shards.append(local.shard)
+        return local.shard
+
+
+def observe(stage, seconds):
+    """
+    Record the time taken by a step of a request
+    :param stage: one of STAGES
+    :type stage: str
+    :param seconds: time taken
+    :type seconds: float
+    :return: None
+    :rtype: None
+    """
+    histogram = shard().stages[stage]
+    histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+    histogram[1] += seconds
+    return None
+
+
+def response(code, length):
+    """
+    Record a response sent
+    :param code: HTTP status code
+    :type code: int
+    :param length: bytes sent, header included
+    :type length: int
+    :return: None
+    :rtype: None
+    """
+    current = shard()
+    current.responses[code] = current.responses.get(code, 0) + 1
+    current.bytes_sent += length
+    return None
+
+
+def connection_opened():
+    """
+    Record a connection starting to be served
+    :return: None
+    :rtype: None
+    """
+    shard().opened += 1
+    return None
+
+
+def connection_closed():
+    """
+    Record a connection closed, in the thread which opened it
+    :return: None
+    :rtype: None
+    """
+    shard().closed += 1
+    return None
+
+
+def render():
+    """
+    Sum the metrics of every thread in the Prometheus text format.
+    With pre-fork, each worker process only knows its own connections.
+    :return: the metrics
+    :rtype: str
+    """
+    with shards_lock:
+        current = list(shards)
+    lines = ["# HELP http_request_stage_seconds Time taken by each step of the requests.",
+             "# TYPE http_request_stage_seconds histogram"]
+    for stage in STAGES:
+        counts = [0] * (len(BUCKETS) + 1)
+        total = 0.0
+        for one in current:
+            (shard_counts, shard_total) = one.stages[stage]
+            counts = [a + b for (a, b) in zip(counts, shard_counts)]
+            total += shard_total
+        cumulated = 0
+        for (bound, count) in zip(BUCKETS + ("+Inf",), counts):
+            cumulated += count
+            lines.append('http_request_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, cumulated))
+        lines.append('http_request_stage_seconds_sum{stage="%s"} %f' % (stage, total))
+        lines.append('http_request_stage_seconds_count{stage="%s"} %d' % (stage, cumulated))
+
+    responses = {}
+    for one in current:
+        for (code, count) in list(one.responses.items()):
+            responses[code] = responses.get(code, 0) + count
+    lines += ["# HELP http_responses_total Responses sent, by status code.",
+              "# TYPE http_responses_total counter"]
+    lines += ['http_responses_total{code="%d"} %d' % (code, responses[code]) for code in sorted(responses)]
+    lines += ["# HELP http_response_bytes_total Bytes sent in the responses, headers included.",
+              "# TYPE http_response_bytes_total counter",
+              "http_response_bytes_total %d" % sum(one.bytes_sent for one in current),
+              "# HELP http_connections_active Connections being served.",
+              "# TYPE http_connections_active gauge",
+              "http_connections_active %d" % sum(one.opened - one.closed for one in current),
+              "# HELP http_threads Threads of the process.",
+              "# TYPE http_threads gauge",
+              "http_threads %d" % threading.active_count()]
+    for (name, (description, value)) in sorted(gauges.items()):
+        lines += ["# HELP " + name + " " + description, "# TYPE " + name + " gauge", "%s %d" % (name, value())]
+    for (name, (description, value)) in sorted(counters.items()):
+        lines += ["# HELP " + name + " " + description, "# TYPE " + name + " counter", "%s %d" % (name, value())]
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    # Test
+
+    # ----- observe() / response()
+
+    observe("read", 0.0003)
+    observe("read", 10)
+    response(200, 100)
+    response(404, 50)
+    connection_opened()
+
+    # OTHER THREADS HAVE THEIR OWN METRICS
+    def record():
+        observe("read", 0.0003)
+        response(200, 100)
+        connection_opened()
+        connection_closed()
+
+    threads = [threading.Thread(target=record) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(shards) == 5
+    assert shard().stages["read"][0][2] == 1 and shard().stages["read"][0][-1] == 1
+    print("Test observe OK")
+
+    # ----- render()
+
+    gauges["http_queue_depth"] = ("Accepted connections waiting for a worker.", lambda: 3)
+    counters["http_refused_total"] = ("Connections refused.", lambda: 7)
+    text = render().splitlines()
+    assert 'http_request_stage_seconds_bucket{stage="read",le="0.00025"} 0' in text
+    assert 'http_request_stage_seconds_bucket{stage="read",le="0.0005"} 5' in text
+    assert 'http_request_stage_seconds_bucket{stage="read",le="+Inf"} 6' in text
+    assert 'http_request_stage_seconds_count{stage="send"} 0' in text
+    assert 'http_responses_total{code="200"} 5' in text and 'http_responses_total{code="404"} 1' in text
+    assert "http_response_bytes_total 550" in text and "http_connections_active 1" in text
+    assert "# TYPE http_queue_depth gauge" in text and "http_queue_depth 3" in text
+    assert "# TYPE http_refused_total counter" in text and "http_refused_total 7" in text
+    print("Test render OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,905 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import collections
+import itertools
+import socket
+import threading
+import time
+# Internal modules
+import config_srv
+import metrics_http
+
+# Bytes relayed at once between a client and an upstream server
+COPY_SIZE = 64 * 1024
+# Length of the bodies sent in chunks
+CHUNKED = -1
+# Header fields of a single connection, never relayed (the body is relayed as received, Transfer-Encoding included)
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "te", "trailer", "upgrade", "expect"}
+# Methods sent again on a new connection when a pooled one fails (RFC 9110 9.2.2)
+IDEMPOTENT = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"}
+
+# "host:port" -> Backend, kept while the Upstreams setting names it
+backends = {}
+# (Upstreams setting, [(prefix, backends, counter)] longest prefix first) built from it
+routes = (None, [])
+stats = {'opened': 0, 'reused': 0, 'errors': 0}
+checker = None
+
+lock = threading.Lock()
+
+
+class ClientError(Exception):
+    """
+    Failure of the client while its request body is relayed: connection closed or too slow, malformed chunk
+    """
+
+    def __init__(self, code):
+        super().__init__(code)
+        # Status code answered to the client: 408 when it was too slow, 400 otherwise
+        self.code = code
+
+
+class Backend:
+    """
+    Upstream server: its connections kept open and its state for the balancing
+    """
+    __slots__ = ("address", "idle", "streams", "active", "healthy")
+
+    def __init__(self, address):
+        # (host, port)
+        self.address = address
+        # Open sockets waiting for a request of the threads engine, the most recently used last
+        self.idle = collections.deque()
+        # Open (reader, writer, task reading while idle) waiting for a request of the asyncio engine
+        self.streams = collections.deque()
+        # Requests being forwarded
+        self.active = 0
+        self.healthy = True
+
+
+class Connection:
+    """
+    Socket and the bytes received from it not used yet
+    """
+    __slots__ = ("sock", "buffer")
+
+    def __init__(self, sock, buffer=None):
+        self.sock = sock
+        self.buffer = bytearray() if buffer is None else buffer
+
+    def read(self, size):
+        """
+        Get at most size bytes
+        :type size: int
+        :return: the bytes, empty when the connection is closed
+        :rtype: bytes
+        """
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        return self.sock.recv(size)
+
+    def readline(self):
+        """
+        Get a line, CRLF included, at most MaxHeaderSize bytes
+        :return: the line
+        :rtype: bytes
+        :raise: ValueError for a line too long, ConnectionError when the connection is closed before its end
+        """
+        searched = 0
+        while True:
+            end = self.buffer.find(b"\n", searched)
+            if end != -1:
+                line = bytes(self.buffer[:end + 1])
+                del self.buffer[:end + 1]
+                return line
+            if len(self.buffer) >= config_srv.CONFIGURATION['MaxHeaderSize']:
+                raise ValueError("Line too long")
+            searched = len(self.buffer)
+            data = self.sock.recv(COPY_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed")
+            self.buffer += data
+
+
+def parse_address(value):
+    """
+    :param value: "host:port"
+    :type value: str
+    :return: (host, port)
+    :rtype: tuple
+    :raise: ValueError
+    """
+    (host, colon, port) = value.strip().rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("Upstream server must be host:port: " + value)
+    return host.strip("[]"), int(port)
+
+
+def table():
+    """
+    Get the routes of the Upstreams setting, built again when it changes:
+    path prefix -> "host:port" list or comma separated string
+    :return: [(prefix, backends, counter)], the longest prefixes first
+    :rtype: list
+    """
+    global routes
+    upstreams = config_srv.CONFIGURATION['Upstreams']
+    if routes[0] is upstreams:
+        return routes[1]
+    with lock:
+        if routes[0] is upstreams:
+            return routes[1]
+        current = {}
+        built = []
+        for (prefix, servers) in upstreams.items():
+            if isinstance(servers, str):
+                servers = servers.split(",")
+            chosen = []
+            for server in servers:
+                try:
+                    address = parse_address(server)
+                except ValueError as e:
+                    print(e)
+                    continue
+                name = "%s:%d" % address
+                current[name] = backends.get(name) or current.get(name) or Backend(address)
+                chosen.append(current[name])
+            if chosen:
+                built.append((prefix, chosen, itertools.count()))
+        for (name, backend) in backends.items():
+            if name not in current:
+                while backend.idle:
+                    backend.idle.pop().close()
+        backends.clear()
+        backends.update(current)
+        built.sort(key=lambda route: len(route[0]), reverse=True)
+        routes = (upstreams, built)
+    return built
+
+
+def route(request):
+    """
+    Find the upstream servers of a request from the prefix of its target
+    :param request: request header
+    :type request: str
+    :return: (prefix, backends, counter), None when the request is served from the files
+    :rtype: tuple or None
+    """
+    if not config_srv.CONFIGURATION['Upstreams']:
+        return None
+    parts = request.split(" ", 2)
+    if len(parts) < 3:
+        return None
+    for one in table():
+        if parts[1].startswith(one[0]):
+            return one
+    return None
+
+
+def choose(chosen):
+    """
+    Pick a healthy upstream server of a route below UpstreamMaxConnections requests,
+    in turn, or the one with the fewest requests with UpstreamBalancing "least-connections"
+    :param chosen: route
+    :type chosen: tuple
+    :return: the server, counted as active until release, None when none is available
+    :rtype: Backend or None
+    """
+    (prefix, servers, counter) = chosen
+    max_connections = config_srv.CONFIGURATION['UpstreamMaxConnections']
+    with lock:
+        candidates = [backend for backend in servers if backend.healthy and backend.active < max_connections]
+        if not candidates:
+            return None
+        if config_srv.CONFIGURATION['UpstreamBalancing'] == "least-connections":
+            fewest = min(backend.active for backend in candidates)
+            candidates = [backend for backend in candidates if backend.active == fewest]
+        backend = candidates[next(counter) % len(candidates)]
+        backend.active += 1
+    return backend
+
+
+def alive(sock):
+    """
+    Tells if an idle connection can still be used: not closed by the server, nothing unexpected received
+    :type sock: socket.socket
+    :rtype: bool
+    """
+    try:
+        sock.setblocking(False)
+        sock.recv(1, socket.MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+def acquire(backend):
+    """
+    Get a connection to an upstream server, an idle one when there is one
+    :type backend: Backend
+    :return: the connection, and whether it was used before
+    :rtype: tuple
+    :raise: OSError when the server can't be reached
+    """
+    timeout = config_srv.CONFIGURATION['UpstreamTimeout']
+    while True:
+        with lock:
+            sock = backend.idle.pop() if backend.idle else None
+        if sock is None:
+            break
+        if alive(sock):
+            sock.settimeout(timeout)
+            stats['reused'] += 1
+            return Connection(sock), True
+        sock.close()
+    sock = socket.create_connection(backend.address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    stats['opened'] += 1
+    return Connection(sock), False
+
+
+def release(backend, connection, reusable):
+    """
+    End a request forwarded to an upstream server, its connection being kept
+    for the next requests while there are less than UpstreamPoolSize idle ones
+    :type backend: Backend
+    :param connection: the connection, None if it failed
+    :type connection: Connection or None
+    :param reusable: the response was read entirely and the server keeps the connection open
+    :type reusable: bool
+    :return: None
+    :rtype: None
+    """
+    with lock:
+        backend.active -= 1
+        if reusable and not connection.buffer and len(backend.idle) < config_srv.CONFIGURATION['UpstreamPoolSize']:
+            backend.idle.append(connection.sock)
+            return None
+    if connection is not None:
+        connection.sock.close()
+    return None
+
+
+def failed(backend):
+    """
+    Take an upstream server out of the balancing until its next successful health check
+    :type backend: Backend
+    :return: None
+    :rtype: None
+    """
+    stats['errors'] += 1
+    if config_srv.CONFIGURATION['UpstreamHealthInterval'] and backend.healthy:
+        backend.healthy = False
+        print("Upstream server %s:%d is down." % backend.address)
+    return None
+
+
+def parse_head(text):
+    """
+    Split a request or response header
+    :param text: header, the empty line included
+    :type text: str
+    :return: the three parts of the first line, and the (name, value) fields in their order
+    :rtype: tuple
+    :raise: ValueError
+    """
+    lines = text.split("\r\n")
+    first = lines[0].split(" ", 2)
+    if len(first) != 3:
+        raise ValueError("Malformed first line: " + lines[0])
+    fields = []
+    for line in lines[1:]:
+        if line == "":
+            continue
+        (name, colon, value) = line.partition(":")
+        if not colon or not name or name != name.strip():
+            raise ValueError("Malformed field: " + line)
+        fields.append((name, value.strip()))
+    return first, fields
+
+
+def field(fields, name):
+    """
+    :param fields: (name, value) fields
+    :type fields: list
+    :param name: name in lower case
+    :type name: str
+    :return: the values of the fields of this name joined by commas, "" when there is none
+    :rtype: str
+    """
+    return ", ".join(value for (key, value) in fields if key.lower() == name)
+
+
+def relayed(fields):
+    """
+    Remove the fields of the connection, and the ones it lists.
+    Content-Length is removed too when Transfer-Encoding overrides it (RFC 9112 6.3):
+    a next hop honouring it would read the rest of the body as another message.
+    :param fields: (name, value) fields
+    :type fields: list
+    :return: fields to relay
+    :rtype: list
+    """
+    listed = {token.strip().lower() for token in field(fields, "connection").split(",")}
+    if field(fields, "transfer-encoding"):
+        listed.add("content-length")
+    return [(name, value) for (name, value) in fields if name.lower() not in HOP_BY_HOP and name.lower() not in listed]
+
+
+def persistent(version, fields):
+    """
+    Tells if the other side keeps the connection open, like client_http.wants_keep_alive
+    :param version: "HTTP/1.1" or "HTTP/1.0"
+    :type version: str
+    :param fields: (name, value) fields
+    :type fields: list
+    :rtype: bool
+    """
+    connection = field(fields, "connection").lower()
+    if version == "HTTP/1.0":
+        return "keep-alive" in connection
+    return version == "HTTP/1.1" and "close" not in connection
+
+
+def request_length(fields):
+    """
+    Length of a request body
+    :param fields: (name, value) fields
+    :type fields: list
+    :return: bytes, or CHUNKED
+    :rtype: int
+    :raise: ValueError for a length which can't be trusted
+    """
+    encoding = field(fields, "transfer-encoding").lower()
+    if encoding:
+        if encoding != "chunked":
+            raise ValueError("Unsupported transfer encoding: " + encoding)
+        if field(fields, "content-length"):
+            # Framed differently by the servers honouring one field or the other (RFC 9112 6.1)
+            raise ValueError("Content-Length with Transfer-Encoding")
+        return CHUNKED
+    length = field(fields, "content-length")
+    if not length:
+        return 0
+    if not length.isdigit():
+        raise ValueError("Invalid Content-Length: " + length)
+    return int(length)
+
+
+def response_length(method, code, fields):
+    """
+    Length of a response body
+    :param method: method of the request
+    :type method: str
+    :param code: status code
+    :type code: int
+    :param fields: (name, value) fields
+    :type fields: list
+    :return: bytes, CHUNKED, or None when the body lasts until the connection is closed
+    :rtype: int or None
+    :raise: ValueError for a length which can't be trusted
+    """
+    if method == "HEAD" or code in (204, 304) or code < 200:
+        return 0
+    encoding = field(fields, "transfer-encoding").lower()
+    if encoding:
+        return CHUNKED if encoding.endswith("chunked") else None
+    length = field(fields, "content-length")
+    if not length:
+        return None
+    if not length.isdigit():
+        raise ValueError("Invalid Content-Length: " + length)
+    return int(length)
+
+
+def upstream_request(method, target, fields, backend, address):
+    """
+    Header of a request forwarded to an upstream server, on a persistent connection
+    :param method: method of the request
+    :type method: str
+    :param target: target of the request
+    :type target: str
+    :param fields: (name, value) fields of the request
+    :type fields: list
+    :type backend: Backend
+    :param address: IP address of the client, added to X-Forwarded-For
+    :type address: str
+    :rtype: bytes
+    """
+    fields = relayed(fields)
+    forwarded = field(fields, "x-forwarded-for")
+    lines = [method + " " + target + " HTTP/1.1"]
+    lines += [name + ": " + value for (name, value) in fields if name.lower() != "x-forwarded-for"]
+    if not field(fields, "host"):
+        lines.append("Host: %s:%d" % backend.address)
+    lines.append("X-Forwarded-For: " + (forwarded + ", " + address if forwarded else address))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def client_response(first, fields, keep_alive, dechunk=False):
+    """
+    Header of an upstream response relayed to the client
+    :param first: parts of the status line
+    :type first: list
+    :param fields: (name, value) fields of the response
+    :type fields: list
+    :param keep_alive: announce a persistent connection instead of closing it
+    :type keep_alive: bool
+    :param dechunk: the body is relayed without its chunks, until the connection is closed
+    :type dechunk: bool
+    :rtype: bytes
+    """
+    lines = ["HTTP/1.1 " + first[1] + " " + first[2]]
+    lines += [name + ": " + value for (name, value) in relayed(fields)
+              if not dechunk or name.lower() != "transfer-encoding"]
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def read_head(connection):
+    """
+    Read a response header, at most MaxHeaderSize bytes
+    :type connection: Connection
+    :return: the header
+    :rtype: str
+    :raise: ValueError, OSError
+    """
+    lines = []
+    size = 0
+    while True:
+        line = connection.readline()
+        size += len(line)
+        if size > config_srv.CONFIGURATION['MaxHeaderSize']:
+            raise ValueError("Response header too large")
+        if line in (b"\r\n", b"\n"):
+            return "".join(lines) + "\r\n"
+        lines.append(line.decode("latin-1").rstrip("\r\n") + "\r\n")
+
+
+def copy_length(source, send, length):
+    """
+    Relay a body of a known length
+    :type source: Connection
+    :param send: function sending the bytes to the other side
+    :type send: function
+    :param length: bytes to relay
+    :type length: int
+    :return: bytes relayed
+    :rtype: int
+    :raise: ConnectionError when the source is closed before the end
+    """
+    left = length
+    while left > 0:
+        data = source.read(min(left, COPY_SIZE))
+        if not data:
+            raise ConnectionError("Connection closed before the end of the body")
+        send(data)
+        left -= len(data)
+    return length
+
+
+def copy_chunked(source, send, dechunk=False):
+    """
+    Relay a body sent in chunks as it is received, up to its last chunk and its trailer,
+    or only the data of the chunks for an HTTP/1.0 client
+    :type source: Connection
+    :param send: function sending the bytes to the other side
+    :type send: function
+    :param dechunk: relay only the data of the chunks
+    :type dechunk: bool
+    :return: bytes relayed
+    :rtype: int
+    :raise: ValueError for a malformed chunk, ConnectionError when the source is closed before the end
+    """
+    length = 0
+    while True:
+        line = source.readline()
+        size = int(line.split(b";")[0], 16)
+        if not dechunk:
+            send(line)
+            length += len(line)
+        if size == 0:
+            break
+        if dechunk:
+            length += copy_length(source, send, size)
+            source.readline()
+        else:
+            # Chunk and its CRLF
+            length += copy_length(source, send, size + 2)
+    while True:
+        line = source.readline()
+        if not dechunk:
+            send(line)
+            length += len(line)
+        if line in (b"\r\n", b"\n"):
+            return length
+
+
+def copy_until_close(source, send):
+    """
+    Relay a body lasting until the source closes the connection
+    :type source: Connection
+    :param send: function sending the bytes to the other side
+    :type send: function
+    :return: bytes relayed
+    :rtype: int
+    """
+    length = 0
+    while True:
+        data = source.read(COPY_SIZE)
+        if not data:
+            return length
+        send(data)
+        length += len(data)
+
+
+def copy_body(source, send, length, dechunk=False):
+    """
+    Relay a body of a length given by request_length or response_length
+    :type source: Connection
+    :type send: function
+    :type length: int or None
+    :param dechunk: relay only the data of a body sent in chunks
+    :type dechunk: bool
+    :return: bytes relayed
+    :rtype: int
+    """
+    if length == CHUNKED:
+        return copy_chunked(source, send, dechunk)
+    if length is None:
+        return copy_until_close(source, send)
+    return copy_length(source, send, length)
+
+
+def relay_request_body(client, sock, length):
+    """
+    Relay a request body to an upstream server, the failures of the client
+    being told from the ones of the server
+    :type client: Connection
+    :param sock: socket of the upstream server
+    :type sock: socket.socket
+    :param length: bytes, or CHUNKED
+    :type length: int
+    :return: bytes relayed
+    :rtype: int
+    :raise: ClientError when the client fails, OSError when the server does
+    """
+    sending = False
+
+    def send(data):
+        nonlocal sending
+        sending = True
+        sock.sendall(data)
+        sending = False
+
+    try:
+        return copy_body(client, send, length)
+    except socket.timeout as e:
+        if sending:
+            raise
+        raise ClientError(408) from e
+    except (OSError, ValueError) as e:
+        if sending:
+            raise
+        raise ClientError(400) from e
+
+
+def forward(sock_client, buffer, request, chosen, keep_alive, address):
+    """
+    Forward a request to an upstream server of its route and relay the response,
+    the bodies being streamed in both directions without being kept in memory.
+    A connection used before which fails before answering is replaced by a new one
+    when the request has no body and an idempotent method; an unreachable server is answered 502,
+    a server not answering within UpstreamTimeout seconds 504, a client failing
+    to send its request body 400, or 408 if it is too slow, the server not being blamed.
+    :param sock_client: socket representing the connection with the client
+    :type sock_client: socket.socket
+    :param buffer: bytes received from the client and not used yet, starting with the request body
+    :type buffer: bytearray
+    :param request: request header
+    :type request: str
+    :param chosen: route given by route
+    :type chosen: tuple
+    :param keep_alive: the connection may stay open if the client wants it
+    :type keep_alive: bool
+    :param address: IP address of the client
+    :type address: str
+    :return: status code, header and body lengths sent to the client, whether the connection stays open;
+             the header length is None for an error to answer (400, 408, 502, 503 or 504), nothing being sent
+    :rtype: tuple
+    :raise: OSError when the client connection fails before the response
+    """
+    try:
+        (first, fields) = parse_head(request)
+        length = request_length(fields)
+    except ValueError:
+        return 400, None, 0, False
+    (method, target, version) = first
+    keep_alive = keep_alive and persistent(version, fields)
+    backend = choose(chosen)
+    if backend is None:
+        return 503, None, 0, False
+    head = upstream_request(method, target, fields, backend, address)
+    if "100-continue" in field(fields, "expect").lower():
+        # The body is streamed right after the header, the server is not asked first
+        sock_client.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+    client = Connection(sock_client, buffer)
+    upstream = None
+    while True:
+        try:
+            (upstream, reused) = acquire(backend)
+        except OSError:
+            failed(backend)
+            release(backend, None, False)
+            return 502, None, 0, False
+        try:
+            upstream.sock.sendall(head)
+            if length:
+                relay_request_body(client, upstream.sock, length)
+            status = read_head(upstream)
+            (response, response_fields) = parse_head(status)
+            # Interim responses, like 100 Continue, are not relayed
+            while response[1].startswith("1") and response[1] != "101":
+                (response, response_fields) = parse_head(read_head(upstream))
+            code = int(response[1])
+            body = response_length(method, code, response_fields)
+            break
+        except ClientError as e:
+            release(backend, upstream, False)
+            return e.code, None, 0, False
+        except socket.timeout:
+            stats['errors'] += 1
+            release(backend, upstream, False)
+            return 504, None, 0, False
+        except (OSError, ValueError):
+            upstream.sock.close()
+            if reused and not length and method in IDEMPOTENT:
+                continue
+            stats['errors'] += 1
+            release(backend, None, False)
+            return 502, None, 0, False
+    # An HTTP/1.0 client does not know the chunks: it gets their data until the connection is closed
+    dechunk = body == CHUNKED and version == "HTTP/1.0"
+    keep_alive = keep_alive and body is not None and not dechunk
+    header = client_response(response, response_fields, keep_alive, dechunk)
+    sent = 0
+    try:
+        sock_client.sendall(header)
+        sent = copy_body(upstream, sock_client.sendall, body, dechunk)
+        reusable = body is not None and persistent(response[0], response_fields)
+    except (OSError, ValueError):
+        # The response is started: the client only sees the connection closed
+        (reusable, keep_alive) = (False, False)
+    release(backend, upstream, reusable)
+    return code, len(header), sent, keep_alive
+
+
+def check(backend):
+    """
+    Ask UpstreamHealthPath to an upstream server on a new connection
+    :type backend: Backend
+    :return: True if it answered without a server error
+    :rtype: bool
+    """
+    request = "GET %s HTTP/1.1\r\nHost: %s:%d\r\nConnection: close\r\n\r\n" % (
+        (config_srv.CONFIGURATION['UpstreamHealthPath'],) + backend.address)
+    try:
+        with socket.create_connection(backend.address, config_srv.CONFIGURATION['UpstreamTimeout']) as sock:
+            sock.sendall(request.encode("latin-1"))
+            status = Connection(sock).readline().split()
+        return int(status[1]) < 500
+    except (OSError, ValueError, IndexError):
+        return False
+
+
+def check_forever():
+    """
+    Health checker thread: check every upstream server each UpstreamHealthInterval seconds,
+    the ones failing are left out of the balancing until they answer again
+    :return: None
+    :rtype: None
+    """
+    while True:
+        interval = config_srv.CONFIGURATION['UpstreamHealthInterval']
+        time.sleep(interval or 1)
+        if not interval:
+            continue
+        table()
+        for backend in list(backends.values()):
+            healthy = check(backend)
+            if healthy != backend.healthy:
+                print("Upstream server %s:%d is %s." % (backend.address + ("up" if healthy else "down",)))
+                backend.healthy = healthy
+
+
+def start():
+    """
+    Start the health checker thread, from each process serving connections
+    :return: None
+    :rtype: None
+    """
+    global checker
+    if checker is None:
+        checker = threading.Thread(target=check_forever, daemon=True)
+        checker.start()
+    return None
+
+
+metrics_http.counters['http_upstream_connections_opened_total'] = (
+    "Connections opened to the upstream servers.", lambda: stats['opened'])
+metrics_http.counters['http_upstream_connections_reused_total'] = (
+    "Requests forwarded on an idle upstream connection.", lambda: stats['reused'])
+metrics_http.counters['http_upstream_errors_total'] = (
+    "Requests not answered by their upstream server.", lambda: stats['errors'])
+metrics_http.gauges['http_upstream_connections_idle'] = (
+    "Upstream connections waiting for a request.",
+    lambda: sum(len(backend.idle) + len(backend.streams) for backend in list(backends.values())))
+metrics_http.gauges['http_upstream_healthy'] = (
+    "Upstream servers in the balancing.", lambda: sum(backend.healthy for backend in list(backends.values())))
+
+
+def main():
+    # Test
+    import http.server
+
+    class Upstream(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path in ("/api/chunked", "/api/both"):
+                self.send_response(200)
+                if self.path == "/api/both":
+                    self.send_header("Content-Length", "4")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.wfile.write(b"5\r\nhello\r\n0\r\n\r\n")
+                return
+            self.answer(("%d %s" % (self.server.server_port, self.headers["X-Forwarded-For"])).encode())
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            body = self.rfile.read(length)
+            # Not answered when the proxy gives up the request, its client failing to send the body
+            if len(body) == length:
+                self.answer(body)
+
+        def answer(self, body):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    servers = [http.server.ThreadingHTTPServer(("127.0.0.1", 0), Upstream) for i in range(2)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports = [server.server_port for server in servers]
+    config_srv.update({'Upstreams': {"/api/": ["127.0.0.1:%d" % port for port in ports],
+                                     "/api/one/": "127.0.0.1:%d" % ports[1]}})
+
+    def proxied(request, body=b""):
+        (server_side, client_side) = socket.socketpair()
+        with client_side:
+            result = forward(server_side, bytearray(body), request, route(request), True, "10.0.0.1")
+            server_side.close()
+            response = b""
+            while True:
+                data = client_side.recv(COPY_SIZE)
+                if not data:
+                    return result, response
+                response += data
+
+    # ----- route()
+
+    assert route("GET /index.html HTTP/1.1\r\n\r\n") is None
+    assert [backend.address[1] for backend in route("GET /api/x HTTP/1.1\r\n\r\n")[1]] == ports
+    assert [backend.address[1] for backend in route("GET /api/one/x HTTP/1.1\r\n\r\n")[1]] == ports[1:]
+    assert len(backends) == 2
+    print("Test route OK")
+
+    # ----- request_length() / response_length()
+
+    assert request_length([("Content-Length", "12")]) == 12 and request_length([]) == 0
+    assert request_length([("Transfer-Encoding", "chunked")]) == CHUNKED
+    assert response_length("HEAD", 200, [("Content-Length", "12")]) == 0
+    assert response_length("GET", 304, []) == 0 and response_length("GET", 200, []) is None
+    for fields in ([("Content-Length", "-1")], [("Content-Length", "4"), ("Transfer-Encoding", "chunked")]):
+        try:
+            request_length(fields)
+            assert False
+        except ValueError:
+            pass
+    # CONTENT-LENGTH NEVER RELAYED WITH TRANSFER-ENCODING
+    assert relayed([("Content-Length", "4"), ("Transfer-Encoding", "chunked"), ("Host", "a")]) == [
+        ("Transfer-Encoding", "chunked"), ("Host", "a")]
+    print("Test response_length OK")
+
+    # ----- forward()
+
+    # IN TURN ON THE POOLED CONNECTIONS
+    answered = [proxied("GET /api/x HTTP/1.1\r\nHost: a\r\nX-Forwarded-For: 10.0.0.9\r\n\r\n") for i in range(4)]
+    for (i, (result, response)) in enumerate(answered):
+        assert result[0] == 200 and result[3]
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n") and b"Connection: keep-alive\r\n" in response
+        assert response.endswith(b"%d 10.0.0.9, 10.0.0.1" % ports[i % 2])
+    assert stats['opened'] == 2 and stats['reused'] == 2
+    assert all(len(backend.idle) == 1 and backend.active == 0 for backend in backends.values())
+    # BODY STREAMED FROM THE CLIENT BUFFER
+    (result, response) = proxied("POST /api/one/ HTTP/1.1\r\nContent-Length: 5\r\nConnection: close\r\n\r\n", b"hello")
+    assert response.endswith(b"\r\n\r\nhello") and b"Connection: close\r\n" in response and not result[3]
+    (result, response) = proxied("GET /api/chunked HTTP/1.1\r\n\r\n")
+    assert response.endswith(b"\r\n\r\n5\r\nhello\r\n0\r\n\r\n") and result[2] == 15
+    # CHUNKS REMOVED FOR AN HTTP/1.0 CLIENT, THE CONNECTION CLOSED
+    (result, response) = proxied("GET /api/chunked HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+    assert response.endswith(b"\r\n\r\nhello") and b"Transfer-Encoding" not in response
+    assert b"Connection: close\r\n" in response and result[2] == 5 and not result[3]
+    # SMUGGLING: A BODY FRAMED BY BOTH FIELDS
+    (result, response) = proxied("GET /api/both HTTP/1.1\r\n\r\n")
+    assert response.endswith(b"\r\n\r\n5\r\nhello\r\n0\r\n\r\n") and b"Content-Length" not in response
+    request = "POST /api/ HTTP/1.1\r\nContent-Length: 4\r\nTransfer-Encoding: chunked\r\n\r\n"
+    assert proxied(request, b"0\r\n\r\nGET /api/x HTTP/1.1\r\n\r\n") == ((400, None, 0, False), b"")
+    # CLIENT CLOSING OR TOO SLOW WHILE SENDING ITS BODY, THE SERVER NOT BLAMED
+    errors = stats['errors']
+    request = "POST /api/ HTTP/1.1\r\nContent-Length: 5\r\n\r\n"
+    for (timeout, code) in ((None, 400), (0.1, 408)):
+        (server_side, client_side) = socket.socketpair()
+        server_side.settimeout(timeout)
+        client_side.sendall(b"hel")
+        if timeout is None:
+            client_side.shutdown(socket.SHUT_WR)
+        assert forward(server_side, bytearray(), request, route(request), True, "10.0.0.1") == (code, None, 0, False)
+        server_side.close()
+        client_side.close()
+    assert stats['errors'] == errors
+
+    def stale(backend):
+        # Pooled connection closed by the server once the request received
+        (pooled, upstream_side) = socket.socketpair()
+        threading.Thread(target=lambda: (upstream_side.recv(COPY_SIZE), upstream_side.close()), daemon=True).start()
+        backend.idle.append(pooled)
+
+    # ONLY AN IDEMPOTENT REQUEST SENT AGAIN WHEN A POOLED CONNECTION FAILS
+    stale(backends["127.0.0.1:%d" % ports[1]])
+    assert proxied("GET /api/one/ HTTP/1.1\r\n\r\n")[0][0] == 200
+    stale(backends["127.0.0.1:%d" % ports[1]])
+    assert proxied("POST /api/one/ HTTP/1.1\r\nContent-Length: 0\r\n\r\n")[0] == (502, None, 0, False)
+    # FEWEST REQUESTS
+    config_srv.update({'UpstreamBalancing': "least-connections"})
+    backends["127.0.0.1:%d" % ports[0]].active += 1
+    assert choose(route("GET /api/ HTTP/1.1\r\n\r\n")).address[1] == ports[1]
+    backends["127.0.0.1:%d" % ports[0]].active -= 1
+    backends["127.0.0.1:%d" % ports[1]].active -= 1
+    config_srv.update({'UpstreamBalancing': "round-robin"})
+    # UNREACHABLE SERVER LEFT OUT
+    servers[1].shutdown()
+    servers[1].server_close()
+    for backend in backends.values():
+        while backend.idle:
+            backend.idle.pop().close()
+    assert proxied("GET /api/one/ HTTP/1.1\r\n\r\n")[0] == (502, None, 0, False)
+    assert not backends["127.0.0.1:%d" % ports[1]].healthy
+    assert proxied("GET /api/one/ HTTP/1.1\r\n\r\n")[0] == (503, None, 0, False)
+    assert all(proxied("GET /api/ HTTP/1.1\r\n\r\n")[0][0] == 200 for i in range(2))
+    assert proxied("GET /api/ HTTP/1.1\r\nContent-Length: x\r\n\r\n")[0] == (400, None, 0, False)
+    print("Test forward OK")
+
+    # ----- check()
+
+    assert [check(backend) for backend in backends.values()] == [True, False]
+    text = metrics_http.render().splitlines()
+    assert "http_upstream_errors_total 2" in text and "http_upstream_healthy 1" in text
+    servers[0].shutdown()
+    config_srv.update({'Upstreams': {}})
+    print("Test check OK")
+
+
+if __name__ == "__main__":
+    main()
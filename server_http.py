@@ -2,12 +2,25 @@
 # -*- coding: utf-8 -*-
 
 # System modules
+import errno
+import os
+import queue
+import resource
+import signal
 import socket
 import sys
 import threading
+import time
 # Internal modules
-from config_srv import CONFIGURATION
+import async_http
+import cache_http
 import client_http
+import config_srv
+import limit_http
+import log_http
+import metrics_http
+import proxy_http
+import tls_http
 
 
 def config():
@@ -17,11 +30,37 @@ def config():
     :return: None
     :rtype: None
     """
-    CONFIGURATION['Host'] = socket.gethostname()
+    config_srv.override({'Host': socket.gethostname()})
     print("-------------")
-    print("Host:", CONFIGURATION['Host'])
-    print("Port :", CONFIGURATION['Port'])
-    print("Path :", CONFIGURATION['Path'])
+    print("Host:", config_srv.CONFIGURATION['Host'])
+    print("Port :", config_srv.CONFIGURATION['Port'])
+    print("Path :", config_srv.CONFIGURATION['Path'])
+    print("Engine :", config_srv.CONFIGURATION['Engine'])
+    print("Workers :", config_srv.CONFIGURATION['Workers'])
+    print("Processes :", config_srv.CONFIGURATION['Processes'] or os.cpu_count())
+    print("Preload :", config_srv.CONFIGURATION['Preload'])
+    print("Access log :", config_srv.CONFIGURATION['AccessLog'])
+    print("Limits :", config_srv.CONFIGURATION['MaxConnectionsPerIP'] or "-", "connections,",
+          config_srv.CONFIGURATION['RateLimit'] or "-", "requests/s per client")
+    print("TLS :", config_srv.CONFIGURATION['TlsCertificate'] or "-")
+    for (prefix, servers) in config_srv.CONFIGURATION['Upstreams'].items():
+        print("Proxy :", prefix, "->", servers if isinstance(servers, str) else ", ".join(servers))
+    return
+
+
+def raise_fd_limit():
+    """
+    Raise the limit of open files to its maximum,
+    each connection held open costs a file descriptor.
+    :return: None
+    :rtype: None
+    """
+    try:
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        print("Cannot raise the open files limit.")
     return
 
 
@@ -34,7 +73,12 @@ def server_shutdown(sock):
     """
     print("The server is shutting down.")
     try:
-        sock.shutdown(socket.SHUT_RDWR)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            # A socket bound but never listening (pre-fork master with SO_REUSEPORT) is not connected
+            if e.errno != errno.ENOTCONN:
+                raise
         sock.close()
         sys.exit(0)
     except OSError:
@@ -45,20 +89,29 @@ def server_shutdown(sock):
 def listen(sock):
     """
     Allows the server socket to listen for incoming connections.
-    Repeat the following sequence indefinitely:
+    Start the workers, then repeat the following sequence indefinitely:
         wait for a new incoming connection
         display a message on the console indicating this connection
+        refuse it if its client already has MaxConnectionsPerIP open
+        wrap it for TLS with HTTPS, its handshake being left to the worker
         transmits the necessary parameters to the start function
     :type sock: socket.socket
     :return: None
     :rtype: None
     """
     try:
+        start_workers()
         sock.listen()
         while True:
             (client, address) = sock.accept()
-            print("-------------" + "\n" + "Connection received from", address)
-            start(client)
+            log_http.debug("-------------" + "\n" + "Connection received from " + str(address))
+            counted = limit_http.connection_opened(address[0])
+            if counted is False:
+                refuse(client)
+                continue
+            if tls_http.context is not None:
+                client = tls_http.wrap(client)
+            start(client, address[0], counted)
     except KeyboardInterrupt:
         print("Socket stopped manually")
     except OSError:
@@ -66,28 +119,289 @@ def listen(sock):
     return
 
 
-def start(sock):
+# Accepted connections waiting for a worker, (socket, IP address of the client, counted by limit_http)
+connections = None
+
+
+def start_workers():
+    """
+    Start the fixed pool of threads serving the accepted connections,
+    fed by a waiting queue bounded by QueueSize
+    :return: None
+    :rtype: None
+    """
+    global connections
+    connections = queue.Queue(config_srv.CONFIGURATION['QueueSize'])
+    metrics_http.gauges['http_queue_depth'] = ("Accepted connections waiting for a worker thread.",
+                                               connections.qsize)
+    for i in range(config_srv.CONFIGURATION['Workers']):
+        t = threading.Thread(target=worker, args=[connections], daemon=True)
+        t.start()
+    return
+
+
+def worker(waiting):
     """
-    Start a new thread to manage a new connection
-    :t: thread
+    Serve the connections of the waiting queue one after the other
+    :param waiting: accepted connections
+    :type waiting: queue.Queue
+    :return: None
+    :rtype: None
+    """
+    while True:
+        (sock, address, counted) = waiting.get()
+        try:
+            client_http.client_processing(sock)
+        except Exception as e:
+            # A failing connection must not kill the worker
+            print(e)
+        finally:
+            if counted:
+                limit_http.connection_closed(address)
+
+
+def start(sock, address, counted):
+    """
+    Hand a new connection over to the pool of workers.
+    When the waiting queue is full, block the accept loop
+    or answer 503 right away, depending on QueuePolicy.
     :param sock: socket
+    :param address: IP address of the client
+    :type address: str
+    :param counted: the connection was counted by limit_http.connection_opened
+    :type counted: bool or None
     :return: None
     """
     try:
-        t = threading.Thread(target=client_http.client_processing, args=[sock])
-        t.start()
+        if config_srv.CONFIGURATION['QueuePolicy'] == "503":
+            connections.put_nowait((sock, address, counted))
+        else:
+            connections.put((sock, address, counted))
+    except queue.Full:
+        refuse(sock)
+        if counted:
+            limit_http.connection_closed(address)
+    return
+
+
+def refuse(sock):
+    """
+    Answer 503 to a connection the server can't serve, or just close it with HTTPS:
+    the client can't read an answer before a handshake that would block the accept loop
+    :param sock: socket
+    :return: None
+    """
+    if tls_http.context is not None:
+        sock.close()
+    else:
+        client_http.reject(sock, 503)
+    return
+
+
+def serve(sock):
+    """
+    Serve the connections of a bound socket with the configured engine,
+    the access log being written by a thread of the process meanwhile,
+    and the upstream servers checked by another one
+    :type sock: socket.socket
+    :return: None
+    :rtype: None
+    """
+    log_http.start()
+    proxy_http.start()
+    try:
+        if config_srv.CONFIGURATION['Engine'] == "asyncio":
+            async_http.listen(sock)
+        else:
+            listen(sock)
+    finally:
+        log_http.stop()
+    return
+
+
+def interrupt(signum, frame):
+    """
+    Signal handler stopping the server like a manual interruption
+    :raise: KeyboardInterrupt
+    """
+    raise KeyboardInterrupt
+
+
+reload_lock = threading.Lock()
+
+
+def preload():
+    """
+    Preload the files of the document root, replacing the ones preloaded before,
+    and display the time it took and the memory used
+    :return: None
+    :rtype: None
+    """
+    begin = time.perf_counter()
+    (table, in_memory, mapped) = client_http.preload(config_srv.CONFIGURATION['Path'])
+    cache_http.install_preloaded(table)
+    print("Preloaded", len(table), "files in", round((time.perf_counter() - begin) * 1000, 1), "ms:",
+          in_memory, "bytes in memory,", mapped, "bytes mapped")
+    return
+
+
+def reload():
+    """
+    Apply the configuration file given to the server again, then preload the document root again
+    :return: None
+    :rtype: None
+    """
+    with reload_lock:
+        config_srv.reload()
+        if config_srv.CONFIGURATION['Preload']:
+            preload()
+    return
+
+
+def hangup(signum, frame):
+    """
+    SIGHUP handler reloading the configuration file and the preloaded files.
+    The connections keep being served during the reload, done in a thread,
+    and the pre-fork master forwards the signal to its workers.
+    :return: None
+    :rtype: None
+    """
+    threading.Thread(target=reload, daemon=True).start()
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except ProcessLookupError:
+            pass
+    return
+
+
+# Worker processes of the pre-fork mode
+workers = set()
+
+
+def spawn_worker(sock, reuse_port):
+    """
+    Fork a worker process serving the connections.
+    With reuse_port, the worker binds its own socket on the same address
+    and the kernel balances the connections between the workers,
+    otherwise it accepts on the listening socket inherited from the master.
+    :type sock: socket.socket
+    :type reuse_port: bool
+    :return: None
+    :rtype: None
+    """
+    pid = os.fork()
+    if pid != 0:
+        workers.add(pid)
+        return
+    # Worker process, its hangup handler must not signal the other workers
+    workers.clear()
+    code = 1
+    try:
+        config_srv.watch()
+        signal.signal(signal.SIGTERM, interrupt)
+        if reuse_port:
+            address = sock.getsockname()
+            sock.close()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(address)
+        serve(sock)
+        code = 0
+    except KeyboardInterrupt:
+        code = 0
     except OSError:
-        return None
+        print("Worker", os.getpid(), "failure.")
+    finally:
+        os._exit(code)
+
+
+def stop_workers(timeout=5):
+    """
+    Ask every worker process to stop, and kill the ones still running after timeout seconds
+    :type timeout: int
+    :return: None
+    :rtype: None
+    """
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    while workers:
+        for pid in list(workers):
+            try:
+                (done, status) = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done == pid:
+                workers.discard(pid)
+            elif time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+        time.sleep(0.05)
     return
 
 
+def prefork(sock, reuse_port):
+    """
+    Master process of the pre-fork mode: start one worker per process wanted,
+    restart the ones that stop, and shut everything down on SIGINT/SIGTERM.
+    :type sock: socket.socket
+    :type reuse_port: bool
+    :return: None
+    :rtype: None
+    """
+    if not reuse_port:
+        sock.listen(socket.SOMAXCONN)
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        for i in range(config_srv.CONFIGURATION['Processes'] or os.cpu_count()):
+            spawn_worker(sock, reuse_port)
+        while True:
+            (pid, status) = os.wait()
+            if pid in workers:
+                workers.discard(pid)
+                print("Worker", pid, "stopped, restarting it.")
+                # Don't fork in a loop if the workers die right away
+                time.sleep(0.1)
+                spawn_worker(sock, reuse_port)
+    except KeyboardInterrupt:
+        print("Socket stopped manually")
+    stop_workers()
+    server_shutdown(sock)
+
+
 def main():
+    # python server_http.py [configuration file .toml, .json or .ini]
+    if len(sys.argv) > 1:
+        try:
+            config_srv.load(sys.argv[1])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print("Configuration file error:", repr(e))
+            sys.exit(1)
+        config_srv.watch()
     config()
+    raise_fd_limit()
     host = "127.0.0.1"
-    port = CONFIGURATION['Port']
+    port = config_srv.CONFIGURATION['Port']
+    processes = config_srv.CONFIGURATION['Processes']
+    reuse_port = processes != 1 and config_srv.CONFIGURATION['ReusePort'] and hasattr(socket, "SO_REUSEPORT")
+    if config_srv.CONFIGURATION['Preload']:
+        # Before the fork, the workers share the preloaded files
+        preload()
+    try:
+        # Before the fork, the workers share the session ticket keys
+        tls_http.create_context()
+    except (OSError, ValueError) as e:
+        print("TLS certificate error:", repr(e))
+        sys.exit(1)
+    signal.signal(signal.SIGHUP, hangup)
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             try:
+                if reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 sock.bind((host, port))
                 print("-------------" + "\n" + "The server has started on the port: ", port)
             except PermissionError:
@@ -95,7 +409,12 @@ def main():
             except OSError:
                 print("Cannot attach the socket to this port.")
                 server_shutdown(sock)
-            listen(sock)
+            if processes != 1:
+                prefork(sock, reuse_port)
+            else:
+                # Stopped like a manual interruption, for the access log to be written
+                signal.signal(signal.SIGTERM, interrupt)
+                serve(sock)
     except OSError:
         print("Socket creation failure.")
 
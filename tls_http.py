@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# System modules
+import ssl
+# Internal modules
+import config_srv
+import log_http
+import metrics_http
+
+# Context of the HTTPS connections, None for plain HTTP.
+# Created once before the worker processes are forked, for them to share its session ticket keys.
+context = None
+
+
+def create_context():
+    """
+    Create the TLS context of the server from TlsCertificate and TlsKey, offering h2 with ALPN
+    when Http2 is enabled. The returning clients resume their session without a full handshake:
+    with a session ticket, encrypted by keys drawn when the context is created and so accepted
+    by every worker process forked after, or by session ID from the cache of the process.
+    :return: the context, None without certificate
+    :rtype: ssl.SSLContext or None
+    :raise: OSError or ssl.SSLError when the certificate or the key can't be loaded
+    """
+    global context
+    certificate = config_srv.CONFIGURATION['TlsCertificate']
+    if not certificate:
+        context = None
+        return None
+    new = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    # HTTP/2 requires TLS 1.2 at least
+    new.minimum_version = ssl.TLSVersion.TLSv1_2
+    new.load_cert_chain(certificate, config_srv.CONFIGURATION['TlsKey'] or None)
+    new.set_alpn_protocols(["h2", "http/1.1"] if config_srv.CONFIGURATION['Http2'] else ["http/1.1"])
+    if not config_srv.CONFIGURATION['TlsSessionTickets']:
+        # TLS 1.3 still gives tickets, holding only the ID of the session kept in the cache
+        new.options |= ssl.OP_NO_TICKET
+    context = new
+    return new
+
+
+def wrap(sock):
+    """
+    Wrap an accepted connection without doing its handshake,
+    left to the worker serving it so that a slow client doesn't stall the accept loop
+    :param sock: socket accepted
+    :type sock: socket.socket
+    :return: the socket encrypting the connection
+    :rtype: ssl.SSLSocket
+    """
+    return context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+
+
+def handshake(sock):
+    """
+    Do the TLS handshake of a connection given by wrap, in at most TlsHandshakeTimeout seconds
+    :param sock: socket representing the connection with the client
+    :type sock: socket.socket or ssl.SSLSocket
+    :return: protocol chosen with ALPN, "http/1.1" when the client doesn't use ALPN
+             or the connection is not encrypted, None when the handshake failed
+    :rtype: str or None
+    """
+    if not isinstance(sock, ssl.SSLSocket):
+        return "http/1.1"
+    try:
+        sock.settimeout(config_srv.CONFIGURATION['TlsHandshakeTimeout'])
+        sock.do_handshake()
+    except (OSError, ValueError) as e:
+        # ssl.SSLError and socket.timeout are OSError
+        log_http.debug("TLS handshake failed: " + repr(e))
+        return None
+    return sock.selected_alpn_protocol() or "http/1.1"
+
+
+def session_stat(name):
+    """
+    Read a counter of the OpenSSL session cache of the context
+    :param name: key of ssl.SSLContext.session_stats()
+    :type name: str
+    :return: the counter, 0 for plain HTTP
+    :rtype: int
+    """
+    if context is None:
+        return 0
+    return context.session_stats()[name]
+
+
+metrics_http.counters['http_tls_handshakes_total'] = (
+    "TLS handshakes completed.", lambda: session_stat('accept_good'))
+metrics_http.counters['http_tls_handshakes_failed_total'] = (
+    "TLS handshakes started and not completed.", lambda: session_stat('accept') - session_stat('accept_good'))
+metrics_http.counters['http_tls_sessions_resumed_total'] = (
+    "TLS handshakes resuming a session, with a ticket or a session ID.", lambda: session_stat('hits'))
+
+
+def main():
+    # Test
+    import asyncio
+    import os
+    import socket
+    import subprocess
+    import tempfile
+    import threading
+    import async_http
+    import client_http
+    import h2_http
+    import hpack_http
+    # The engines use the context of the module they import, not the one of __main__
+    import tls_http
+
+    def frames_of(data):
+        frames = []
+        while data:
+            length = int.from_bytes(data[:3], "big")
+            frames.append((data[3], data[9:9 + length]))
+            data = data[9 + length:]
+        return frames
+
+    def exchange(client_side, data, session):
+        # Send data from a new client connection, return what it received until closed,
+        # its session, whether it was resumed and the protocol chosen with ALPN
+        client_side = client_context.wrap_socket(client_side, server_hostname="localhost", session=session)
+        client_side.sendall(data)
+        response = b""
+        while True:
+            buf = client_side.recv(65536)
+            if not buf:
+                break
+            response += buf
+        result = (response, client_side.session, client_side.session_reused, client_side.selected_alpn_protocol())
+        client_side.close()
+        return result
+
+    def served(data, session=None):
+        # Serve one connection with the threads engine
+        (server_side, client_side) = socket.socketpair()
+        thread = threading.Thread(target=client_http.client_processing, args=[tls_http.wrap(server_side)])
+        thread.start()
+        result = exchange(client_side, data, session)
+        thread.join()
+        return result
+
+    # ----- create_context()
+
+    assert tls_http.create_context() is None and tls_http.context is None
+    assert tls_http.handshake(socket.socket()) == "http/1.1"
+
+    with tempfile.TemporaryDirectory() as directory:
+        certificate = os.path.join(directory, "cert.pem")
+        key = os.path.join(directory, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj",
+                        "/CN=localhost", "-keyout", key, "-out", certificate], check=True, capture_output=True)
+        config_srv.update({'TlsCertificate': certificate, 'TlsKey': key})
+        assert tls_http.create_context() is tls_http.context is not None
+        client_context = ssl.create_default_context(cafile=certificate)
+        print("Test create_context OK")
+
+        # ----- handshake()
+
+        client_context.set_alpn_protocols(["http/1.1"])
+        (response, session, reused, protocol) = served(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n") and not reused
+        # RETURNING CLIENT RESUMING ITS SESSION WITH A TICKET
+        (response, session, reused, protocol) = served(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n", session)
+        assert response.startswith(b"HTTP/1.1 200 OK\r\n") and reused and protocol == "http/1.1"
+        assert tls_http.session_stat('accept_good') == 2 and tls_http.session_stat('hits') == 1
+
+        # HTTP/2 CHOSEN WITH ALPN
+        client_context.set_alpn_protocols(["h2", "http/1.1"])
+        block = hpack_http.Encoder().encode([(":method", "GET"), (":scheme", "https"), (":path", "/"),
+                                             (":authority", "localhost")])
+        (response, session, reused, protocol) = served(
+            h2_http.PREFACE + h2_http.frame(h2_http.SETTINGS, 0, 0) +
+            h2_http.frame(h2_http.HEADERS, h2_http.END_STREAM | h2_http.END_HEADERS, 1, block) +
+            h2_http.frame(h2_http.GOAWAY, 0, 0, bytes(8)))
+        assert protocol == "h2"
+        frames = frames_of(response)
+        headers = [payload for (frame_type, payload) in frames if frame_type == h2_http.HEADERS]
+        assert hpack_http.Decoder().decode(headers[0])[0] == (":status", "200")
+        assert frames[-1][0] == h2_http.DATA
+
+        # PLAIN HTTP SENT TO THE HTTPS SERVER
+        (server_side, client_side) = socket.socketpair()
+        client_side.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        assert tls_http.handshake(tls_http.wrap(server_side)) is None
+        text = metrics_http.render().splitlines()
+        assert "http_tls_sessions_resumed_total 1" in text and "http_tls_handshakes_failed_total 1" in text
+        print("Test handshake OK")
+
+        # ----- async_http.serve_forever()
+
+        async def test_async():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(("127.0.0.1", 0))
+            server = asyncio.create_task(async_http.serve_forever(sock))
+            await asyncio.sleep(0.1)
+            responses = []
+            session = None
+            for (protocols, data) in ((["http/1.1"], b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n"),
+                                      (["http/1.1"], b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n"),
+                                      (["h2"], h2_http.PREFACE + h2_http.frame(h2_http.SETTINGS, 0, 0) +
+                                       h2_http.frame(h2_http.GOAWAY, 0, 0, bytes(8)))):
+                client_context.set_alpn_protocols(protocols)
+                # The asyncio streams can't resume a session, the client is blocking
+                (response, session, reused, protocol) = await asyncio.to_thread(
+                    exchange, socket.create_connection(sock.getsockname()), data, session)
+                responses.append((response, reused))
+            # The connections are served until the server sees them closed, then it is stopped
+            handlers = asyncio.all_tasks() - {asyncio.current_task(), server}
+            if handlers:
+                await asyncio.wait(handlers)
+            server.cancel()
+            try:
+                await server
+            except asyncio.CancelledError:
+                pass
+            return responses
+
+        config_srv.update({'TlsSessionTickets': False})
+        tls_http.create_context()
+        responses = asyncio.run(test_async())
+        assert responses[0][0].startswith(b"HTTP/1.1 200 OK\r\n") and responses[1][0].startswith(b"HTTP/1.1 200")
+        # WITHOUT TICKET, THE SESSION IS RESUMED FROM THE CACHE OF THE PROCESS
+        assert not responses[0][1] and responses[1][1]
+        assert frames_of(responses[2][0])[-1][0] == h2_http.GOAWAY
+        print("Test serve_forever OK")
+        config_srv.update({'TlsCertificate': None, 'TlsKey': None, 'TlsSessionTickets': True})
+        tls_http.create_context()
+
+
+if __name__ == "__main__":
+    main()